@@ -0,0 +1,140 @@
+"""partition_orders_and_revenues_by_month
+
+Revision ID: f6a7b8c9d0e1
+Revises: e5f6a7b8c9d0
+Create Date: 2026-10-19 16:40:13.274590
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f6a7b8c9d0e1'
+down_revision: Union[str, None] = 'e5f6a7b8c9d0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Số tháng tạo sẵn phía trước (sau đó job beat ensure_future_partitions lo tiếp)
+MONTHS_AHEAD = 3
+
+
+def _add_months(month, count):
+    index = month.year * 12 + (month.month - 1) + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _create_month_partitions(table, key):
+    """Partition theo tháng phủ toàn bộ dữ liệu hiện có của bảng cũ + vài tháng tới, và partition DEFAULT."""
+    conn = op.get_bind()
+    first, last = conn.execute(sa.text(
+        f"SELECT date_trunc('month', MIN({key}))::date, date_trunc('month', MAX({key}))::date FROM {table}_unpartitioned"
+    )).first()
+    current = date.today().replace(day=1)
+    month = min(first or current, current)
+    end = _add_months(max(last or current, current), MONTHS_AHEAD)
+    while month <= end:
+        op.execute(
+            f"CREATE TABLE {table}_p{month.year:04d}_{month.month:02d} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+        )
+        month = _add_months(month, 1)
+    op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+
+def _swap_table(table, partition_key=None):
+    """
+    Đổi tên bảng cũ, tạo bảng mới cùng cấu trúc (phân vùng theo `partition_key` hoặc bảng thường),
+    chép dữ liệu, giữ lại sequence id rồi xóa bảng cũ (kéo theo ràng buộc / index cũ).
+    """
+    op.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned")
+    partition_clause = f" PARTITION BY RANGE ({partition_key})" if partition_key else ""
+    op.execute(f"CREATE TABLE {table} (LIKE {table}_unpartitioned INCLUDING DEFAULTS){partition_clause}")
+    if partition_key:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN {partition_key} SET NOT NULL")
+        _create_month_partitions(table, partition_key)
+    op.execute(f"INSERT INTO {table} SELECT * FROM {table}_unpartitioned")
+    op.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY NONE")
+    op.execute(f"DROP TABLE {table}_unpartitioned CASCADE")
+    op.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+
+
+def _create_orders_constraints(partitioned):
+    key_columns = ['id', 'order_date'] if partitioned else ['id']
+    unique_columns = ['order_code', 'brand_id', 'order_date'] if partitioned else ['order_code', 'brand_id']
+    op.create_primary_key('orders_pkey', 'orders', key_columns)
+    op.create_unique_constraint('uq_order_brand_code', 'orders', unique_columns)
+    op.create_foreign_key('orders_brand_id_fkey', 'orders', 'brands', ['brand_id'], ['id'])
+    op.create_index('ix_orders_id', 'orders', ['id'], unique=False)
+    op.create_index('ix_orders_order_code', 'orders', ['order_code'], unique=False)
+    op.create_index('ix_orders_order_date', 'orders', ['order_date'], unique=False)
+    op.create_index('ix_orders_tracking_id', 'orders', ['tracking_id'], unique=False)
+    op.create_index('ix_orders_status', 'orders', ['status'], unique=False)
+    op.create_index('ix_orders_username', 'orders', ['username'], unique=False)
+    op.create_index('ix_orders_source', 'orders', ['source'], unique=False)
+    op.create_index('ix_orders_brand_id', 'orders', ['brand_id'], unique=False)
+    op.create_index('ix_order_brand_id_order_date', 'orders', ['brand_id', 'order_date'], unique=False)
+    op.create_index('idx_order_search_gin', 'orders', ['order_code', 'tracking_id', 'username'], unique=False, postgresql_using='gin', postgresql_ops={'order_code': 'gin_trgm_ops', 'tracking_id': 'gin_trgm_ops', 'username': 'gin_trgm_ops'})
+
+
+def _create_revenues_constraints(partitioned):
+    op.create_primary_key('revenues_pkey', 'revenues', ['id', 'transaction_date'] if partitioned else ['id'])
+    op.create_foreign_key('revenues_brand_id_fkey', 'revenues', 'brands', ['brand_id'], ['id'])
+    op.create_index('ix_revenues_id', 'revenues', ['id'], unique=False)
+    op.create_index('ix_revenues_order_code', 'revenues', ['order_code'], unique=False)
+    op.create_index('ix_revenues_order_refund', 'revenues', ['order_refund'], unique=False)
+    op.create_index('ix_revenues_source', 'revenues', ['source'], unique=False)
+    op.create_index('ix_revenues_brand_id', 'revenues', ['brand_id'], unique=False)
+    op.create_index('ix_revenue_brand_id_transaction_date', 'revenues', ['brand_id', 'transaction_date'], unique=False)
+    op.create_index('idx_revenue_search_gin', 'revenues', ['order_code', 'order_refund'], unique=False, postgresql_using='gin', postgresql_ops={'order_code': 'gin_trgm_ops', 'order_refund': 'gin_trgm_ops'})
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+
+    # 1. Khóa phân vùng phải có giá trị: dòng doanh thu thiếu ngày giao dịch lấy theo ngày đặt đơn
+    op.execute("UPDATE revenues SET transaction_date = order_date WHERE transaction_date IS NULL AND order_date IS NOT NULL")
+    op.execute("""
+        UPDATE revenues r SET transaction_date = CAST(o.order_date AS date)
+        FROM orders o
+        WHERE r.transaction_date IS NULL AND o.brand_id = r.brand_id
+          AND o.order_code = r.order_code AND o.order_date IS NOT NULL
+    """)
+    missing_orders = conn.execute(sa.text("SELECT COUNT(*) FROM orders WHERE order_date IS NULL")).scalar()
+    missing_revenues = conn.execute(sa.text("SELECT COUNT(*) FROM revenues WHERE transaction_date IS NULL")).scalar()
+    if missing_orders or missing_revenues:
+        raise RuntimeError(
+            f"Không thể phân vùng: {missing_orders} đơn thiếu order_date, {missing_revenues} dòng doanh thu "
+            "thiếu transaction_date. Hãy bổ sung ngày hoặc xóa các dòng này rồi chạy lại migration."
+        )
+
+    # 2. order_items tham chiếu orders qua (order_id, order_date) - khóa ngoại tới bảng phân vùng phải chứa khóa phân vùng
+    op.add_column('order_items', sa.Column('order_date', sa.DateTime(), nullable=True))
+    op.execute("UPDATE order_items oi SET order_date = o.order_date FROM orders o WHERE o.id = oi.order_id")
+    op.execute("DELETE FROM order_items WHERE order_date IS NULL")
+    op.alter_column('order_items', 'order_date', nullable=False)
+
+    # 3. Chuyển orders / revenues sang bảng phân vùng theo tháng
+    _swap_table('orders', 'order_date')
+    _create_orders_constraints(partitioned=True)
+    _swap_table('revenues', 'transaction_date')
+    _create_revenues_constraints(partitioned=True)
+
+    op.create_foreign_key('order_items_order_fkey', 'order_items', 'orders', ['order_id', 'order_date'], ['id', 'order_date'], ondelete='CASCADE')
+
+
+def downgrade() -> None:
+    op.drop_constraint('order_items_order_fkey', 'order_items', type_='foreignkey')
+
+    _swap_table('revenues')
+    op.alter_column('revenues', 'transaction_date', nullable=True)
+    _create_revenues_constraints(partitioned=False)
+    _swap_table('orders')
+    op.alter_column('orders', 'order_date', nullable=True)
+    _create_orders_constraints(partitioned=False)
+
+    op.create_foreign_key('order_items_order_id_fkey', 'order_items', 'orders', ['order_id'], ['id'], ondelete='CASCADE')
+    op.drop_column('order_items', 'order_date')
@@ -0,0 +1,47 @@
+# FILE: Backend/app/async_database.py
+
+import os
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+# Dùng chung DATABASE_URL với database.py, chỉ đổi driver sang asyncpg
+DATABASE_URL = os.getenv("DATABASE_URL")
+if DATABASE_URL is None:
+    raise ValueError("Biến môi trường DATABASE_URL chưa được thiết lập!")
+
+def to_async_url(url: str) -> str:
+    """postgresql://... hoặc postgresql+psycopg2://... -> postgresql+asyncpg://..."""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
+# Pool cho luồng đọc async: không bị giới hạn bởi threadpool của FastAPI/Starlette
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=int(os.getenv("ASYNC_DB_POOL_SIZE", 20)),
+    max_overflow=int(os.getenv("ASYNC_DB_MAX_OVERFLOW", 20)),
+    pool_pre_ping=True
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Read replica (tùy chọn): cùng URL với REPLICA_DATABASE_URL, đổi driver sang asyncpg
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL") or None
+ASYNC_REPLICA_DATABASE_URL = os.getenv("ASYNC_REPLICA_DATABASE_URL") or (to_async_url(REPLICA_DATABASE_URL) if REPLICA_DATABASE_URL else None)
+async_replica_engine = None
+AsyncReplicaSessionLocal = None
+if ASYNC_REPLICA_DATABASE_URL:
+    async_replica_engine = create_async_engine(
+        ASYNC_REPLICA_DATABASE_URL,
+        pool_size=int(os.getenv("ASYNC_DB_POOL_SIZE", 20)),
+        max_overflow=int(os.getenv("ASYNC_DB_MAX_OVERFLOW", 20)),
+        pool_pre_ping=True,
+        connect_args={"server_settings": {"default_transaction_read_only": "on"}}
+    )
+    AsyncReplicaSessionLocal = async_sessionmaker(async_replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async def get_async_db():
+    """Dependency: một AsyncSession cho mỗi request (chỉ đọc)."""
+    async with AsyncSessionLocal() as session:
+        yield session
@@ -1,7 +1,13 @@
 # FILE: backend/app/cache.py
 
 import redis
+import redis.asyncio as aioredis
 import os
+import gzip
+import json
+import orjson
+from bisect import bisect_left
+from datetime import date
 
 # Lấy thông tin host từ biến môi trường nếu có, mặc định là 'cache'
 REDIS_HOST = os.getenv("REDIS_HOST", "cache")
@@ -17,4 +23,190 @@ redis_client = redis.Redis(
     password=REDIS_PASSWORD
 )
 
-print("Đã kết nối đến Redis server.")
\ No newline at end of file
+# Client trả về bytes thô (không decode) - dùng cho các payload đã nén sẵn (gzip)
+redis_binary_client = redis.Redis(
+    host=REDIS_HOST,
+    port=6379,
+    db=0,
+    decode_responses=False,
+    password=REDIS_PASSWORD
+)
+
+# Client bất đồng bộ cho các endpoint đọc async (dashboard) - tương đương redis_client
+async_redis_client = aioredis.Redis(
+    host=REDIS_HOST,
+    port=6379,
+    db=0,
+    decode_responses=True,
+    password=REDIS_PASSWORD
+)
+
+# Client bất đồng bộ (bytes thô) cho các endpoint async: SSE pub/sub
+async_redis_binary_client = aioredis.Redis(
+    host=REDIS_HOST,
+    port=6379,
+    db=0,
+    decode_responses=False,
+    password=REDIS_PASSWORD
+)
+
+print("Đã kết nối đến Redis server.")
+
+def result_channel(cache_key: str) -> str:
+    """Kênh pub/sub mà worker publish kết quả (payload đã đóng gói) khi xử lý xong cache_key."""
+    return f"data_req_done:{cache_key}"
+
+# TTL mặc định của cache data request (giây) và TTL dài hơn cho các key được làm nóng sẵn (warm)
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 3600))
+WARM_CACHE_TTL_SECONDS = int(os.getenv("WARM_CACHE_TTL_SECONDS", 12 * 3600))
+
+def generate_cache_key(brand_id: int, request_type: str, params: dict) -> str:
+    """Tạo ra một cache key nhất quán từ thông tin request."""
+    param_string = ":".join(f"{k}={v}" for k, v in sorted(params.items()))
+    return f"data_req:{brand_id}:{request_type}:{param_string}"
+
+# Mức nén gzip cho payload cache: 6 là điểm cân bằng giữa CPU của worker và dung lượng
+PAYLOAD_COMPRESS_LEVEL = 6
+
+def pack_payload(envelope: dict) -> bytes:
+    """
+    Serialize envelope ({"status": ..., "data"/"error": ...}) bằng orjson rồi nén gzip.
+    Kết quả được lưu nguyên vào Redis và API trả thẳng về client (Content-Encoding: gzip).
+    """
+    return gzip.compress(
+        orjson.dumps(envelope, default=str, option=orjson.OPT_NON_STR_KEYS),
+        compresslevel=PAYLOAD_COMPRESS_LEVEL
+    )
+
+def is_packed_payload(raw: bytes) -> bool:
+    """Kiểm tra magic bytes gzip (bỏ qua các entry cũ dạng JSON thuần còn sót trong cache)."""
+    return bool(raw) and raw[:2] == b"\x1f\x8b"
+
+def unpack_payload(raw: bytes) -> dict:
+    """Giải nén + parse payload đã được tạo bởi `pack_payload`."""
+    return orjson.loads(gzip.decompress(raw))
+
+# ==============================================================================
+# INDEX CACHE KEY THEO BRAND + THÁNG (phục vụ xóa cache theo ngày, không cần SCAN)
+# ==============================================================================
+# - cache_idx:{brand_id}:{YYYY-MM}  (SET)  : các cache key có khoảng thời gian giao với tháng đó
+# - cache_idx_meta:{brand_id}       (HASH) : cache key -> {"s": start, "e": end, "src": [sources] | null}
+
+def _index_bucket_key(brand_id: int, bucket: str) -> str:
+    return f"cache_idx:{brand_id}:{bucket}"
+
+def _index_meta_key(brand_id: int) -> str:
+    return f"cache_idx_meta:{brand_id}"
+
+def _month_buckets(start_date: date, end_date: date) -> list:
+    buckets = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        buckets.append(f"{year:04d}-{month:02d}")
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+    return buckets
+
+def _normalize_index_sources(sources):
+    """None / 'all' = toàn bộ nguồn; list rỗng = không nguồn nào (kết quả rỗng)."""
+    if sources is None:
+        return None
+    if isinstance(sources, str):
+        sources = [sources]
+    cleaned = [str(s).strip().lower() for s in sources if s is not None and str(s).strip()]
+    if "all" in cleaned:
+        return None
+    return sorted(set(cleaned))
+
+def index_cache_key(brand_id: int, cache_key: str, start_date: date, end_date: date, sources=None, ttl_seconds: int = None):
+    """
+    Đăng ký cache key vào index theo tháng để có thể xóa chính xác khi dữ liệu của ngày thay đổi.
+    Lỗi Redis ở đây không được làm hỏng luồng chính (chỉ mất khả năng xóa chọn lọc).
+    """
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        _queue_index_commands(pipe, brand_id, cache_key, start_date, end_date, sources, ttl_seconds)
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không index được cache key {cache_key}: {e}")
+
+async def async_index_cache_key(brand_id: int, cache_key: str, start_date: date, end_date: date, sources=None, ttl_seconds: int = None):
+    """Phiên bản async của `index_cache_key` cho luồng đọc async."""
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        _queue_index_commands(pipe, brand_id, cache_key, start_date, end_date, sources, ttl_seconds)
+        await pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không index được cache key {cache_key}: {e}")
+
+def _queue_index_commands(pipe, brand_id: int, cache_key: str, start_date: date, end_date: date, sources, ttl_seconds):
+    """Đưa các lệnh index vào pipeline (dùng chung cho client sync và async)."""
+    if end_date < start_date:
+        start_date, end_date = end_date, start_date
+    meta = json.dumps({
+        "s": start_date.isoformat(),
+        "e": end_date.isoformat(),
+        "src": _normalize_index_sources(sources),
+    })
+    # Index sống lâu hơn cache key dài nhất; key hết hạn còn sót trong index chỉ tốn một lệnh DEL vô hại
+    index_ttl = max(ttl_seconds or CACHE_TTL_SECONDS, WARM_CACHE_TTL_SECONDS) + 3600
+
+    for bucket in _month_buckets(start_date, end_date):
+        bucket_key = _index_bucket_key(brand_id, bucket)
+        pipe.sadd(bucket_key, cache_key)
+        pipe.expire(bucket_key, index_ttl)
+    pipe.hset(_index_meta_key(brand_id), cache_key, meta)
+    pipe.expire(_index_meta_key(brand_id), index_ttl)
+
+def evict_cache_for_dates(brand_id: int, affected_dates, source: str = None) -> int:
+    """
+    Xóa các cache key của brand có khoảng thời gian chứa ít nhất một ngày bị ảnh hưởng
+    và có bộ lọc nguồn bao gồm `source` (source=None nghĩa là thay đổi trên mọi nguồn).
+    Trả về số key đã xóa.
+    """
+    dates = sorted({d if isinstance(d, date) else date.fromisoformat(str(d)) for d in affected_dates if d})
+    if not dates:
+        return 0
+    source = str(source).strip().lower() if source else None
+    meta_key = _index_meta_key(brand_id)
+
+    # 1. Gom các key ứng viên từ những tháng bị ảnh hưởng
+    buckets = sorted({d.strftime("%Y-%m") for d in dates})
+    pipe = redis_client.pipeline(transaction=False)
+    for bucket in buckets:
+        pipe.smembers(_index_bucket_key(brand_id, bucket))
+    candidates = sorted(set().union(*pipe.execute()))
+    if not candidates:
+        return 0
+
+    # 2. Lọc chính xác theo khoảng ngày và nguồn
+    metas = redis_client.hmget(meta_key, candidates)
+    to_evict = []  # (cache_key, buckets của key đó)
+    for cache_key, raw_meta in zip(candidates, metas):
+        if raw_meta is None:
+            # Không có metadata -> không chứng minh được là an toàn, xóa luôn
+            to_evict.append((cache_key, buckets))
+            continue
+        meta = json.loads(raw_meta)
+        start_date, end_date = date.fromisoformat(meta["s"]), date.fromisoformat(meta["e"])
+        idx = bisect_left(dates, start_date)
+        if idx >= len(dates) or dates[idx] > end_date:
+            continue
+        key_sources = meta.get("src")
+        if source is not None and key_sources is not None and source not in key_sources:
+            continue
+        to_evict.append((cache_key, _month_buckets(start_date, end_date)))
+
+    if not to_evict:
+        return 0
+
+    # 3. Xóa cache + dọn index
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(*[cache_key for cache_key, _ in to_evict])
+    for cache_key, key_buckets in to_evict:
+        for bucket in key_buckets:
+            pipe.srem(_index_bucket_key(brand_id, bucket), cache_key)
+    pipe.hdel(meta_key, *[cache_key for cache_key, _ in to_evict])
+    pipe.execute()
+    return len(to_evict)
@@ -1,19 +1,26 @@
 # FILE: Backend/app/celery_worker.py
 
-from celery import Celery
+from celery import Celery, chord
+from celery.utils import uuid
+from celery.schedules import crontab
+from celery.signals import worker_process_init, before_task_publish, task_prerun
 import os
 import json
+import time
+import random
 import traceback
-from datetime import date, timedelta
-from worker_utils import get_db_session
+from worker_utils import get_db_session, get_read_db_session, engine as worker_engine, replica_engine as worker_replica_engine
 import crud
-import kpi_utils
 import models
-import schemas
 from datetime import date, timedelta, datetime
-from services import dashboard_service, data_service
-from cache import redis_client
-from sqlalchemy import func, distinct
+from services import dashboard_service, data_service, warmup_service
+from cache import redis_client, redis_binary_client, pack_payload, generate_cache_key, index_cache_key, result_channel, CACHE_TTL_SECONDS, WARM_CACHE_TTL_SECONDS
+from sqlalchemy import func, distinct, text
+from kpi_history import CustomerHistorySnapshot
+import task_queues
+from task_queues import INTERACTIVE_QUEUE, BULK_QUEUE, run_with_brand_slot, record_queue_wait
+import partitioning
+import replica
 
 # --- Cấu hình Celery (Kết nối đến Redis) ---
 REDIS_HOST = os.getenv("REDIS_HOST", "cache")
@@ -23,24 +30,131 @@ CELERY_RESULT_BACKEND = f"redis://:{REDIS_PASSWORD}@{REDIS_HOST}:6379/2"
 
 celery_app = Celery("tasks", broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
 
+# Giờ chạy job làm nóng cache hàng ngày (theo APP_TIMEZONE) và độ trễ sau khi tính toán lại
+CACHE_WARM_HOUR = int(os.getenv("CACHE_WARM_HOUR", 6))
+CACHE_WARM_DELAY_SECONDS = int(os.getenv("CACHE_WARM_DELAY_SECONDS", 5))
+# Số ngày được tính lại & commit trong mỗi khối của lần tính toán lại toàn bộ
+RECALC_CHUNK_DAYS = int(os.getenv("RECALC_CHUNK_DAYS", 31))
+# Tính toán lại toàn bộ song song: số shard tối đa (≈ số core của worker bulk) và số ngày tối thiểu mỗi shard
+RECALC_PARALLEL_SHARDS = int(os.getenv("RECALC_PARALLEL_SHARDS", 8))
+RECALC_MIN_SHARD_DAYS = int(os.getenv("RECALC_MIN_SHARD_DAYS", 60))
+# Sổ stats_dirty_days: số dòng nhận mỗi lượt và ngưỡng coi là tồn đọng (job quét định kỳ lên lịch drain lại)
+RECALC_LEDGER_BATCH = int(os.getenv("RECALC_LEDGER_BATCH", 500))
+RECALC_LEDGER_STALE_SECONDS = int(os.getenv("RECALC_LEDGER_STALE_SECONDS", 600))
+# Bảo trì ban đêm: giờ bắt đầu, độ trễ ngẫu nhiên tối đa theo brand (tránh mọi brand chạy cùng lúc),
+# giờ VACUUM/ANALYZE và ngưỡng số dòng thay đổi kể từ lần ANALYZE gần nhất
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", 2))
+MAINTENANCE_JITTER_SECONDS = int(os.getenv("MAINTENANCE_JITTER_SECONDS", 1800))
+VACUUM_HOUR = int(os.getenv("VACUUM_HOUR", 4))
+VACUUM_MIN_CHANGED_ROWS = int(os.getenv("VACUUM_MIN_CHANGED_ROWS", 50000))
+VACUUM_CHANGED_RATIO = float(os.getenv("VACUUM_CHANGED_RATIO", 0.1))
+# Xóa brand chạy nền: số dòng mỗi lô DELETE (mỗi lô một transaction)
+BRAND_DELETE_BATCH_SIZE = int(os.getenv("BRAND_DELETE_BATCH_SIZE", 5000))
+# Giờ job tạo trước partition theo tháng cho orders / revenues
+PARTITION_MAINTENANCE_HOUR = int(os.getenv("PARTITION_MAINTENANCE_HOUR", 1))
+
 celery_app.conf.update(
     task_track_started=True,
     result_expires=timedelta(hours=1),
     broker_connection_retry_on_startup=True,
+    timezone=warmup_service.APP_TIMEZONE,
+    # Hai hàng đợi tách biệt:
+    # - interactive: người dùng đang chờ kết quả (worker gevent)
+    # - bulk: tính toán lại / làm nóng cache chạy lâu (worker prefork riêng)
+    task_default_queue=INTERACTIVE_QUEUE,
+    task_routes={
+        "process_data_request": {"queue": INTERACTIVE_QUEUE},
+        "recalculate_all_brand_data": {"queue": BULK_QUEUE},
+        "recalculate_brand_data_specific_dates": {"queue": BULK_QUEUE},
+        "warm_brand_cache": {"queue": BULK_QUEUE},
+        "warm_all_brands_cache": {"queue": BULK_QUEUE},
+        "drain_brand_recalculation": {"queue": BULK_QUEUE},
+        "recalculate_brand_shard": {"queue": BULK_QUEUE},
+        "finalize_brand_recalculation": {"queue": BULK_QUEUE},
+        "fail_brand_recalculation": {"queue": BULK_QUEUE},
+        "sweep_stats_dirty_days": {"queue": BULK_QUEUE},
+        "schedule_nightly_maintenance": {"queue": BULK_QUEUE},
+        "run_brand_maintenance": {"queue": BULK_QUEUE},
+        "vacuum_hot_tables": {"queue": BULK_QUEUE},
+        "delete_brand": {"queue": BULK_QUEUE},
+        "clone_brand_data": {"queue": BULK_QUEUE},
+        "ensure_future_partitions": {"queue": BULK_QUEUE},
+    },
+    # Worker chỉ giữ trước 1 task/slot: task chờ nằm lại trong broker (đo được độ sâu queue)
+    worker_prefetch_multiplier=1,
+    beat_schedule={
+        "warm-all-brands-cache-every-morning": {
+            "task": "warm_all_brands_cache",
+            "schedule": crontab(hour=CACHE_WARM_HOUR, minute=0),
+        },
+        "sweep-stats-dirty-days": {
+            "task": "sweep_stats_dirty_days",
+            "schedule": timedelta(seconds=RECALC_LEDGER_STALE_SECONDS),
+        },
+        "nightly-brand-maintenance": {
+            "task": "schedule_nightly_maintenance",
+            "schedule": crontab(hour=MAINTENANCE_HOUR, minute=0),
+        },
+        "vacuum-hot-tables-nightly": {
+            "task": "vacuum_hot_tables",
+            "schedule": crontab(hour=VACUUM_HOUR, minute=0),
+        },
+        "ensure-future-partitions-daily": {
+            "task": "ensure_future_partitions",
+            "schedule": crontab(hour=PARTITION_MAINTENANCE_HOUR, minute=0),
+        },
+    },
 )
 
+@worker_process_init.connect
+def _reset_db_pool_after_fork(**kwargs):
+    """Worker prefork: không dùng chung kết nối DB được mở ở process cha."""
+    worker_engine.dispose(close=False)
+    if worker_replica_engine is not None:
+        worker_replica_engine.dispose(close=False)
+
+@before_task_publish.connect
+def _stamp_enqueued_at(headers=None, **kwargs):
+    """Đóng dấu thời điểm đưa vào hàng đợi (cả khi retry) để đo thời gian chờ."""
+    if headers is not None:
+        headers["enqueued_at"] = time.time()
+
+@task_prerun.connect
+def _measure_queue_wait(task=None, **kwargs):
+    try:
+        request = task.request
+        enqueued_at = getattr(request, "enqueued_at", None) or (request.headers or {}).get("enqueued_at")
+        if not enqueued_at:
+            return
+        ready_at = float(enqueued_at)
+        # Task có countdown/ETA: chỉ tính thời gian chờ sau thời điểm được phép chạy
+        if request.eta:
+            ready_at = max(ready_at, datetime.fromisoformat(str(request.eta)).timestamp())
+        queue = (request.delivery_info or {}).get("routing_key")
+        record_queue_wait(queue, time.time() - ready_at)
+    except Exception as e:
+        print(f"WARNING: Không đo được thời gian chờ queue: {e}")
+
 # ==============================================================================
 # TASK 1: "SIÊU TASK" XỬ LÝ YÊU CẦU DỮ LIỆU (ĐÃ TỐI ƯU VỚI DAILY STATS)
 # ==============================================================================
-@celery_app.task(name="process_data_request")
-def process_data_request(request_type: str, cache_key: str, brand_id: int, params: dict):
+@celery_app.task(name="process_data_request", bind=True)
+def process_data_request(self, request_type: str, cache_key: str, brand_id: int, params: dict, ttl_seconds: int = None):
     """
     Task trung tâm. Đã được nâng cấp để sử dụng bảng DailyStat cho tốc độ tối đa.
+    ttl_seconds: TTL của cache kết quả (mặc định CACHE_TTL_SECONDS, cache warming dùng TTL dài hơn).
     """
+    return run_with_brand_slot(
+        self, INTERACTIVE_QUEUE, brand_id,
+        _process_data_request, request_type, cache_key, brand_id, params, ttl_seconds
+    )
+
+def _process_data_request(request_type: str, cache_key: str, brand_id: int, params: dict, ttl_seconds: int = None):
     print(f"WORKER: Nhận yêu cầu '{request_type}' cho brand {brand_id}.")
     result_data = None
     try:
-        with get_db_session() as db:
+        # Mọi loại request ở đây chỉ đọc -> replica khi đã theo kịp lần ghi gần nhất của brand
+        with get_read_db_session(brand_id) as db:
             start_date = date.fromisoformat(params.get("start_date"))
             end_date = date.fromisoformat(params.get("end_date"))
 
@@ -48,41 +162,17 @@ def process_data_request(request_type: str, cache_key: str, brand_id: int, param
             # --- Nhánh 1: KPI TỔNG HỢP (ĐÃ TỐI ƯU HÓA) ---
             # --------------------------------------------------------------
             if request_type == "kpi_summary":
-                # TỐI ƯU: Chỉ cần một truy vấn SUM tất cả các cột từ DailyStat
-                summary_query = db.query(
-                    func.sum(models.DailyStat.net_revenue).label('net_revenue'),
-                    func.sum(models.DailyStat.gmv).label('gmv'),
-                    func.sum(models.DailyStat.profit).label('profit'),
-                    func.sum(models.DailyStat.total_cost).label('total_cost'),
-                    func.sum(models.DailyStat.ad_spend).label('ad_spend'),
-                    func.sum(models.DailyStat.total_orders).label('total_orders'),
-                    func.sum(models.DailyStat.cogs).label('cogs'),
-                    func.sum(models.DailyStat.execution_cost).label('execution_cost'),
-                    func.sum(models.DailyStat.completed_orders).label('completed_orders'),
-                    func.sum(models.DailyStat.cancelled_orders).label('cancelled_orders'),
-                    func.sum(models.DailyStat.refunded_orders).label('refunded_orders'),
-                    func.sum(models.DailyStat.unique_skus_sold).label('unique_skus_sold'),
-                    func.sum(models.DailyStat.total_quantity_sold).label('total_quantity_sold'),
-                    func.sum(models.DailyStat.total_customers).label('total_customers'),
-                    func.sum(models.DailyStat.new_customers).label('new_customers'),
-                    func.sum(models.DailyStat.returning_customers).label('returning_customers')
-                ).filter(
-                    models.DailyStat.brand_id == brand_id,
-                    models.DailyStat.date.between(start_date, end_date)
-                ).first()
+                # TỐI ƯU: Tổng lũy kế -> 2 lần đọc theo index mỗi nguồn, không phụ thuộc độ dài khoảng ngày
+                req_source = params.get("source")
+                source_list = None
+                if req_source is not None:
+                    source_list = req_source if isinstance(req_source, list) else [req_source]
 
-                # Chuyển kết quả từ SQLAlchemy Row thành dictionary
-                if summary_query:
-                    d = {key: (value or 0) for key, value in summary_query._mapping.items()}
-                else:
-                    d = {}
+                # Tính lại các tỷ lệ (%) dựa trên tổng bằng kpi_utils.calculate_derived_metrics
+                final_kpis = dashboard_service.get_range_kpis(db, brand_id, start_date, end_date, source_list)
 
-                # BƯỚC 3: TÍNH TOÁN LẠI CÁC TỶ LỆ (%) DỰA TRÊN TỔNG
-                # Sử dụng kpi_utils để tính toán các chỉ số phái sinh một cách thống nhất
-                final_metrics = kpi_utils.calculate_derived_metrics(d)
-                
-                # Validate qua Schema và dump ra JSON-friendly dict
-                result_data = schemas.KpiSet(**final_metrics).model_dump(mode='json')
+                # Dump ra JSON-friendly dict
+                result_data = final_kpis.model_dump(mode='json')
                 
             # --------------------------------------------------------------
             # --- Nhánh 2: BIỂU ĐỒ ---
@@ -96,14 +186,26 @@ def process_data_request(request_type: str, cache_key: str, brand_id: int, param
                     source_list = req_source if isinstance(req_source, list) else [req_source]
 
                 # Gọi hàm mới hỗ trợ aggregation (Trả về List[KpiSet])
+                # Dạng cột chỉ trả chỉ số dạng số -> không đọc cột JSONB
+                columnar = params.get("format") == "columnar"
                 chart_items = dashboard_service.get_aggregated_kpis_chart(
-                    db, brand_id, start_date, end_date, source_list=source_list, interval=interval
+                    db, brand_id, start_date, end_date, source_list=source_list, interval=interval,
+                    fields=dashboard_service.SCALAR_KPI_FIELDS if columnar else None
                 )
                 
-                result_data = {
-                    "data": [item.model_dump(mode='json') for item in chart_items],
-                    "aggregationType": interval
-                }
+                if columnar:
+                    # Dạng cột: một mảng ngày + một mảng mỗi chỉ số được yêu cầu (không có breakdown JSON)
+                    metric_names = dashboard_service.resolve_columnar_metrics(params.get("metrics"))
+                    result_data = {
+                        "format": "columnar",
+                        **dashboard_service.build_columnar_kpis(chart_items, metric_names),
+                        "aggregationType": interval
+                    }
+                else:
+                    result_data = {
+                        "data": [item.model_dump(mode='json') for item in chart_items],
+                        "aggregationType": interval
+                    }
 
             # --------------------------------------------------------------
             # --- Nhánh 3: TOP SẢN PHẨM ---
@@ -151,7 +253,13 @@ def process_data_request(request_type: str, cache_key: str, brand_id: int, param
         # --- LƯU KẾT QUẢ VÀO CACHE ---
         # --------------------------------------------------------------
         if result_data is not None:
-            redis_client.setex(cache_key, timedelta(hours=1), json.dumps(result_data, default=str))
+            # Lưu sẵn toàn bộ envelope dạng orjson + gzip để API trả thẳng bytes khi cache hit
+            packed = pack_payload({"status": "SUCCESS", "data": result_data})
+            redis_binary_client.setex(cache_key, ttl_seconds or CACHE_TTL_SECONDS, packed)
+            # Đẩy kết quả cho các client đang chờ qua SSE (không cần polling)
+            redis_binary_client.publish(result_channel(cache_key), packed)
+            # Index theo tháng để upload/xóa dữ liệu chỉ evict đúng các khoảng thời gian bị ảnh hưởng
+            index_cache_key(brand_id, cache_key, start_date, end_date, params.get("source"), ttl_seconds=ttl_seconds)
             print(f"WORKER: Đã cache kết quả thành công: {cache_key}")
             return {"status": "SUCCESS"}
         else:
@@ -161,87 +269,292 @@ def process_data_request(request_type: str, cache_key: str, brand_id: int, param
         print(f"!!! WORKER ERROR '{request_type}': {e}")
         traceback.print_exc()
         error_info = {"status": "FAILED", "error": str(e)}
-        redis_client.setex(cache_key, timedelta(minutes=5), json.dumps(error_info))
+        packed_error = pack_payload(error_info)
+        redis_binary_client.setex(cache_key, timedelta(minutes=5), packed_error)
+        redis_binary_client.publish(result_channel(cache_key), packed_error)
         return error_info
 
 # ==============================================================================
 # TASK 2: TÍNH TOÁN LẠI TOÀN BỘ (WORKER GHI DB)
 # ==============================================================================
-@celery_app.task(name="recalculate_all_brand_data")
-def recalculate_all_brand_data(brand_id: int):
+@celery_app.task(name="recalculate_all_brand_data", bind=True)
+def recalculate_all_brand_data(self, brand_id: int):
     """
     Task chạy ngầm: Quét dữ liệu thô và cập nhật bảng DailyStat.
     """
+    return run_with_brand_slot(
+        self, BULK_QUEUE, brand_id,
+        _run_with_recalc_lock, self, brand_id, _recalculate_all_brand_data, brand_id
+    )
+
+def _recalculate_all_brand_data(brand_id: int, lock_token: str = None, ledger_ids: list = None, allow_resume: bool = False):
+    """
+    Tính lại toàn bộ: chia các ngày hoạt động thành shard liên tiếp (tối đa RECALC_PARALLEL_SHARDS),
+    mỗi shard tự nạp snapshot lịch sử khách hàng (kpi_history) nên các shard độc lập và chạy song song
+    dưới dạng chord (shard -> finalize). Trong shard, mỗi khối RECALC_CHUNK_DAYS ngày được xóa + tính lại
+    + commit trong MỘT transaction; checkpoint theo shard được lưu vào Redis để chạy tiếp sau sự cố.
+    Brand nhỏ (1 shard) chạy luôn trong task hiện tại.
+    Trả về {"lock_handed_off": True} khi khóa brand được chuyển cho callback của chord.
+    ledger_ids: các dòng stats_dirty_days mà lần tính này bao trùm - chỉ xóa khi finalize thành công.
+    allow_resume: chỉ True khi được lên lịch bởi resume tự động; ngược lại luôn bắt đầu lần chạy mới
+    (start_recalc_progress xóa checkpoint cũ).
+    """
     print(f"WORKER: Bắt đầu RECALCULATE (DailyStat) cho brand ID {brand_id}.")
+    resume = task_queues.get_resume_checkpoint(brand_id) if allow_resume else None
+    attempts = int(resume.get("attempts", 0)) + 1 if resume else 1
     try:
         with get_db_session() as db:
-            # BƯỚC MỚI: Xóa tất cả các bản ghi DailyStat và DailyAnalytics cũ của brand này
-            print(f"WORKER: [1/4] Đang xóa dữ liệu cũ (Stats & Analytics) cho brand {brand_id}...")
-            db.query(models.DailyStat).filter(models.DailyStat.brand_id == brand_id).delete(synchronize_session=False)
-            db.query(models.DailyAnalytics).filter(models.DailyAnalytics.brand_id == brand_id).delete(synchronize_session=False)
-            
-            # QUAN TRỌNG: Commit ngay lập tức để xác nhận việc xóa
-            db.commit() 
-            print(f"WORKER: [2/4] Đã xóa xong và Commit dữ liệu cũ.")
+            print(f"WORKER: [1/3] Đang quét các ngày có hoạt động...")
+            all_activity_dates, orphan_dates = _scan_brand_activity_dates(db, brand_id)
 
-            # 1. Lấy tất cả các ngày có hoạt động (Query trực tiếp để tránh lỗi Import CRUD)
-            print(f"WORKER: [3/4] Đang quét các ngày có hoạt động...")
-            from sqlalchemy import union_all, select
-            
-            q1 = select(func.date(models.Order.order_date)).filter(models.Order.brand_id == brand_id).where(models.Order.order_date.isnot(None))
-            q2 = select(models.Revenue.transaction_date).filter(models.Revenue.brand_id == brand_id).where(models.Revenue.transaction_date.isnot(None))
-            q3 = select(models.MarketingSpend.date).filter(models.MarketingSpend.brand_id == brand_id).where(models.MarketingSpend.date.isnot(None))
-            
-            combined_query = union_all(q1, q2, q3).subquery()
-            # Thực thi query từ subquery
-            # Lưu ý: Khi select từ subquery, ta cần chỉ định cột cụ thể hoặc dùng combined_query.c[0]
-            results = db.execute(select(combined_query.c[0]).distinct().order_by(combined_query.c[0])).all()
-            all_activity_dates = [r[0] for r in results if r[0]]
-            
-            if not all_activity_dates:
-                print(f"WORKER: Brand {brand_id} không có dữ liệu hoạt động nào.")
-                crud.clear_brand_cache(brand_id)
-                return
-            
-            # 2. Tính toán và lưu vào DailyStat từng ngày
-            print(f"WORKER: [4/4] Đang tính toán lại cho {len(all_activity_dates)} ngày...")
-            count = 0
-            for target_date in all_activity_dates:
-                try:
-                    data_service.update_daily_stats(db, brand_id, target_date)
-                    count += 1
-                    if count % 10 == 0:
-                        print(f"WORKER: ...đã xử lý {count}/{len(all_activity_dates)} ngày.")
-                except Exception as inner_e:
-                    print(f"WORKER ERROR tại ngày {target_date}: {inner_e}")
-                    # Tiếp tục chạy các ngày khác chứ không dừng hẳn
-            
-            # 3. Commit dữ liệu mới
-            print("WORKER: Đang commit dữ liệu mới...")
-            db.commit()
-            print("WORKER: Commit thành công. Hoàn tất!")
+        # 1. Kế hoạch shard: dùng lại ranh giới của lần chạy dang dở (nếu có) để checkpoint còn ý nghĩa
+        if resume:
+            run_id = resume["run_id"]
+            shard_bounds = [
+                tuple(date.fromisoformat(v) for v in resume[f"shard:{i}"].split("|"))
+                for i in range(int(resume.get("shards_total", 0)))
+            ]
+            print(f"WORKER: Chạy tiếp lần tính {run_id} (lần thử {attempts}).")
+        else:
+            run_id = uuid()
+            shard_bounds = _plan_shards(all_activity_dates)
+            task_queues.start_recalc_progress(
+                brand_id, run_id=run_id, total_days=len(all_activity_dates), processed_days=0,
+                shards_total=len(shard_bounds), shards_done=0,
+                **{f"shard:{i}": f"{first.isoformat()}|{last.isoformat()}" for i, (first, last) in enumerate(shard_bounds)}
+            )
+        task_queues.update_recalc_progress(brand_id, status="running", attempts=attempts)
+
+        # 2. Ngày còn phải tính của từng shard (sau checkpoint của shard đó)
+        shard_work = []
+        for index, (first, last) in enumerate(shard_bounds):
+            checkpoint = (resume or {}).get(f"ckpt:{index}")
+            lower = date.fromisoformat(checkpoint) if checkpoint else None
+            dates = [d for d in all_activity_dates if first <= d <= last and (lower is None or d > lower)]
+            if dates:
+                shard_work.append((index, dates))
+
+        orphan_iso = [d.isoformat() for d in orphan_dates]
+        if len(shard_work) <= 1:
+            print(f"WORKER: [2/3] Đang tính toán lại trong task hiện tại ({len(shard_work)} shard)...")
+            for index, dates in shard_work:
+                _recalculate_shard(brand_id, run_id, index, dates)
+            _finalize_brand_recalculation(brand_id, run_id, orphan_iso, ledger_ids)
+            return {"mode": "inline", "shards": len(shard_work)}
+
+        print(f"WORKER: [2/3] Chia {sum(len(d) for _, d in shard_work)} ngày thành {len(shard_work)} shard song song...")
+        header = [
+            recalculate_brand_shard.s(brand_id, run_id, index, [d.isoformat() for d in dates])
+            for index, dates in shard_work
+        ]
+        callback = finalize_brand_recalculation.s(brand_id, run_id, orphan_iso, lock_token, ledger_ids)
+        chord(header)(callback.on_error(fail_brand_recalculation.s(brand_id, run_id, lock_token, attempts, ledger_ids)))
+        return {"mode": "parallel", "shards": len(shard_work), "lock_handed_off": bool(lock_token)}
 
-            # 4. Xóa cache MỘT LẦN DUY NHẤT
-            data_service.clear_brand_cache(brand_id)
-                
     except Exception as e:
-        print(f"WORKER RECALCULATE ERROR: {e}")
-        traceback.print_exc()
+        _handle_recalculation_failure(brand_id, e, attempts, ledger_ids)
         
     print(f"WORKER: Hoàn thành RECALCULATE cho brand ID {brand_id}.")
 
+def _scan_brand_activity_dates(db, brand_id: int):
+    """Trả về (các ngày có dữ liệu gốc, các ngày có Stats nhưng không còn dữ liệu gốc)."""
+    from sqlalchemy import union_all, select
+    
+    q1 = select(func.date(models.Order.order_date)).filter(models.Order.brand_id == brand_id).where(models.Order.order_date.isnot(None))
+    q2 = select(models.Revenue.transaction_date).filter(models.Revenue.brand_id == brand_id).where(models.Revenue.transaction_date.isnot(None))
+    q3 = select(models.MarketingSpend.date).filter(models.MarketingSpend.brand_id == brand_id).where(models.MarketingSpend.date.isnot(None))
+    
+    combined_query = union_all(q1, q2, q3).subquery()
+    # Lưu ý: Khi select từ subquery, ta cần chỉ định cột cụ thể hoặc dùng combined_query.c[0]
+    results = db.execute(select(combined_query.c[0]).distinct().order_by(combined_query.c[0])).all()
+    all_activity_dates = [r[0] for r in results if r[0]]
+
+    existing_stat_dates = {r[0] for r in db.query(models.DailyStat.date).filter(models.DailyStat.brand_id == brand_id).all()}
+    existing_stat_dates.update(r[0] for r in db.query(models.DailyAnalytics.date).filter(models.DailyAnalytics.brand_id == brand_id).distinct().all())
+    orphan_dates = sorted(existing_stat_dates - set(all_activity_dates))
+    return all_activity_dates, orphan_dates
+
+def _plan_shards(activity_dates: list) -> list:
+    """Chia các ngày (đã sắp xếp) thành các khoảng [first, last] liên tiếp, số ngày gần bằng nhau."""
+    if not activity_dates:
+        return []
+    shard_count = max(1, min(RECALC_PARALLEL_SHARDS, len(activity_dates) // max(RECALC_MIN_SHARD_DAYS, 1)))
+    size = -(-len(activity_dates) // shard_count)
+    return [
+        (activity_dates[offset], activity_dates[min(offset + size, len(activity_dates)) - 1])
+        for offset in range(0, len(activity_dates), size)
+    ]
+
+def _recalculate_shard(brand_id: int, run_id: str, shard_index: int, shard_dates: list) -> int:
+    """
+    Tính lại một shard theo từng khối (commit + checkpoint sau mỗi khối).
+    Trước mỗi commit kiểm tra run_id: lần chạy đã bị fence (shard khác lỗi) -> rollback khối đang tính và dừng.
+    """
+    def still_current():
+        return task_queues.is_current_recalc_run(brand_id, run_id)
+
+    with get_db_session() as db:
+        history = CustomerHistorySnapshot.build(db, brand_id, shard_dates[0], shard_dates[-1])
+        for offset in range(0, len(shard_dates), RECALC_CHUNK_DAYS):
+            chunk = shard_dates[offset:offset + RECALC_CHUNK_DAYS]
+            if not _recompute_date_chunk(db, brand_id, chunk, history=history, fence=still_current):
+                print(f"WORKER: Shard {shard_index} của brand {brand_id} dừng: lần tính {run_id} đã bị thay thế.")
+                return offset
+            task_queues.update_recalc_progress(brand_id, **{f"ckpt:{shard_index}": chunk[-1].isoformat()})
+            task_queues.increment_recalc_progress(brand_id, "processed_days", len(chunk))
+    task_queues.increment_recalc_progress(brand_id, "shards_done")
+    print(f"WORKER: Shard {shard_index} của brand {brand_id} xong ({len(shard_dates)} ngày).")
+    return len(shard_dates)
+
+def _finalize_brand_recalculation(brand_id: int, run_id: str, orphan_dates_iso: list, ledger_ids: list = None):
+    """
+    Dọn các ngày không còn dữ liệu gốc, đánh dấu hoàn tất, xóa cache một lần rồi làm nóng lại.
+    ledger_ids: dòng sổ tính lại được xóa cùng transaction với tổng lũy kế (lần tính đã hoàn tất).
+    """
+    print(f"WORKER: [3/3] Dọn {len(orphan_dates_iso)} ngày không còn dữ liệu...")
+    if orphan_dates_iso:
+        orphan_dates = [date.fromisoformat(d) for d in orphan_dates_iso]
+        with get_db_session() as db:
+            db.query(models.DailyStat).filter(
+                models.DailyStat.brand_id == brand_id, models.DailyStat.date.in_(orphan_dates)
+            ).delete(synchronize_session=False)
+            db.query(models.DailyAnalytics).filter(
+                models.DailyAnalytics.brand_id == brand_id, models.DailyAnalytics.date.in_(orphan_dates)
+            ).delete(synchronize_session=False)
+            db.commit()
+    # Các shard đã commit số liệu mới: dựng lại toàn bộ tổng lũy kế rồi ghim đọc vào primary tới khi replica theo kịp
+    with get_db_session() as db:
+        data_service.refresh_cumulative_stats(db, brand_id)
+        data_service.ack_dirty_days(db, ledger_ids or [])
+        db.commit()
+        replica.pin_brand_to_primary(db, brand_id)
+
+    task_queues.update_recalc_progress(brand_id, status="completed", finished_at=time.time())
+    print(f"WORKER: Hoàn tất lần tính {run_id} cho brand {brand_id}!")
+
+    data_service.clear_brand_cache(brand_id)
+    schedule_cache_warmup(brand_id)
+
+def _handle_recalculation_failure(brand_id: int, error, attempts: int, ledger_ids: list = None):
+    print(f"WORKER RECALCULATE ERROR: {error}")
+    traceback.print_exc()
+    task_queues.update_recalc_progress(brand_id, status="failed", error=str(error)[:500])
+    # Tự chạy tiếp từ checkpoint (có giới hạn số lần) - các khối đã commit được giữ nguyên
+    if attempts < task_queues.RECALC_MAX_RESUME_ATTEMPTS:
+        if ledger_ids:
+            # Các yêu cầu mà lần chạy lỗi bao trùm (còn nguyên trong sổ) trở thành yêu cầu resume
+            with get_db_session() as db:
+                data_service.mark_dirty_days_reason(db, ledger_ids, task_queues.RECALC_RESUME_REASON)
+                db.commit()
+        enqueue_brand_recalculation(brand_id, full=not ledger_ids, reason=task_queues.RECALC_RESUME_REASON)
+
+@celery_app.task(name="recalculate_brand_shard")
+def recalculate_brand_shard(brand_id: int, run_id: str, shard_index: int, shard_dates_iso: list):
+    """Một phần của chord tính toán lại song song (không dùng slot brand: khóa brand do lần chạy cha giữ)."""
+    progress = task_queues.get_recalc_progress(brand_id)
+    if progress.get("run_id") != run_id:
+        print(f"WORKER: Bỏ qua shard {shard_index} của lần tính cũ {run_id}.")
+        return 0
+    return _recalculate_shard(brand_id, run_id, shard_index, [date.fromisoformat(d) for d in shard_dates_iso])
+
+@celery_app.task(name="finalize_brand_recalculation")
+def finalize_brand_recalculation(shard_results: list, brand_id: int, run_id: str, orphan_dates_iso: list, lock_token: str = None, ledger_ids: list = None):
+    """Callback của chord: chạy khi TẤT CẢ shard đã commit."""
+    try:
+        _finalize_brand_recalculation(brand_id, run_id, orphan_dates_iso, ledger_ids)
+        return {"days": sum(shard_results or [])}
+    finally:
+        if lock_token:
+            task_queues.release_recalc_lock(brand_id, lock_token)
+
+@celery_app.task(name="fail_brand_recalculation")
+def fail_brand_recalculation(request, exc, traceback_obj, brand_id: int, run_id: str, lock_token: str = None, attempts: int = 1, ledger_ids: list = None):
+    """
+    Errback của chord: một shard lỗi -> fence lần chạy (các shard còn lại dừng trước lần commit kế tiếp),
+    ghi nhận, nhả khóa và lên lịch chạy tiếp từ checkpoint dưới run_id mới.
+    """
+    try:
+        task_queues.fence_recalc_run(brand_id, run_id)
+        _handle_recalculation_failure(brand_id, exc, attempts, ledger_ids)
+    finally:
+        if lock_token:
+            task_queues.release_recalc_lock(brand_id, lock_token)
+
+def _replace_day_stats(db, brand_id: int, target_dates: list, source: str = None, history=None) -> list:
+    """
+    Xóa + tính lại Stats/Analytics của từng ngày trong một savepoint riêng (KHÔNG commit):
+    ngày lỗi được rollback về số liệu cũ thay vì bị để trống. Trả về danh sách ngày lỗi.
+    source: chỉ thay DailyAnalytics của nguồn này, DailyStat được gộp lại từ các nguồn.
+    """
+    failed_dates = []
+    for target_date in target_dates:
+        try:
+            with db.begin_nested():
+                db.query(models.DailyStat).filter(
+                    models.DailyStat.brand_id == brand_id,
+                    models.DailyStat.date == target_date
+                ).delete(synchronize_session=False)
+                analytics_query = db.query(models.DailyAnalytics).filter(
+                    models.DailyAnalytics.brand_id == brand_id,
+                    models.DailyAnalytics.date == target_date
+                )
+                if source:
+                    analytics_query = analytics_query.filter(models.DailyAnalytics.source == source)
+                analytics_query.delete(synchronize_session=False)
+
+                data_service.update_daily_stats(db, brand_id, target_date, history=history, source=source)
+        except Exception as inner_e:
+            print(f"WORKER ERROR tại ngày {target_date}: {inner_e}")
+            # Tiếp tục chạy các ngày khác chứ không dừng hẳn
+            failed_dates.append(target_date)
+    return failed_dates
+
+def _recompute_date_chunk(db, brand_id: int, chunk_dates: list, history=None, fence=None) -> bool:
+    """
+    Thay thế Stats/Analytics của một khối ngày trong một transaction duy nhất (xem _replace_day_stats).
+    Ngày lỗi giữ số liệu cũ và được ghi lại vào sổ stats_dirty_days cùng transaction: finalize chỉ xóa
+    các dòng sổ mà lần tính bao trùm, dòng mới này ở lại cho job quét định kỳ tính lại.
+    fence(): gọi ngay trước commit; False -> rollback, trả về False (không ghi gì).
+    """
+    try:
+        failed_dates = _replace_day_stats(db, brand_id, chunk_dates, history=history)
+        if failed_dates:
+            data_service.mark_days_dirty(db, brand_id, failed_dates, reason="retry")
+
+        if fence and not fence():
+            db.rollback()
+            return False
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        raise
+
 # ==============================================================================
 # TASK 3: TÍNH TOÁN LẠI THEO NGÀY CỤ THỂ (OPTIMIZED INCREMENTAL UPDATE)
 # ==============================================================================
 @celery_app.task(name="recalculate_brand_data_specific_dates")
-def recalculate_brand_data_specific_dates(brand_id: int, target_dates_iso: list):
+def recalculate_brand_data_specific_dates(brand_id: int, target_dates_iso: list, source: str = None):
+    """
+    [Tương thích] Message cũ còn trong broker mang danh sách ngày ISO: chuyển các ngày vào
+    sổ stats_dirty_days rồi để job drain xử lý. Producer mới ghi sổ trực tiếp cùng transaction dữ liệu.
+    """
+    target_dates = [date.fromisoformat(d) for d in target_dates_iso or []]
+    if target_dates:
+        with get_db_session() as db:
+            data_service.mark_days_dirty(db, brand_id, target_dates, source, reason="legacy")
+            db.commit()
+    return enqueue_brand_recalculation(brand_id).id
+
+def _recalculate_brand_data_specific_dates(brand_id: int, target_dates_iso: list, source: str = None, lock_token: str = None) -> list:
     """
-    Task chạy ngầm: Chỉ tính toán lại các ngày được chỉ định (affected_dates).
-    Giúp tối ưu hiệu năng, tránh xóa toàn bộ dữ liệu lịch sử.
+    Tính lại các ngày trong MỘT transaction: mỗi ngày xóa + tính lại trong savepoint riêng,
+    commit một lần cùng tổng lũy kế (dashboard không thấy ngày trống trong lúc tính).
+    Trả về các ngày tính lỗi (giữ nguyên số liệu cũ) - caller không xóa dòng sổ của các ngày này.
     """
     if not target_dates_iso:
         print("WORKER: Không có ngày nào cần tính toán lại.")
-        return
+        return []
 
     print(f"WORKER: Bắt đầu RECALCULATE (Incremental) cho brand ID {brand_id} với {len(target_dates_iso)} ngày.")
     
@@ -250,41 +563,415 @@ def recalculate_brand_data_specific_dates(brand_id: int, target_dates_iso: list)
         target_dates = [date.fromisoformat(d) for d in target_dates_iso]
         
         with get_db_session() as db:
-            # 1. Xóa dữ liệu cũ (DailyStat & DailyAnalytics) CHỈ TRONG NHỮNG NGÀY NÀY
-            # Lưu ý: Cần xóa để đảm bảo số liệu mới đè lên số liệu cũ sạch sẽ
-            print(f"WORKER: [1/3] Đang xóa dữ liệu cũ của {len(target_dates)} ngày...")
-            
-            db.query(models.DailyStat).filter(
-                models.DailyStat.brand_id == brand_id,
-                models.DailyStat.date.in_(target_dates)
-            ).delete(synchronize_session=False)
-            
-            db.query(models.DailyAnalytics).filter(
-                models.DailyAnalytics.brand_id == brand_id,
-                models.DailyAnalytics.date.in_(target_dates)
-            ).delete(synchronize_session=False)
-            
-            db.commit()
-
-            # 2. Tính toán lại cho từng ngày
-            print(f"WORKER: [2/3] Đang tính toán lại...")
-            count = 0
-            for target_date in target_dates:
-                try:
-                    data_service.update_daily_stats(db, brand_id, target_date)
-                    count += 1
-                except Exception as inner_e:
-                    print(f"WORKER ERROR tại ngày {target_date}: {inner_e}")
+            # 1 + 2. Thay số liệu từng ngày (nguồn: source hoặc tất cả)
+            print(f"WORKER: [1/3] Đang tính toán lại {len(target_dates)} ngày (nguồn: {source or 'tất cả'})...")
+            failed_dates = _replace_day_stats(db, brand_id, target_dates, source=source)
             
             # 3. Commit và Clear Cache
-            print("WORKER: [3/3] Đang commit và xóa cache...")
+            # Tổng lũy kế dựng lại từ ngày sớm nhất vừa tính (cùng transaction với số liệu ngày)
+            data_service.refresh_cumulative_stats(db, brand_id, min(target_dates), source=source)
+
+            print("WORKER: [2/3] Đang commit và xóa cache...")
             db.commit()
+            replica.pin_brand_to_primary(db, brand_id)
             
-            # Xóa cache để dashboard cập nhật
-            data_service.clear_brand_cache(brand_id)
+            # Chỉ xóa cache của các khoảng thời gian chứa ngày bị ảnh hưởng, sau đó làm nóng lại
+            data_service.invalidate_brand_cache(brand_id, target_dates, source)
+            schedule_cache_warmup(brand_id)
             
     except Exception as e:
         print(f"WORKER INCREMENTAL ERROR: {e}")
         traceback.print_exc()
+        # Báo lỗi cho job drain: các dòng trong sổ được trả lại để tính lại lần sau
+        raise
         
-    print(f"WORKER: Hoàn thành RECALCULATE (Incremental) cho brand ID {brand_id}.")
\ No newline at end of file
+    print(f"WORKER: [3/3] Hoàn thành RECALCULATE (Incremental) cho brand ID {brand_id} ({len(failed_dates)} ngày lỗi).")
+    return failed_dates
+
+# ==============================================================================
+# TASK 4: LÀM NÓNG CACHE (CACHE WARMING)
+# ==============================================================================
+def schedule_cache_warmup(brand_id: int):
+    """Nối task làm nóng cache ngay sau khi tính toán lại (không chặn task hiện tại)."""
+    try:
+        warm_brand_cache.apply_async(args=[brand_id], countdown=CACHE_WARM_DELAY_SECONDS)
+    except Exception as e:
+        print(f"WARNING: Không thể lên lịch làm nóng cache cho brand {brand_id}: {e}")
+
+@celery_app.task(name="warm_brand_cache", bind=True)
+def warm_brand_cache(self, brand_id: int):
+    """
+    Tính trước các request hay dùng nhất (mặc định + học từ log) để người xem đầu tiên
+    không phải chờ worker. Các key đã có trong cache sẽ được bỏ qua.
+    """
+    return run_with_brand_slot(self, BULK_QUEUE, brand_id, _warm_brand_cache, brand_id)
+
+def _warm_brand_cache(brand_id: int):
+    plan = warmup_service.build_warm_plan(brand_id)
+    print(f"WORKER: Bắt đầu làm nóng cache cho brand {brand_id} ({len(plan)} request).")
+    warmed, skipped = 0, 0
+
+    for request_type, params in plan:
+        try:
+            if request_type in warmup_service.KPI_ENDPOINT_TYPES:
+                # kpis/operation & kpis/customer đọc từ cache kpi_daily -> làm nóng tầng đó
+                start_date = date.fromisoformat(params["start_date"])
+                end_date = date.fromisoformat(params["end_date"])
+                source_list = params.get("source")
+                # Kỳ trước của customer_kpis đọc từ tổng lũy kế -> chỉ cần làm nóng kỳ hiện tại
+                with get_db_session() as db:
+                    dashboard_service.get_daily_kpis_for_range(
+                        db, brand_id, start_date, end_date, source_list,
+                        cache_ttl=WARM_CACHE_TTL_SECONDS,
+                        fields=dashboard_service.kpi_endpoint_fields(request_type, source_list)
+                    )
+                warmed += 1
+                continue
+
+            cache_key = generate_cache_key(brand_id, request_type, params)
+            if redis_client.exists(cache_key):
+                skipped += 1
+                continue
+            # Chạy trực tiếp trong worker hiện tại (không tạo thêm task con)
+            result = _process_data_request(request_type, cache_key, brand_id, params, ttl_seconds=WARM_CACHE_TTL_SECONDS)
+            if result and result.get("status") == "SUCCESS":
+                warmed += 1
+        except Exception as e:
+            print(f"WORKER WARMUP ERROR '{request_type}' {params}: {e}")
+
+    print(f"WORKER: Làm nóng cache brand {brand_id}: {warmed} mới, {skipped} đã có sẵn.")
+    return {"warmed": warmed, "skipped": skipped}
+
+@celery_app.task(name="warm_all_brands_cache")
+def warm_all_brands_cache():
+    """Job theo lịch (beat): làm nóng cache cho tất cả brand vào đầu ngày."""
+    with get_db_session() as db:
+        brand_ids = [row[0] for row in db.query(models.Brand.id).filter(models.Brand.is_deleting.is_(False)).all()]
+    for brand_id in brand_ids:
+        warm_brand_cache.delay(brand_id)
+    print(f"WORKER: Đã lên lịch làm nóng cache cho {len(brand_ids)} brand.")
+
+# ==============================================================================
+# TASK 5: GỘP CÁC YÊU CẦU TÍNH TOÁN LẠI THEO BRAND (DEBOUNCE / COALESCE)
+# ==============================================================================
+def enqueue_brand_recalculation(brand_id: int, full: bool = False, reason: str = "manual"):
+    """
+    Producer (upload, xóa dữ liệu, nút tính lại): đảm bảo chỉ có MỘT job drain đang chờ cho brand.
+    Các ngày cần tính lại đã được producer ghi vào sổ stats_dirty_days cùng transaction dữ liệu;
+    full=True ghi thêm yêu cầu tính lại toàn bộ. Message Celery chỉ mang brand_id.
+    Trả về AsyncResult của job drain (để caller có thể chờ).
+    """
+    if full:
+        with get_db_session() as db:
+            data_service.mark_full_recalculation(db, brand_id, reason)
+            db.commit()
+    task_id = uuid()
+    existing_task_id = task_queues.claim_pending_drain(brand_id, task_id)
+    if existing_task_id:
+        print(f"API: Gộp yêu cầu tính toán lại của brand {brand_id} vào job {existing_task_id}.")
+        return celery_app.AsyncResult(existing_task_id)
+    return drain_brand_recalculation.apply_async(
+        args=[brand_id], countdown=task_queues.RECALC_DEBOUNCE_SECONDS, task_id=task_id
+    )
+
+def _run_with_recalc_lock(task, brand_id: int, func, *args):
+    """
+    Chỉ một job tính toán lại chạy cho mỗi brand (tránh đua ghi uq_brand_date_stat).
+    func nhận thêm lock_token; nếu func trả về {"lock_handed_off": True} thì khóa được giữ lại
+    và sẽ do callback của chord nhả.
+    """
+    lock = task_queues.recalc_lock(brand_id)
+    lock_token = uuid()
+    if not lock.acquire(token=lock_token):
+        if task.request.called_directly:
+            raise RuntimeError(f"Brand {brand_id} đang được tính toán lại.")
+        print(f"WORKER: Brand {brand_id} đang được tính toán lại, thử lại sau.")
+        raise task.retry(countdown=task_queues.RECALC_DEBOUNCE_SECONDS * 5, max_retries=None)
+    result = None
+    try:
+        result = func(*args, lock_token=lock_token)
+        return result
+    finally:
+        if not (isinstance(result, dict) and result.get("lock_handed_off")):
+            task_queues.release_recalc_lock(brand_id, lock_token)
+
+@celery_app.task(name="drain_brand_recalculation", bind=True)
+def drain_brand_recalculation(self, brand_id: int):
+    """Lấy toàn bộ ngày bẩn tích lũy trong cửa sổ debounce và tính lại một lần (hợp các ngày)."""
+    return run_with_brand_slot(
+        self, BULK_QUEUE, brand_id,
+        _run_with_recalc_lock, self, brand_id, _drain_brand_recalculation, brand_id
+    )
+
+def _drain_brand_recalculation(brand_id: int, lock_token: str = None):
+    task_queues.clear_pending_drain(brand_id)
+    total_days = 0
+    failed_ids = set()
+
+    # Mỗi lô: đọc sổ trong phiên ngắn -> tính lại -> chỉ xóa đúng các dòng đã đọc và tính THÀNH CÔNG.
+    # Không giữ transaction của sổ trong lúc tính; lỗi -> dòng còn nguyên, job quét định kỳ drain lại.
+    while True:
+        with get_db_session() as ledger_db:
+            pending = data_service.peek_dirty_days(ledger_db, brand_id, RECALC_LEDGER_BATCH, exclude_ids=failed_ids)
+            if pending and any(day is None for _, day, _, _ in pending):
+                # Tính lại toàn bộ bao trùm mọi ngày còn lại trong sổ
+                pending = data_service.peek_dirty_days(ledger_db, brand_id, exclude_ids=failed_ids)
+        if not pending:
+            break
+
+        full_reasons = {reason for _, day, _, reason in pending if day is None}
+        if full_reasons:
+            # Sổ chỉ được xóa khi lần tính toàn bộ hoàn tất (inline, hoặc trong callback của chord).
+            # Chỉ chạy tiếp checkpoint cũ khi MỌI yêu cầu toàn bộ đều là resume tự động;
+            # có yêu cầu mới (nút tính lại, bảo trì...) -> tính lại từ đầu
+            ledger_ids = [row_id for row_id, _, _, _ in pending]
+            result = _recalculate_all_brand_data(
+                brand_id, lock_token=lock_token, ledger_ids=ledger_ids,
+                allow_resume=full_reasons == {task_queues.RECALC_RESUME_REASON}
+            ) or {}
+            return {**result, "full": True, "days": total_days}
+
+        # Gộp nguồn theo từng ngày: cùng nguồn giữ nguyên, khác nguồn (hoặc NULL) -> mọi nguồn
+        day_sources = {}
+        for _, day, source, _ in pending:
+            if day not in day_sources:
+                day_sources[day] = source
+            elif day_sources[day] != source:
+                day_sources[day] = None
+
+        dates_by_source = {}
+        for day, source in day_sources.items():
+            dates_by_source.setdefault(source, []).append(day.isoformat())
+
+        print(f"WORKER: Nhận {len(pending)} dòng ({len(day_sources)} ngày) từ sổ tính lại của brand {brand_id}.")
+        failed_days = set()
+        for source, target_dates_iso in dates_by_source.items():
+            failed_days.update(_recalculate_brand_data_specific_dates(brand_id, sorted(target_dates_iso), source))
+
+        # Ngày tính lỗi giữ nguyên số liệu cũ và dòng sổ (bỏ qua trong các lô sau của lần drain này)
+        failed_ids.update(row_id for row_id, day, _, _ in pending if day in failed_days)
+        with get_db_session() as ledger_db:
+            data_service.ack_dirty_days(ledger_db, [row_id for row_id, _, _, _ in pending if row_id not in failed_ids])
+            ledger_db.commit()
+        total_days += len(day_sources) - len(failed_days)
+
+    if not total_days:
+        print(f"WORKER: Brand {brand_id} không còn ngày nào cần tính lại.")
+        return {"mode": "noop", "days": 0}
+    return {"mode": "dates", "days": total_days}
+
+@celery_app.task(name="sweep_stats_dirty_days")
+def sweep_stats_dirty_days():
+    """
+    Job theo lịch (beat): brand còn dòng trong sổ quá lâu (job drain bị mất, worker chết, lỗi)
+    được lên lịch drain lại - đảm bảo không có ngày nào bị bỏ quên.
+    """
+    with get_db_session() as db:
+        brand_ids = data_service.get_brands_with_stale_dirty_days(db, RECALC_LEDGER_STALE_SECONDS)
+    for brand_id in brand_ids:
+        enqueue_brand_recalculation(brand_id)
+    if brand_ids:
+        print(f"WORKER: Lên lịch drain lại cho {len(brand_ids)} brand còn ngày tồn đọng.")
+
+# ==============================================================================
+# TASK 6: BẢO TRÌ BAN ĐÊM (BEAT)
+# ==============================================================================
+# Các bảng ghi nhiều nhất (import / tính toán lại) - danh sách cố định, không nhận input ngoài.
+# orders / revenues là bảng cha phân vùng (không có dòng trong pg_stat_user_tables, VACUUM bảng cha
+# quét mọi partition) -> xét từng partition lá (xem _hot_vacuum_targets).
+HOT_TABLES = [
+    "orders", "revenues", "marketing_spends", "customers",
+    "daily_stats", "daily_analytics", "stats_dirty_days",
+]
+
+def _hot_vacuum_targets(conn) -> list:
+    """HOT_TABLES với mỗi bảng phân vùng được thay bằng các partition lá của nó (pg_inherits)."""
+    targets = []
+    for table in HOT_TABLES:
+        if table in partitioning.PARTITIONED_TABLES:
+            targets.extend(sorted(partitioning.get_existing_partitions(conn, table)))
+        else:
+            targets.append(table)
+    return targets
+
+@celery_app.task(name="schedule_nightly_maintenance")
+def schedule_nightly_maintenance():
+    """Job theo lịch (beat): rải job bảo trì của từng brand trong cửa sổ jitter trên queue bulk."""
+    with get_db_session() as db:
+        brand_ids = [row[0] for row in db.query(models.Brand.id).filter(models.Brand.is_deleting.is_(False)).all()]
+    for brand_id in brand_ids:
+        run_brand_maintenance.apply_async(
+            args=[brand_id], countdown=random.randint(0, MAINTENANCE_JITTER_SECONDS)
+        )
+    print(f"WORKER: Đã lên lịch bảo trì ban đêm cho {len(brand_ids)} brand (jitter ≤ {MAINTENANCE_JITTER_SECONDS}s).")
+
+@celery_app.task(name="run_brand_maintenance", bind=True)
+def run_brand_maintenance(self, brand_id: int):
+    """
+    Bảo trì một brand (ngoài luồng request của người dùng):
+    1. Churn / chỉ số hoạt động trôi theo ngày -> đưa hôm qua & hôm nay vào sổ tính lại rồi drain.
+    2. Phân hạng lại khách hàng (một câu UPDATE).
+    3. Làm mới dữ liệu tuần / tháng (tầng cache kpi_daily mà biểu đồ theo tuần/tháng gộp lại).
+    Làm nóng cache request được drain tự lên lịch sau khi tính lại.
+    """
+    return run_with_brand_slot(self, BULK_QUEUE, brand_id, _run_brand_maintenance, self, brand_id)
+
+def _run_brand_maintenance(task, brand_id: int):
+    today = warmup_service.local_today()
+
+    with get_db_session() as db:
+        data_service.mark_days_dirty(db, brand_id, [today - timedelta(days=1), today], reason="nightly")
+        reranked = crud.customer.reclassify_ranks(db, brand_id)
+        db.commit()
+        replica.pin_brand_to_primary(db, brand_id)
+
+    recalc = _run_with_recalc_lock(task, brand_id, _drain_brand_recalculation, brand_id) or {}
+
+    # Tuần / tháng hiện tại và kỳ đầy đủ liền trước
+    week_start = today - timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    last_month_end = month_start - timedelta(days=1)
+    rollup_ranges = [
+        (week_start, today),
+        (week_start - timedelta(days=7), week_start - timedelta(days=1)),
+        (month_start, today),
+        (last_month_end.replace(day=1), last_month_end),
+    ]
+    with get_db_session() as db:
+        for range_start, range_end in rollup_ranges:
+            dashboard_service.get_daily_kpis_for_range(
+                db, brand_id, range_start, range_end, None, cache_ttl=WARM_CACHE_TTL_SECONDS
+            )
+
+    print(f"WORKER: Bảo trì brand {brand_id}: {reranked} khách đổi hạng, tính lại {recalc.get('days', 0)} ngày.")
+    return {"reranked": reranked, "recalc": recalc}
+
+@celery_app.task(name="vacuum_hot_tables")
+def vacuum_hot_tables():
+    """
+    Job theo lịch (beat): VACUUM (ANALYZE) các bảng nóng có nhiều dòng thay đổi kể từ lần ANALYZE
+    gần nhất (sau các đợt import lớn), để planner có thống kê mới và bảng không phình.
+    """
+    lock = redis_client.lock("maintenance_vacuum_lock", timeout=3 * 3600, blocking=False)
+    if not lock.acquire():
+        print("WORKER: VACUUM đang chạy ở worker khác, bỏ qua.")
+        return {"vacuumed": []}
+
+    vacuumed = []
+    try:
+        # VACUUM không chạy được trong transaction -> kết nối AUTOCOMMIT riêng
+        with worker_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            targets = _hot_vacuum_targets(conn)
+            rows = conn.execute(
+                text(
+                    "SELECT relname, n_live_tup, n_mod_since_analyze "
+                    "FROM pg_stat_user_tables WHERE relname = ANY(:tables)"
+                ),
+                {"tables": targets}
+            ).all()
+            for table_name, live_rows, changed_rows in rows:
+                threshold = max(VACUUM_MIN_CHANGED_ROWS, int((live_rows or 0) * VACUUM_CHANGED_RATIO))
+                if (changed_rows or 0) < threshold or table_name not in targets:
+                    continue
+                started = time.time()
+                conn.execute(text(f'VACUUM (ANALYZE) "{table_name}"'))
+                vacuumed.append(table_name)
+                print(f"WORKER: VACUUM (ANALYZE) {table_name} ({changed_rows} dòng thay đổi) trong {time.time() - started:.1f}s.")
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+
+    return {"vacuumed": vacuumed}
+
+# ==============================================================================
+# TASK 7: XÓA BRAND CHẠY NỀN (THEO LÔ)
+# ==============================================================================
+@celery_app.task(name="delete_brand", bind=True)
+def delete_brand(self, brand_id: int):
+    """
+    Xóa toàn bộ dữ liệu của brand theo lô (DELETE ... WHERE brand_id) rồi xóa brand, có báo tiến độ.
+    Giữ khóa tính toán lại để không có job tính lại nào ghi vào brand trong lúc xóa.
+    """
+    return run_with_brand_slot(
+        self, BULK_QUEUE, brand_id,
+        _run_with_recalc_lock, self, brand_id, _delete_brand, brand_id
+    )
+
+def _delete_brand(brand_id: int, lock_token: str = None):
+    print(f"WORKER: Bắt đầu xóa brand {brand_id} (lô {BRAND_DELETE_BATCH_SIZE} dòng).")
+    task_queues.update_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id, status="running", error="")
+    try:
+        with get_db_session() as db:
+            total_rows = data_service.count_brand_rows(db, brand_id)
+            task_queues.update_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id, total_rows=total_rows, processed_rows=0)
+            data_service.delete_brand_in_batches(
+                db, brand_id,
+                batch_size=BRAND_DELETE_BATCH_SIZE,
+                on_table=lambda table_name: task_queues.update_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id, current_table=table_name),
+                on_batch=lambda deleted: task_queues.increment_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id, deleted)
+            )
+    except Exception as e:
+        print(f"WORKER DELETE BRAND ERROR: {e}")
+        traceback.print_exc()
+        task_queues.update_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id, status="failed", error=str(e)[:500])
+        raise
+
+    task_queues.update_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id, status="completed", current_table="")
+    print(f"WORKER: Đã xóa xong brand {brand_id} ({total_rows} dòng dữ liệu).")
+    return {"brand_id": brand_id, "deleted_rows": total_rows}
+
+# ==============================================================================
+# TASK 8: NHÂN BẢN BRAND KÈM DỮ LIỆU (INSERT ... SELECT)
+# ==============================================================================
+@celery_app.task(name="clone_brand_data", bind=True)
+def clone_brand_data(self, source_brand_id: int, target_brand_id: int):
+    """
+    Sao chép toàn bộ dữ liệu + số liệu đã tính của brand nguồn sang brand nhân bản (phía server).
+    Giữ khóa tính toán lại của brand đích để không có job tính lại nào chen vào giữa các bảng;
+    brand nguồn được đọc trong một snapshot REPEATABLE READ (xem data_service.clone_brand_data).
+    """
+    return run_with_brand_slot(
+        self, BULK_QUEUE, target_brand_id,
+        _run_with_recalc_lock, self, target_brand_id, _clone_brand_data, source_brand_id, target_brand_id
+    )
+
+def _clone_brand_data(source_brand_id: int, target_brand_id: int, lock_token: str = None):
+    job = task_queues.BRAND_JOB_CLONE
+    print(f"WORKER: Bắt đầu nhân bản dữ liệu brand {source_brand_id} -> {target_brand_id}.")
+    task_queues.update_brand_job_progress(job, target_brand_id, status="running", error="")
+
+    def on_table(table_name: str, copied_rows: int):
+        task_queues.increment_brand_job_progress(job, target_brand_id, copied_rows)
+        task_queues.update_brand_job_progress(job, target_brand_id, current_table=table_name)
+        print(f"WORKER: Nhân bản {table_name}: {copied_rows} dòng.")
+
+    try:
+        with get_db_session() as db:
+            total_rows = data_service.count_brand_rows(db, source_brand_id, data_service.BRAND_CLONE_MODELS)
+            task_queues.update_brand_job_progress(job, target_brand_id, total_rows=total_rows, processed_rows=0)
+            data_service.clone_brand_data(db, source_brand_id, target_brand_id, on_table=on_table)
+    except Exception as e:
+        print(f"WORKER CLONE BRAND ERROR: {e}")
+        traceback.print_exc()
+        task_queues.update_brand_job_progress(job, target_brand_id, status="failed", error=str(e)[:500])
+        raise
+
+    task_queues.update_brand_job_progress(job, target_brand_id, status="completed", current_table="")
+    schedule_cache_warmup(target_brand_id)
+    return {"source_brand_id": source_brand_id, "target_brand_id": target_brand_id, "copied_rows": total_rows}
+
+# ==============================================================================
+# TASK 9: TẠO TRƯỚC PARTITION THEO THÁNG (BEAT)
+# ==============================================================================
+@celery_app.task(name="ensure_future_partitions")
+def ensure_future_partitions():
+    """
+    Job theo lịch (beat): tạo sẵn partition tháng hiện tại + PARTITION_MONTHS_AHEAD tháng tới cho
+    orders / revenues, để dữ liệu mới không rơi vào partition DEFAULT (không được prune).
+    """
+    created = partitioning.ensure_future_partitions(worker_engine)
+    total = sum(len(names) for names in created.values())
+    print(f"WORKER: Kiểm tra partition theo tháng xong, tạo mới {total} partition.")
+    return created
@@ -16,20 +16,20 @@ update_brand_name = brand.update_name
 
 def delete_brand_by_id(db, brand_id: int):
     """
-    Xóa brand và xóa cache liên quan.
+    Xóa brand và xóa cache liên quan (đồng bộ).
+    Xóa theo lô từng bảng con thay vì cascade ORM (không nạp toàn bộ row vào session).
+    API dùng task nền delete_brand (celery_worker) để có tiến độ và không bị timeout.
     """
-    # 1. Xóa trong DB (Cascade sẽ xóa hết các bảng con)
-    deleted_brand = brand.remove(db=db, id=brand_id)
-    
-    # 2. Xóa Cache Redis
+    deleted_brand = brand.get(db, id=brand_id)
     if deleted_brand:
-        clear_brand_cache(brand_id)
+        delete_brand_in_batches(db, brand_id)
         
     return deleted_brand
 
 def clone_brand(db, brand_id: int):
     """
-    Hàm nhân bản Brand (Logic: Copy tên + ' - Copy', scoped theo owner)
+    Hàm nhân bản Brand (Logic: Copy tên + ' - Copy', scoped theo owner).
+    Chỉ tạo brand rỗng; dữ liệu được sao chép bởi task nền clone_brand_data (celery_worker).
     """
     original = brand.get(db, id=brand_id)
     if not original:
@@ -56,6 +56,8 @@ def recalculate_brand_data_sync(db, brand_id: int):
     for d in dates:
         update_daily_stats(db, brand_id, d)
         count += 1
+    refresh_cumulative_stats(db, brand_id)
+    db.commit()
     
     clear_brand_cache(brand_id)
     return {"message": f"Đã tính toán lại dữ liệu cho {count} ngày.", "days_processed": count}
@@ -83,12 +85,16 @@ from services.dashboard_service import (
     get_top_selling_products,
     get_kpis_by_platform,
     get_aggregated_location_distribution,
-    get_brand_details
+    get_brand_details,
+    get_dashboard_bundle,
+    BUNDLE_PANELS
 )
 from services.data_service import (
     update_daily_stats,
     delete_brand_data_in_range,
-    clear_brand_cache
+    delete_brand_in_batches,
+    clear_brand_cache,
+    refresh_cumulative_stats
 )
 
 # Thêm alias cho các hàm mà worker có thể gọi (nếu cần)
@@ -22,7 +22,8 @@ class CRUDBrand(CRUDBase[Brand, BrandCreate, BrandBase]):
     def get_by_slug(self, db: Session, *, slug: str, owner_id: str) -> Optional[Brand]:
         return db.query(self.model).filter(
             self.model.slug == slug,
-            self.model.owner_id == owner_id
+            self.model.owner_id == owner_id,
+            self.model.is_deleting.is_(False)
         ).first()
 
     def get_by_name(self, db: Session, *, name: str, owner_id: str) -> Optional[Brand]:
@@ -1,8 +1,8 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, or_
-from datetime import date
+from sqlalchemy import func, desc, or_, case, update
+from datetime import date, datetime, timedelta
 from collections import defaultdict
-from models import Order, Revenue, Product, Customer
+from models import Order, Product, Customer, OrderFinancial
 from kpi_utils import _classify_order_status, is_success_category
 from vietnam_address_mapping import get_new_province_name
 import schemas
@@ -18,6 +18,21 @@ def is_valid(value):
         return False
     return True
 
+# Phân hạng theo tổng chi tiêu (LTV): (ngưỡng trên, hạng) - vượt ngưỡng cuối là DIAMOND
+CUSTOMER_RANK_THRESHOLDS = [
+    (2000000, "MEMBER"),
+    (10000000, "SILVER"),
+    (20000000, "GOLD"),
+    (50000000, "PLATINUM"),
+]
+TOP_CUSTOMER_RANK = "DIAMOND"
+
+def classify_customer_rank(total_spent: float) -> str:
+    for upper_bound, rank in CUSTOMER_RANK_THRESHOLDS:
+        if total_spent < upper_bound:
+            return rank
+    return TOP_CUSTOMER_RANK
+
 class CRUDCustomer:
     """
     CRUDCustomer (Refactored): Tối ưu hóa logic tính toán, loại bỏ code lặp lại.
@@ -149,19 +164,29 @@ class CRUDCustomer:
             if data["success_orders"] > 0:
                 customer.aov = data["total_spent"] / data["success_orders"]
 
-            # Phân hạng (Rank) - Logic tính toán inline (Thay vì gọi helper thiếu)
-            current_spent = customer.total_spent or 0.0
-            rank = "MEMBER"
-            if current_spent < 2000000: rank = "MEMBER"
-            elif current_spent < 10000000: rank = "SILVER"
-            elif current_spent < 20000000: rank = "GOLD"
-            elif current_spent < 50000000: rank = "PLATINUM"
-            else: rank = "DIAMOND"
-            
-            customer.rank = rank
+            # Phân hạng (Rank)
+            customer.rank = classify_customer_rank(customer.total_spent or 0.0)
 
         db.flush() # Đẩy thay đổi xuống nhưng chưa commit hoàn toàn
 
+    def reclassify_ranks(self, db: Session, brand_id: int) -> int:
+        """
+        Phân hạng lại toàn bộ khách của brand bằng một câu UPDATE (cùng ngưỡng với upsert),
+        chỉ ghi những dòng có hạng thay đổi. Trả về số dòng được cập nhật. Không commit.
+        """
+        spent = func.coalesce(Customer.total_spent, 0.0)
+        new_rank = case(
+            *[(spent < upper_bound, rank) for upper_bound, rank in CUSTOMER_RANK_THRESHOLDS],
+            else_=TOP_CUSTOMER_RANK
+        )
+        result = db.execute(
+            update(Customer)
+            .where(Customer.brand_id == brand_id, Customer.rank.is_distinct_from(new_rank))
+            .values(rank=new_rank)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount or 0
+
     def _extract_location_data(self, details: dict):
         """Helper: Trích xuất và chuẩn hóa Province/District từ JSON details."""
         if not details or not isinstance(details, dict):
@@ -180,7 +205,8 @@ class CRUDCustomer:
 
     def _get_revenue_map(self, db: Session, brand_id: int, order_codes: list):
         """
-        Helper: Lấy Net Revenue, Total Fees, GMV và Refund Status từ bảng Revenue.
+        Helper: Lấy Net Revenue, Total Fees, GMV và Refund Status từ bảng order_financials
+        (đã cộng sẵn theo đơn lúc import doanh thu).
         Trả về:
             - revenue_map: Dict[order_code, net_revenue]
             - fees_map: Dict[order_code, total_fees]
@@ -196,34 +222,30 @@ class CRUDCustomer:
         if not order_codes:
             return revenue_map, fees_map, gmv_map, refunded_codes, refund_tracking_map
 
-        chunk_size = 1000
-        for i in range(0, len(order_codes), chunk_size):
-            chunk = order_codes[i:i + chunk_size]
-            rev_records = db.query(
-                Revenue.order_code, 
-                Revenue.net_revenue,
-                Revenue.total_fees,
-                Revenue.gmv,
-                Revenue.refund,
-                Revenue.order_refund  
-            ).filter(
-                Revenue.brand_id == brand_id, 
-                Revenue.order_code.in_(chunk)
-            ).all()
-            
-            for code, net_rev, fees, gmv, refund, order_refund in rev_records:
-                if net_rev:
-                    revenue_map[code] += net_rev
-                if fees:
-                    fees_map[code] += fees
-                if gmv:
-                    gmv_map[code] += gmv
-                if (refund or 0) < -0.1:
-                    refunded_codes.add(code)
-                
-                # Lưu mã hoàn hàng vào map (nếu có)
-                if order_refund:
-                    refund_tracking_map[code] = order_refund
+        fin_records = db.query(
+            OrderFinancial.order_code,
+            OrderFinancial.net_revenue,
+            OrderFinancial.total_fees,
+            OrderFinancial.gmv,
+            OrderFinancial.is_refunded,
+            OrderFinancial.refund_tracking_code
+        ).filter(
+            OrderFinancial.brand_id == brand_id,
+            OrderFinancial.order_code.in_(order_codes)
+        ).all()
+
+        for code, net_rev, fees, gmv, is_refunded, refund_tracking_code in fin_records:
+            if net_rev:
+                revenue_map[code] = net_rev
+            if fees:
+                fees_map[code] = fees
+            if gmv:
+                gmv_map[code] = gmv
+            if is_refunded:
+                refunded_codes.add(code)
+            # Lưu mã hoàn hàng vào map (nếu có)
+            if refund_tracking_code:
+                refund_tracking_map[code] = refund_tracking_code
 
         return revenue_map, fees_map, gmv_map, refunded_codes, refund_tracking_map
 
@@ -307,8 +329,9 @@ class CRUDCustomer:
         # 1. Query Orders
         filters = [
             Order.brand_id == brand_id,
-            func.date(Order.order_date) >= start_date,
-            func.date(Order.order_date) <= end_date,
+            # Khoảng nửa mở trên chính cột order_date -> dùng index và prune partition theo tháng
+            Order.order_date >= datetime.combine(start_date, datetime.min.time()),
+            Order.order_date < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
             Order.username.isnot(None)
         ]
         if source_list and 'all' not in source_list:
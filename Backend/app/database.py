@@ -18,4 +18,19 @@ engine = create_engine(
     pool_size=20,       # Tăng số lượng kết nối thường trực (mặc định là 5)
     max_overflow=10,    # Số kết nối được phép tràn khi cao điểm
     pool_pre_ping=True  # Kiểm tra kết nối sống trước khi dùng
-)
\ No newline at end of file
+)
+
+# Read replica (tùy chọn) cho các endpoint chỉ đọc - định tuyến theo brand trong replica.py
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL") or None
+replica_engine = None
+ReplicaSessionLocal = None
+if REPLICA_DATABASE_URL:
+    replica_engine = create_engine(
+        REPLICA_DATABASE_URL,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        # Transaction luôn chỉ đọc (replica đứng thay khi chạy local cũng không bị ghi nhầm)
+        connect_args={"options": "-c default_transaction_read_only=on"}
+    )
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
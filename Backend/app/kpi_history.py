@@ -0,0 +1,215 @@
+# FILE: Backend/app/kpi_history.py
+
+"""
+Snapshot lịch sử khách hàng cho việc tính toán lại song song theo khối ngày (shard).
+
+Các chỉ số khách hàng của một ngày (mới/cũ, chu kỳ mua lại, churn, tần suất, phân khúc LTV)
+phụ thuộc vào toàn bộ lịch sử đơn hàng TRƯỚC ngày đó. Thay vì mỗi ngày chạy 5 query lịch sử,
+một shard [start_date, end_date] nạp trước lịch sử một lần (4 query) rồi trả lời các câu hỏi
+theo từng ngày trong bộ nhớ - nhờ vậy các shard độc lập với nhau và có thể chạy song song.
+
+Kết quả phải khớp với các query tương ứng trong kpi_utils (cùng bộ lọc, cùng mốc thời gian).
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import models
+from kpi_utils import get_active_order_filters
+
+CHURN_DAYS = 90
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+def _day_end(day: date) -> datetime:
+    return datetime.combine(day, datetime.max.time())
+
+class CustomerHistorySnapshot:
+    """
+    Lịch sử khách hàng của MỘT brand, đủ để trả lời các câu hỏi cho mọi ngày trong [start_date, end_date]:
+    - first_order: ngày đặt đơn đầu tiên (mọi trạng thái) của từng khách.
+    - Đơn active (get_active_order_filters) trước cửa sổ: gộp sẵn (số đơn không hoàn, tổng sku_price, đơn gần nhất).
+    - Đơn active trong cửa sổ [start_date - CHURN_DAYS, end_date]: giữ từng đơn theo thời gian.
+    - Ngày active đầu tiên theo (khách, nguồn) để đếm tổng khách từng mua cho churn.
+    """
+
+    def __init__(self, brand_id: int, start_date: date, end_date: date):
+        self.brand_id = brand_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.window_start = _day_start(start_date - timedelta(days=CHURN_DAYS))
+
+        self.first_order: Dict[str, datetime] = {}
+        # Gộp sẵn phần lịch sử active trước window_start
+        self.base_success_count: Dict[str, int] = {}
+        self.base_ltv: Dict[str, float] = {}
+        self.base_last_active: Dict[str, datetime] = {}
+        # Ngày active đầu tiên (đã sắp xếp) theo phạm vi nguồn: None = tất cả nguồn
+        self.first_active_sorted: Dict[Optional[str], List[datetime]] = {}
+        # Đơn active trong cửa sổ, theo thời gian
+        self.window_times: List[datetime] = []
+        self.window_events: List[tuple] = []  # (order_date, username, source)
+        # Theo từng khách: thời gian + tổng tích lũy (LTV, số đơn không hoàn) để bisect
+        self.user_times: Dict[str, List[datetime]] = {}
+        self.user_ltv_prefix: Dict[str, List[float]] = {}
+        self.user_success_prefix: Dict[str, List[int]] = {}
+
+        self._churn_cache: Dict[tuple, float] = {}
+
+    # ------------------------------------------------------------------
+    # NẠP DỮ LIỆU
+    # ------------------------------------------------------------------
+    @classmethod
+    def build(cls, db: Session, brand_id: int, start_date: date, end_date: date) -> "CustomerHistorySnapshot":
+        snapshot = cls(brand_id, start_date, end_date)
+        window_end = _day_end(end_date)
+        Order = models.Order
+        base_filters = [Order.brand_id == brand_id, Order.username.isnot(None), Order.order_date.isnot(None)]
+        active = get_active_order_filters(Order)
+        not_refund_like = ~Order.status.ilike('%hoan%')
+
+        # 1. Đơn đầu tiên (mọi trạng thái)
+        for username, first_dt in db.query(Order.username, func.min(Order.order_date)).filter(
+            *base_filters, Order.order_date <= window_end
+        ).group_by(Order.username):
+            snapshot.first_order[username] = first_dt
+
+        # 2. Lịch sử active trước cửa sổ (gộp sẵn)
+        for username, success_count, ltv, last_dt in db.query(
+            Order.username,
+            func.count(Order.id).filter(not_refund_like),
+            func.sum(Order.sku_price),
+            func.max(Order.order_date)
+        ).filter(*base_filters, active, Order.order_date < snapshot.window_start).group_by(Order.username):
+            snapshot.base_success_count[username] = int(success_count or 0)
+            snapshot.base_ltv[username] = float(ltv or 0)
+            snapshot.base_last_active[username] = last_dt
+
+        # 3. Ngày active đầu tiên theo (khách, nguồn)
+        first_all: Dict[str, datetime] = {}
+        by_source: Dict[str, List[datetime]] = defaultdict(list)
+        for username, source, first_dt in db.query(
+            Order.username, Order.source, func.min(Order.order_date)
+        ).filter(*base_filters, active, Order.order_date <= window_end).group_by(Order.username, Order.source):
+            by_source[source].append(first_dt)
+            if username not in first_all or first_dt < first_all[username]:
+                first_all[username] = first_dt
+        snapshot.first_active_sorted[None] = sorted(first_all.values())
+        for source, values in by_source.items():
+            snapshot.first_active_sorted[source] = sorted(values)
+
+        # 4. Từng đơn active trong cửa sổ
+        per_user = defaultdict(list)
+        for username, source, order_dt, sku_price, status_refund_like in db.query(
+            Order.username, Order.source, Order.order_date, Order.sku_price,
+            Order.status.ilike('%hoan%')
+        ).filter(
+            *base_filters, active,
+            Order.order_date >= snapshot.window_start,
+            Order.order_date <= window_end
+        ).order_by(Order.order_date):
+            snapshot.window_times.append(order_dt)
+            snapshot.window_events.append((order_dt, username, source))
+            # ilike trên status NULL trả về NULL -> query gốc cũng loại đơn đó khỏi bộ đếm
+            per_user[username].append((order_dt, float(sku_price or 0), status_refund_like is False))
+
+        for username, events in per_user.items():
+            times, ltv_prefix, success_prefix = [], [], []
+            ltv_total, success_total = 0.0, 0
+            for order_dt, sku_price, counts_as_success in events:
+                ltv_total += sku_price
+                success_total += 1 if counts_as_success else 0
+                times.append(order_dt)
+                ltv_prefix.append(ltv_total)
+                success_prefix.append(success_total)
+            snapshot.user_times[username] = times
+            snapshot.user_ltv_prefix[username] = ltv_prefix
+            snapshot.user_success_prefix[username] = success_prefix
+
+        return snapshot
+
+    def covers(self, day: date) -> bool:
+        return self.start_date <= day <= self.end_date
+
+    # ------------------------------------------------------------------
+    # TRUY VẤN THEO NGÀY (tương đương các query trong kpi_utils)
+    # ------------------------------------------------------------------
+    def existing_customers(self, usernames: Iterable[str], day: date) -> Set[str]:
+        """Khách đã từng đặt đơn (mọi trạng thái) trước ngày `day`."""
+        cutoff = _day_start(day)
+        return {u for u in usernames if u in self.first_order and self.first_order[u] < cutoff}
+
+    def last_active_before(self, usernames: Iterable[str], day: date) -> Dict[str, datetime]:
+        """Đơn active gần nhất trước ngày `day` của từng khách."""
+        cutoff = _day_start(day)
+        result = {}
+        for username in usernames:
+            times = self.user_times.get(username)
+            if times:
+                idx = bisect_left(times, cutoff)
+                if idx > 0:
+                    result[username] = times[idx - 1]
+                    continue
+            if username in self.base_last_active:
+                result[username] = self.base_last_active[username]
+        return result
+
+    def past_success_counts(self, usernames: Iterable[str], day: date) -> Dict[str, int]:
+        """Số đơn active (không chứa 'hoan') trước ngày `day` của từng khách."""
+        cutoff = _day_start(day)
+        result = {}
+        for username in usernames:
+            count = self.base_success_count.get(username, 0)
+            times = self.user_times.get(username)
+            if times:
+                idx = bisect_left(times, cutoff)
+                if idx > 0:
+                    count += self.user_success_prefix[username][idx - 1]
+            if count:
+                result[username] = count
+        return result
+
+    def lifetime_values(self, usernames: Iterable[str], day: date) -> Dict[str, float]:
+        """Tổng sku_price của các đơn active tính đến hết ngày `day`."""
+        cutoff = _day_end(day)
+        result = {}
+        for username in usernames:
+            found = username in self.base_ltv
+            ltv = self.base_ltv.get(username, 0.0)
+            times = self.user_times.get(username)
+            if times:
+                idx = bisect_right(times, cutoff)
+                if idx > 0:
+                    ltv += self.user_ltv_prefix[username][idx - 1]
+                    found = True
+            if found:
+                result[username] = ltv
+        return result
+
+    def churn_rate(self, day: date, source: Optional[str] = None, churn_days: int = CHURN_DAYS) -> float:
+        """Tỷ lệ khách từng mua nhưng không có đơn active trong `churn_days` ngày gần nhất (%)."""
+        cache_key = (day, source, churn_days)
+        if cache_key in self._churn_cache:
+            return self._churn_cache[cache_key]
+
+        end_dt = _day_end(day)
+        total_active = bisect_left(self.first_active_sorted.get(source, []), end_dt)
+        rate = 0.0
+        if total_active:
+            lo = bisect_left(self.window_times, _day_start(day - timedelta(days=churn_days)))
+            hi = bisect_left(self.window_times, end_dt)
+            recent = {
+                username for _, username, event_source in self.window_events[lo:hi]
+                if source is None or event_source == source
+            }
+            churned = max(total_active - len(recent), 0)
+            rate = (churned / total_active) * 100
+
+        self._churn_cache[cache_key] = rate
+        return rate
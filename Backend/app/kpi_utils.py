@@ -407,14 +407,17 @@ def aggregate_data_points(data_list: List[Dict[str, Any]]) -> Dict[str, Any]:
 def _calculate_customer_segment_distribution(
     orders: List[models.Order], 
     date_to_calculate: date, 
-    db_session: Session
+    db_session: Session,
+    brand_id: int = None,
+    history=None
 ) -> List[Dict]:
     """
     Phân loại khách hàng mua trong ngày (VIP, Tiềm năng, Phổ thông)
     dựa trên TỔNG CHI TIÊU TÍCH LŨY (LTV) của họ tính đến thời điểm đó.
     Sử dụng phương pháp Percentile (20/30/50) trên nhóm khách hàng này.
+    history: CustomerHistorySnapshot (kpi_history) - nếu có thì không query DB.
     """
-    if not orders or not db_session: return []
+    if not orders or not (db_session or history): return []
     
     # 1. Lấy danh sách khách hàng mua trong ngày
     target_usernames = list({o.username for o in orders if o.username})
@@ -422,21 +425,27 @@ def _calculate_customer_segment_distribution(
 
     try:
         # 2. Tính LTV (Tổng chi tiêu tích lũy) của những khách này
-        ltv_query = db_session.query(
-            models.Order.username,
-            func.sum(models.Order.sku_price)
-        ).filter(
-            models.Order.username.in_(target_usernames),
-            models.Order.order_date <= datetime.combine(date_to_calculate, datetime.max.time()),
-            # Chỉ tính đơn thành công? 
-            # Thường segmentation tính trên đơn thành công.
-            # Tuy nhiên, nếu lọc ở đây sẽ phức tạp vì text search.
-            # Tạm thời tính ALL đơn hoặc reuse logic status keywords.
-            # Để đơn giản và nhanh cho worker, ta lọc đơn status thành công cơ bản.
-             get_active_order_filters(models.Order)
-        ).group_by(models.Order.username).all()
-        
-        user_ltv = {row[0]: float(row[1] or 0) for row in ltv_query}
+        if history:
+            user_ltv = history.lifetime_values(target_usernames, date_to_calculate)
+        else:
+            ltv_query = db_session.query(
+                models.Order.username,
+                func.sum(models.Order.sku_price)
+            ).filter(
+                models.Order.username.in_(target_usernames),
+                models.Order.order_date <= datetime.combine(date_to_calculate, datetime.max.time()),
+                # Chỉ tính đơn thành công? 
+                # Thường segmentation tính trên đơn thành công.
+                # Tuy nhiên, nếu lọc ở đây sẽ phức tạp vì text search.
+                # Tạm thời tính ALL đơn hoặc reuse logic status keywords.
+                # Để đơn giản và nhanh cho worker, ta lọc đơn status thành công cơ bản.
+                 get_active_order_filters(models.Order)
+            )
+            if brand_id:
+                ltv_query = ltv_query.filter(models.Order.brand_id == brand_id)
+            ltv_query = ltv_query.group_by(models.Order.username).all()
+            
+            user_ltv = {row[0]: float(row[1] or 0) for row in ltv_query}
         
         # Những user không tìm thấy (có thể do order hiện tại chưa commit?), gán bằng đơn hiện tại
         # (Lưu ý: orders input chưa chắc đã commit vào DB nếu đang trong transaction của worker)
@@ -617,23 +626,28 @@ def _calculate_hourly_breakdown(orders: List[models.Order]) -> Dict[str, int]:
     result.update(hourly_counts)
     return result
 
-def _calculate_top_products(orders: List[models.Order], limit=10) -> List[Dict]:
+def _get_product_names(db: Session, brand_id: int, skus: Set[str]) -> Dict[str, str]:
+    """Map SKU -> tên sản phẩm (bảng products) cho các SKU xuất hiện trong ngày."""
+    if not db or not brand_id or not skus:
+        return {}
+    rows = db.query(models.Product.sku, models.Product.name).filter(
+        models.Product.brand_id == brand_id,
+        models.Product.sku.in_(list(skus)),
+        models.Product.name.isnot(None)
+    ).all()
+    return {sku: name for sku, name in rows if name}
+
+def _calculate_top_products(orders: List[models.Order], limit=10, product_names: Dict[str, str] = None) -> List[Dict]:
+    # order.items: dòng sản phẩm trong bảng order_items (caller nạp kèm bằng selectinload)
+    product_names = product_names or {}
     product_stats = defaultdict(lambda: {"quantity": 0, "revenue": 0, "name": ""})
     for order in orders:
-        if order.details and isinstance(order.details.get('items'), list):
-            for item in order.details['items']:
-                sku = item.get('sku')
-                if sku:
-                    try:
-                        qty = int(float(item.get('quantity', 0) or 0))
-                    except (ValueError, TypeError):
-                        qty = 0
-                    
-                    price = float(item.get('price', 0) or 0)
-                    
-                    product_stats[sku]["quantity"] += qty
-                    product_stats[sku]["revenue"] += qty * price
-                    product_stats[sku]["name"] = item.get('name', sku)
+        for item in order.items:
+            sku = item.sku
+            if sku:
+                product_stats[sku]["quantity"] += item.quantity or 0
+                product_stats[sku]["revenue"] += item.sku_price or 0
+                product_stats[sku]["name"] = product_names.get(sku, sku)
     
     sorted_products = sorted(product_stats.items(), key=lambda x: x[1]['quantity'], reverse=True)[:limit]
     return [{"sku": sku, "name": data["name"], "quantity": data["quantity"], "revenue": data["revenue"]} for sku, data in sorted_products]
@@ -674,7 +688,8 @@ def merge_product_breakdown_structure(list_of_breakdowns: List[Dict]) -> Dict[st
 def _calculate_bad_product_breakdown(
     orders: List[models.Order], 
     order_has_refund_map: Dict[str, bool],
-    limit=10
+    limit=10,
+    product_names: Dict[str, str] = None
 ) -> Dict[str, List[Dict]]:
     """
     Tính Top sản phẩm cho 3 nhóm riêng biệt: Hủy, Bom, Hoàn tiền.
@@ -695,22 +710,14 @@ def _calculate_bad_product_breakdown(
             # 2. Chỉ quan tâm 3 loại xấu này
             if cat not in baskets: continue
             
-            # 3. Lấy sản phẩm và cộng dồn vào giỏ tương ứng
-            if order.details and isinstance(order.details.get('items'), list):
-                for item in order.details['items']:
-                    sku = item.get('sku')
-                    if sku:
-                        try:
-                            qty = int(float(item.get('quantity', 0) or 0)) # Safe convert string/float/None -> int
-                        except:
-                            qty = 0
-                            
-                        name = item.get('name', sku)
-                        
-                        baskets[cat][sku]["qty"] += qty
-                        # Cập nhật tên nếu chưa có
-                        if baskets[cat][sku]["name"] == "Unknown" and name:
-                            baskets[cat][sku]["name"] = name
+            # 3. Lấy sản phẩm (order_items) và cộng dồn vào giỏ tương ứng
+            for item in order.items:
+                sku = item.sku
+                if sku:
+                    baskets[cat][sku]["qty"] += item.quantity or 0
+                    # Cập nhật tên nếu chưa có
+                    if baskets[cat][sku]["name"] == "Unknown":
+                        baskets[cat][sku]["name"] = (product_names or {}).get(sku, sku)
 
         # 4. Convert sang list và sort
         final_result = {}
@@ -800,9 +807,9 @@ def _calculate_location_distribution(
     results.sort(key=lambda x: x['orders'], reverse=True)
     return results
 
-def _calculate_customer_retention(orders: List[models.Order], current_date: date, db_session: Session, gmv_map: Dict[str, float] = None) -> Dict:
+def _calculate_customer_retention(orders: List[models.Order], current_date: date, db_session: Session, gmv_map: Dict[str, float] = None, brand_id: int = None, history=None) -> Dict:
     stats = {"new_customers": 0, "returning_customers": 0, "new_customer_revenue": 0.0, "returning_customer_revenue": 0.0}
-    if not orders or not db_session: return stats
+    if not orders or not (db_session or history): return stats
     usernames_today = {o.username for o in orders if o.username}
     if not usernames_today: return stats
     
@@ -810,11 +817,16 @@ def _calculate_customer_retention(orders: List[models.Order], current_date: date
     gmv_lookup = gmv_map or {}
 
     try:
-        existing_customers_query = db_session.query(models.Order.username).filter(
-            models.Order.username.in_(usernames_today),
-            models.Order.order_date < datetime.combine(current_date, datetime.min.time())
-        ).distinct()
-        existing_usernames = {row[0] for row in existing_customers_query.all()}
+        if history:
+            existing_usernames = history.existing_customers(usernames_today, current_date)
+        else:
+            existing_customers_query = db_session.query(models.Order.username).filter(
+                models.Order.username.in_(usernames_today),
+                models.Order.order_date < datetime.combine(current_date, datetime.min.time())
+            )
+            if brand_id:
+                existing_customers_query = existing_customers_query.filter(models.Order.brand_id == brand_id)
+            existing_usernames = {row[0] for row in existing_customers_query.distinct().all()}
         counted_new_users = set(); counted_returning_users = set()
         for order in orders:
             if not order.username: continue
@@ -856,13 +868,15 @@ def _calculate_payment_method_breakdown(orders: List[models.Order]) -> Dict[str,
 def _calculate_repurchase_cycle(
     orders: List[models.Order], 
     date_to_calculate: date, 
-    db_session: Session
+    db_session: Session,
+    brand_id: int = None,
+    history=None
 ) -> float:
     """
     Tính chu kỳ mua lại trung bình (Average Repurchase Cycle) trong ngày.
     Chỉ tính trên các đơn hàng THÀNH CÔNG của KHÁCH QUAY LẠI.
     """
-    if not orders or not db_session: return 0.0
+    if not orders or not (db_session or history): return 0.0
 
     # 1. Lọc ra các đơn thành công trong ngày
     # Reuse logic lọc cơ bản để tránh phụ thuộc phức tạp
@@ -881,17 +895,23 @@ def _calculate_repurchase_cycle(
     # 2. Tìm ngày mua gần nhất trước đó của các user này
     # Query: SELECT username, MAX(order_date) FROM orders WHERE username IN (...) AND date < current_date GROUP BY username
     try:
-        prev_orders_query = db_session.query(
-            models.Order.username,
-            func.max(models.Order.order_date)
-        ).filter(
-            models.Order.username.in_(target_usernames),
-            models.Order.order_date < datetime.combine(date_to_calculate, datetime.min.time()),
-            # Filter đơn thành công quá khứ
-            get_active_order_filters(models.Order)
-        ).group_by(models.Order.username).all()
-        
-        prev_date_map = {row[0]: row[1] for row in prev_orders_query}
+        if history:
+            prev_date_map = history.last_active_before(target_usernames, date_to_calculate)
+        else:
+            prev_orders_query = db_session.query(
+                models.Order.username,
+                func.max(models.Order.order_date)
+            ).filter(
+                models.Order.username.in_(target_usernames),
+                models.Order.order_date < datetime.combine(date_to_calculate, datetime.min.time()),
+                # Filter đơn thành công quá khứ
+                get_active_order_filters(models.Order)
+            )
+            if brand_id:
+                prev_orders_query = prev_orders_query.filter(models.Order.brand_id == brand_id)
+            prev_orders_query = prev_orders_query.group_by(models.Order.username).all()
+            
+            prev_date_map = {row[0]: row[1] for row in prev_orders_query}
         
         cycles = []
         for order in success_orders:
@@ -918,7 +938,8 @@ def _calculate_churn_rate(
     db_session: Session,
     brand_id: int,
     source: str = None,
-    churn_days: int = 90
+    churn_days: int = 90,
+    history=None
 ) -> float:
     """
     Tính tỷ lệ rời bỏ (Churn Rate).
@@ -927,6 +948,8 @@ def _calculate_churn_rate(
     
     Cập nhật: Hỗ trợ lọc theo brand_id và source.
     """
+    if history:
+        return history.churn_rate(date_to_calculate, source, churn_days)
     if not db_session or not brand_id: return 0.0
     
     try:
@@ -969,6 +992,107 @@ def _calculate_churn_rate(
         print(f"Error calculating churn rate: {e}")
         return 0.0
 
+def _calculate_frequency_distribution(
+    target_orders: List[models.Order],
+    order_has_refund: Dict[str, bool],
+    date_to_calculate: date,
+    db_session: Session,
+    brand_id: int = None,
+    history=None
+) -> Dict[str, int]:
+    """
+    Phân bổ đơn thành công trong ngày theo thứ tự mua của khách (đơn thứ 1, 2, 3...).
+    order_has_refund: map order_code -> True cho đơn hoàn tiền (xem calculate_daily_kpis).
+    """
+    try:
+        # 1. Lọc đơn thành công trong ngày (dựa vào map order_has_refund)
+        success_orders_today = [
+            o for o in target_orders 
+            if _classify_order_status(o, order_has_refund.get(o.order_code, False)) == 'completed' 
+            and o.username
+        ]
+        
+        if success_orders_today:
+            # Sắp xếp theo thời gian để xác định thứ tự trong ngày
+            success_orders_today.sort(key=lambda x: x.order_date or getattr(x, 'id', 0))
+            
+            target_usernames = {o.username for o in success_orders_today}
+            
+            # 2. Query số lượng đơn thành công trong QUÁ KHỨ (Trước ngày tính toán)
+            # Sử dụng text search đơn giản cho status để tối ưu
+            if history:
+                past_counts_map = history.past_success_counts(target_usernames, date_to_calculate)
+            else:
+                past_counts_query = db_session.query(
+                    models.Order.username, 
+                    func.count(models.Order.id)
+                ).filter(
+                    models.Order.username.in_(target_usernames),
+                    models.Order.order_date < datetime.combine(date_to_calculate, datetime.min.time()),
+                    # Filter đơn thành công (Không phải Hủy/Bom/Hoàn/Fail)
+                    get_active_order_filters(models.Order),
+                    ~models.Order.status.ilike('%hoan%')
+                )
+                if brand_id:
+                    past_counts_query = past_counts_query.filter(models.Order.brand_id == brand_id)
+                past_counts_map = {r[0]: r[1] for r in past_counts_query.group_by(models.Order.username).all()}
+            
+            freq_dist = defaultdict(int)
+            current_day_counts = defaultdict(int) 
+            
+            for order in success_orders_today:
+                user = order.username
+                past_count = past_counts_map.get(user, 0)
+                
+                # Thứ tự mua hàng = Đã mua quá khứ + Đã mua trước đó trong ngày + 1 (đơn hiện tại)
+                nth_purchase = past_count + current_day_counts[user] + 1
+                
+                freq_dist[str(nth_purchase)] += 1
+                current_day_counts[user] += 1
+                
+            return dict(freq_dist)
+        else:
+            return {}
+    except Exception as e:
+        print(f"Error calculating frequency_distribution: {e}")
+        return {}
+
+def _refund_map_from_financials(order_financials: List[models.OrderFinancial]) -> Dict[str, bool]:
+    """Đơn hoàn tiền theo order_financials (đã cộng sẵn theo đơn): order_code -> True."""
+    return {
+        f.order_code: True
+        for f in order_financials
+        if (f.refund_total or 0) < -0.1 and (f.net_revenue or 0) < -0.1
+    }
+
+def calculate_order_distributions(
+    orders: List[models.Order],
+    order_financials: List[models.OrderFinancial],
+    date_to_calculate: date,
+    db_session: Session,
+    brand_id: int = None,
+    history=None
+) -> dict:
+    """
+    Các trường JSONB theo đơn / khách không cộng được giữa các nguồn (top sản phẩm, tần suất mua,
+    phân khúc khách): tính trên toàn bộ đơn của ngày, cùng công thức với calculate_daily_kpis.
+    Dùng khi DailyStat được gộp từ DailyAnalytics (data_service.rebuild_daily_stat_from_analytics).
+    """
+    if history is not None and not history.covers(date_to_calculate):
+        history = None
+    unique_skus = {item.sku for o in orders for item in o.items if item.sku}
+    product_names = _get_product_names(db_session, brand_id, unique_skus)
+    order_has_refund = _refund_map_from_financials(order_financials)
+    return {
+        "top_products": _calculate_top_products(orders, product_names=product_names),
+        "frequency_distribution": _calculate_frequency_distribution(
+            orders, order_has_refund, date_to_calculate, db_session, brand_id=brand_id, history=history
+        ),
+        "customer_segment_distribution": _calculate_customer_segment_distribution(
+            orders, date_to_calculate, db_session, brand_id=brand_id, history=history
+        ),
+    }
+
 def calculate_daily_kpis(
     orders_in_day: List[models.Order], 
     revenues_in_day: List[models.Revenue],
@@ -977,13 +1101,21 @@ def calculate_daily_kpis(
     date_to_calculate: date,
     db_session: Session = None,
     brand_id: int = None,
-    source: str = None
+    source: str = None,
+    history=None,
+    order_financials: List[models.OrderFinancial] = None
 ) -> dict:
     """
     Tính toán KPI cho MỘT ngày. 
     Hợp nhất: Sử dụng hàm calculate_derived_metrics để tính tỷ lệ.
+    history: CustomerHistorySnapshot (kpi_history) của shard chứa ngày này - thay cho các query lịch sử.
+    order_financials: tổng hợp tài chính theo đơn (order_financials) - nếu có thì dùng thay cho việc
+                      cộng lại từng dòng revenues; các dòng revenues chỉ còn dùng cho nhật ký tài chính.
     """
     try:
+        if history is not None and not history.covers(date_to_calculate):
+            history = None
+
         # Nếu không truyền brand_id, cố gắng lấy từ orders (Fallback)
         if not brand_id and orders_in_day:
             brand_id = orders_in_day[0].brand_id
@@ -1001,18 +1133,24 @@ def calculate_daily_kpis(
         counters = {"completed": 0, "cancelled": 0, "bomb": 0, "refunded": 0}
         unique_skus = set()
 
-        # Chuẩn bị Map cho Refund (Do phụ thuộc bảng Revenues, không phải Orders)
-        rev_summary = defaultdict(lambda: {"net": 0.0, "refund": 0.0})
-        for r in valid_revenues:
-            rev_summary[r.order_code]["net"] += (r.net_revenue or 0)
-            rev_summary[r.order_code]["refund"] += (r.refund or 0)
-
-        # Logic xác định đơn hoàn tiền (Refunded)
-        order_has_refund = {
-            code: True 
-            for code, val in rev_summary.items() 
-            if val["refund"] < -0.1 and val["net"] < -0.1 
-        }
+        if order_financials is not None:
+            # Số liệu đã cộng sẵn theo đơn -> mỗi đơn một dòng (cùng thuộc tính gmv / net_revenue / total_fees)
+            money_rows = [f for f in order_financials if f.order_code in creation_date_order_codes]
+            order_has_refund = _refund_map_from_financials(money_rows)
+        else:
+            money_rows = valid_revenues
+            # Chuẩn bị Map cho Refund (Do phụ thuộc bảng Revenues, không phải Orders)
+            rev_summary = defaultdict(lambda: {"net": 0.0, "refund": 0.0})
+            for r in valid_revenues:
+                rev_summary[r.order_code]["net"] += (r.net_revenue or 0)
+                rev_summary[r.order_code]["refund"] += (r.refund or 0)
+
+            # Logic xác định đơn hoàn tiền (Refunded)
+            order_has_refund = {
+                code: True 
+                for code, val in rev_summary.items() 
+                if val["refund"] < -0.1 and val["net"] < -0.1 
+            }
 
         # VÒNG LẶP CHÍNH (Duyệt Orders 1 lần duy nhất)
         for o in target_orders:
@@ -1021,9 +1159,7 @@ def calculate_daily_kpis(
             sums["total_quantity_sold"] += (o.total_quantity or 0)
             
             # 2.2. Lấy Unique SKUs
-            if o.details and isinstance(o.details.get('items'), list):
-                for item in o.details['items']:
-                    if item.get('sku'): unique_skus.add(item['sku'])
+            unique_skus.update(item.sku for item in o.items if item.sku)
 
             # 2.3. Phân loại trạng thái (Status Classification)
             cat = _classify_order_status(o, order_has_refund.get(o.order_code, False))
@@ -1065,9 +1201,9 @@ def calculate_daily_kpis(
             "_count_shipping": sums["ship_count"],
 
             # Từ bảng Revenues (Aggregated)
-            "gmv": sum((r.gmv or 0) for r in valid_revenues),
-            "net_revenue": sum(r.net_revenue for r in valid_revenues),
-            "execution_cost": abs(sum(r.total_fees for r in valid_revenues)),
+            "gmv": sum((r.gmv or 0) for r in money_rows),
+            "net_revenue": sum((r.net_revenue or 0) for r in money_rows),
+            "execution_cost": abs(sum((r.total_fees or 0) for r in money_rows)),
             
             # Từ bảng Marketing Spends
             "ad_spend": sum(m.ad_spend for m in marketing_spends),
@@ -1091,9 +1227,10 @@ def calculate_daily_kpis(
         success_orders = [o for o in target_orders if _classify_order_status(o, order_has_refund.get(o.order_code, False)) == 'completed']
         
         data["hourly_breakdown"] = _calculate_hourly_breakdown(target_orders)
-        data["top_products"] = _calculate_top_products(target_orders)
+        product_names = _get_product_names(db_session, brand_id, unique_skus)
+        data["top_products"] = _calculate_top_products(target_orders, product_names=product_names)
         # Sử dụng hàm mới tách biệt 3 loại sản phẩm xấu
-        data["top_refunded_products"] = _calculate_bad_product_breakdown(target_orders, order_has_refund)
+        data["top_refunded_products"] = _calculate_bad_product_breakdown(target_orders, order_has_refund, product_names=product_names)
         data["payment_method_breakdown"] = _calculate_payment_method_breakdown(success_orders)
         data["cancel_reason_breakdown"] = _calculate_cancel_reason_breakdown(target_orders)
         
@@ -1101,9 +1238,9 @@ def calculate_daily_kpis(
         rev_map = defaultdict(float)
         gmv_map = defaultdict(float)
         
-        for r in valid_revenues:
+        for r in money_rows:
             if r.order_code:
-                rev_map[r.order_code] += r.net_revenue
+                rev_map[r.order_code] += (r.net_revenue or 0)
                 gmv_map[r.order_code] += (r.gmv or 0)
         
         data["location_distribution"] = _calculate_location_distribution(
@@ -1125,70 +1262,25 @@ def calculate_daily_kpis(
         data["financial_events"] = financial_events
 
         # 9. Khách hàng mới/cũ
-        if db_session:
-            data.update(_calculate_customer_retention(target_orders, date_to_calculate, db_session, gmv_map=gmv_map))
+        if db_session or history:
+            data.update(_calculate_customer_retention(target_orders, date_to_calculate, db_session, gmv_map=gmv_map, brand_id=brand_id, history=history))
             data["total_customers"] = len({o.username for o in target_orders if o.username})
             
             # --- TÍNH TOÁN CHU KỲ MUA LẠI TRUNG BÌNH ---
-            data["avg_repurchase_cycle"] = _calculate_repurchase_cycle(target_orders, date_to_calculate, db_session)
+            data["avg_repurchase_cycle"] = _calculate_repurchase_cycle(target_orders, date_to_calculate, db_session, brand_id=brand_id, history=history)
             
             # --- TÍNH TOÁN TỶ LỆ RỜI BỎ (CHURN RATE) ---
             # Truyền brand_id và source để tính chính xác ngữ cảnh
-            data["churn_rate"] = _calculate_churn_rate(date_to_calculate, db_session, brand_id, source)
+            data["churn_rate"] = _calculate_churn_rate(date_to_calculate, db_session, brand_id, source, history=history)
             
             # --- TÍNH TOÁN PHÂN BỔ TẦN SUẤT (Frequency Distribution) ---
-            try:
-                # 1. Lọc đơn thành công trong ngày (dựa vào map order_has_refund đã tính ở trên)
-                success_orders_today = [
-                    o for o in target_orders 
-                    if _classify_order_status(o, order_has_refund.get(o.order_code, False)) == 'completed' 
-                    and o.username
-                ]
-                
-                if success_orders_today:
-                    # Sắp xếp theo thời gian để xác định thứ tự trong ngày
-                    success_orders_today.sort(key=lambda x: x.order_date or getattr(x, 'id', 0))
-                    
-                    target_usernames = {o.username for o in success_orders_today}
-                    
-                    # 2. Query số lượng đơn thành công trong QUÁ KHỨ (Trước ngày tính toán)
-                    # Sử dụng text search đơn giản cho status để tối ưu
-                    past_counts_query = db_session.query(
-                        models.Order.username, 
-                        func.count(models.Order.id)
-                    ).filter(
-                        models.Order.username.in_(target_usernames),
-                        models.Order.order_date < datetime.combine(date_to_calculate, datetime.min.time()),
-                        # Filter đơn thành công (Không phải Hủy/Bom/Hoàn/Fail)
-                        get_active_order_filters(models.Order),
-                        ~models.Order.status.ilike('%hoan%')
-                    ).group_by(models.Order.username)
-                    
-                    past_counts_map = {r[0]: r[1] for r in past_counts_query.all()}
-                    
-                    freq_dist = defaultdict(int)
-                    current_day_counts = defaultdict(int) 
-                    
-                    for order in success_orders_today:
-                        user = order.username
-                        past_count = past_counts_map.get(user, 0)
-                        
-                        # Thứ tự mua hàng = Đã mua quá khứ + Đã mua trước đó trong ngày + 1 (đơn hiện tại)
-                        nth_purchase = past_count + current_day_counts[user] + 1
-                        
-                        freq_dist[str(nth_purchase)] += 1
-                        current_day_counts[user] += 1
-                        
-                    data["frequency_distribution"] = dict(freq_dist)
-                else:
-                    data["frequency_distribution"] = {}
-            except Exception as e:
-                print(f"Error calculating frequency_distribution: {e}")
-                data["frequency_distribution"] = {}
+            data["frequency_distribution"] = _calculate_frequency_distribution(
+                target_orders, order_has_refund, date_to_calculate, db_session, brand_id=brand_id, history=history
+            )
 
             # --- TÍNH PHÂN KHÚC KHÁCH HÀNG (Mới) ---
             data["customer_segment_distribution"] = _calculate_customer_segment_distribution(
-                target_orders, date_to_calculate, db_session
+                target_orders, date_to_calculate, db_session, brand_id=brand_id, history=history
             )
 
         return data
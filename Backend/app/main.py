@@ -1,18 +1,23 @@
-import json, crud, models, schemas, standard_parser, secrets, string
+import json, gzip, time, asyncio, crud, models, schemas, standard_parser, secrets, string, replica
 from services.search_service import search_service
+from services import warmup_service, async_dashboard_service, dashboard_service, data_service
 from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Response, status, Query, Body, Request
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Dict, Any, Union
-from database import SessionLocal, engine
-from datetime import date, timedelta
+from database import SessionLocal, ReplicaSessionLocal, engine
+from async_database import get_async_db, AsyncSessionLocal, AsyncReplicaSessionLocal
+from datetime import date, datetime
 import pandas as pd
 import io
 from openpyxl.styles import Font, PatternFill, Alignment
-from cache import redis_client
-from celery_worker import process_data_request, recalculate_all_brand_data, recalculate_brand_data_specific_dates
+from cache import redis_binary_client, async_redis_binary_client, is_packed_payload, generate_cache_key, result_channel
+from celery_worker import process_data_request, enqueue_brand_recalculation, delete_brand, clone_brand_data
+import task_queues
+from worker_utils import get_pool_checkout_metrics
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
@@ -45,24 +50,37 @@ def get_db():
     finally: 
         db.close()
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Không thể xác thực thông tin đăng nhập",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode_token_data(token: str) -> schemas.TokenData:
+    credentials_exception = _credentials_exception()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-        token_data = schemas.TokenData(username=username, role=payload.get("role"))
+        return schemas.TokenData(username=username, role=payload.get("role"))
     except JWTError:
         raise credentials_exception
-    
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    token_data = _decode_token_data(token)
     user = db.query(models.User).filter(models.User.username == token_data.username).first()
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
+    return user
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """Giống get_current_user nhưng dùng AsyncSession - cho các route đọc async."""
+    token_data = _decode_token_data(token)
+    user = await async_dashboard_service.get_user_by_username(db, token_data.username)
+    if user is None:
+        raise _credentials_exception()
     return user
 
 class RoleChecker:
@@ -142,6 +160,65 @@ def get_brand_from_slug(brand_slug: str, db: Session = Depends(get_db), current_
     
     return db_brand
 
+def _find_read_brand(db: Session, brand_slug: str, username: str):
+    user = db.query(models.User).filter(models.User.username == username).first()
+    if user is None:
+        return None
+    return crud.get_brand_by_slug(db, slug=brand_slug, owner_id=user.id)
+
+def _brand_lookup_error(user_exists: bool) -> HTTPException:
+    return HTTPException(status_code=404, detail="Không tìm thấy Brand.") if user_exists else _credentials_exception()
+
+def get_read_db(brand_slug: str, token: str = Depends(oauth2_scheme)):
+    """
+    Session CHỈ ĐỌC dữ liệu của brand: read replica nếu đã theo kịp lần ghi gần nhất, ngược lại primary.
+    User + brand được tra ngay trên session đọc (không giữ thêm kết nối primary suốt request);
+    route lấy brand qua get_read_brand.
+    """
+    token_data = _decode_token_data(token)
+    db, brand = replica.open_brand_read_session(
+        lambda session: _find_read_brand(session, brand_slug, token_data.username),
+        SessionLocal, ReplicaSessionLocal
+    )
+    try:
+        if brand is None:
+            user_exists = db.query(models.User.id).filter(models.User.username == token_data.username).first() is not None
+            raise _brand_lookup_error(user_exists)
+        db.info["brand"] = brand
+        yield db
+    finally:
+        db.close()
+
+def get_read_brand(db: Session = Depends(get_read_db)) -> models.Brand:
+    """Brand đã được get_read_db kiểm tra quyền sở hữu (dùng chung session đọc của request)."""
+    return db.info["brand"]
+
+async def _find_read_brand_async(db: AsyncSession, brand_slug: str, username: str):
+    user = await async_dashboard_service.get_user_by_username(db, username)
+    if user is None:
+        return None
+    return await async_dashboard_service.get_brand_by_slug(db, brand_slug, user.id)
+
+async def get_async_read_db(brand_slug: str, token: str = Depends(oauth2_scheme)):
+    """Bản async của get_read_db."""
+    token_data = _decode_token_data(token)
+    db, brand = await replica.open_brand_read_session_async(
+        lambda session: _find_read_brand_async(session, brand_slug, token_data.username),
+        AsyncSessionLocal, AsyncReplicaSessionLocal
+    )
+    try:
+        if brand is None:
+            user = await async_dashboard_service.get_user_by_username(db, token_data.username)
+            raise _brand_lookup_error(user is not None)
+        db.info["brand"] = brand
+        yield db
+    finally:
+        await db.close()
+
+async def get_async_read_brand(db: AsyncSession = Depends(get_async_read_db)) -> models.Brand:
+    """Bản async của get_read_brand."""
+    return db.info["brand"]
+
 # ==============================================================================
 # === 1. ENDPOINTS QUẢN LÝ THƯƠNG HIỆU (BRAND MANAGEMENT) ===
 # ==============================================================================
@@ -153,7 +230,10 @@ def read_root():
 @app.get("/api/brands/", response_model=List[schemas.BrandInfo])
 def read_brands(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)): 
     """Lấy danh sách các brand thuộc sở hữu của user hiện tại"""
-    return db.query(models.Brand).filter(models.Brand.owner_id == current_user.id).all()
+    return db.query(models.Brand).filter(
+        models.Brand.owner_id == current_user.id,
+        models.Brand.is_deleting.is_(False)
+    ).all()
 
 @app.post("/api/brands/", response_model=schemas.BrandInfo)
 def create_brand_api(brand: schemas.BrandCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
@@ -172,7 +252,11 @@ def create_brand_api(brand: schemas.BrandCreate, db: Session = Depends(get_db),
 @app.put("/api/brands/{brand_id}", response_model=schemas.BrandInfo)
 def update_brand_api(brand_id: int, brand_update: schemas.BrandCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     # Kiểm tra quyền sở hữu
-    db_brand = db.query(models.Brand).filter(models.Brand.id == brand_id, models.Brand.owner_id == current_user.id).first()
+    db_brand = db.query(models.Brand).filter(
+        models.Brand.id == brand_id,
+        models.Brand.owner_id == current_user.id,
+        models.Brand.is_deleting.is_(False)
+    ).first()
     if not db_brand:
         raise HTTPException(status_code=403, detail="Bạn không có quyền chỉnh sửa thương hiệu này.")
         
@@ -181,30 +265,98 @@ def update_brand_api(brand_id: int, brand_update: schemas.BrandCreate, db: Sessi
         raise HTTPException(status_code=400, detail="Không thể đổi tên. Tên Brand mới đã bị trùng trong danh sách của bạn.")
     return updated_brand
 
-@app.delete("/api/brands/{brand_id}", status_code=status.HTTP_204_NO_CONTENT)
+@app.delete("/api/brands/{brand_id}", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.MessageResponse)
 def delete_brand_api(brand_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    # Kiểm tra quyền sở hữu
-    db_brand = db.query(models.Brand).filter(models.Brand.id == brand_id, models.Brand.owner_id == current_user.id).first()
+    """
+    Đánh dấu brand đang xóa (ẩn ngay khỏi danh sách) và giao việc xóa dữ liệu cho worker nền
+    (xóa theo lô từng bảng con). Theo dõi qua /api/brands/{brand_id}/deletion-progress.
+    """
+    # Kiểm tra quyền sở hữu (brand đang xóa dở mà job trước bị lỗi thì cho phép xóa lại)
+    db_brand = db.query(models.Brand).filter(
+        models.Brand.id == brand_id,
+        models.Brand.owner_id == current_user.id
+    ).first()
     if not db_brand:
         raise HTTPException(status_code=403, detail="Bạn không có quyền xóa thương hiệu này.")
-        
-    deleted_brand = crud.delete_brand_by_id(db, brand_id=brand_id)
-    if not deleted_brand:
-        raise HTTPException(status_code=404, detail="Không tìm thấy Brand để xóa.")
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    if db_brand.is_deleting and task_queues.get_brand_job_progress(task_queues.BRAND_JOB_DELETE, brand_id).get("status") in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="Thương hiệu này đang được xóa.")
+
+    db_brand.is_deleting = True
+    db.commit()
+    task_queues.update_brand_job_progress(
+        task_queues.BRAND_JOB_DELETE, brand_id, status="queued", owner_id=current_user.id, processed_rows=0, started_at=time.time()
+    )
+    delete_brand.delay(brand_id)
+    return {"message": "Đang xóa thương hiệu trong nền."}
+
+def _brand_job_progress_response(job: str, brand_id: int, current_user: models.User):
+    """Dòng brand có thể đã biến mất (xóa) -> quyền sở hữu được lưu cùng tiến độ."""
+    progress = task_queues.get_brand_job_progress(job, brand_id)
+    if not progress or progress.get("owner_id") != current_user.id:
+        raise HTTPException(status_code=404, detail="Không tìm thấy tiến trình của Brand này.")
+
+    total_rows = int(progress.get("total_rows", 0))
+    processed_rows = int(progress.get("processed_rows", 0))
+
+    def to_datetime(value):
+        return datetime.fromtimestamp(float(value)) if value else None
+
+    return {
+        "status": progress.get("status", "queued"),
+        "current_table": progress.get("current_table") or None,
+        "processed_rows": processed_rows,
+        "total_rows": total_rows,
+        "percent": 100.0 if progress.get("status") == "completed" else (
+            round(min(processed_rows * 100 / total_rows, 100.0), 1) if total_rows else 0.0
+        ),
+        "started_at": to_datetime(progress.get("started_at")),
+        "updated_at": to_datetime(progress.get("updated_at")),
+        "error": progress.get("error") or None,
+    }
+
+@app.get("/api/brands/{brand_id}/deletion-progress", response_model=schemas.BrandJobProgressResponse)
+def get_brand_deletion_progress(brand_id: int, current_user: models.User = Depends(get_current_user)):
+    """Tiến độ xóa nền của brand."""
+    return _brand_job_progress_response(task_queues.BRAND_JOB_DELETE, brand_id, current_user)
 
 @app.post("/api/brands/{brand_id}/clone", response_model=schemas.BrandInfo)
-def clone_brand_api(brand_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def clone_brand_api(
+    brand_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    copy_data: bool = Query(False, description="Nếu True, sao chép cả dữ liệu và số liệu đã tính (chạy nền).")
+):
+    """
+    Nhân bản brand. copy_data=True: worker sao chép sản phẩm, đơn hàng, doanh thu, marketing, khách hàng
+    và số liệu ngày bằng INSERT ... SELECT (không cần tính lại). Theo dõi qua /api/brands/{id}/clone-progress.
+    """
     # Kiểm tra quyền sở hữu
-    db_brand = db.query(models.Brand).filter(models.Brand.id == brand_id, models.Brand.owner_id == current_user.id).first()
+    db_brand = db.query(models.Brand).filter(
+        models.Brand.id == brand_id,
+        models.Brand.owner_id == current_user.id,
+        models.Brand.is_deleting.is_(False)
+    ).first()
     if not db_brand:
         raise HTTPException(status_code=403, detail="Bạn không có quyền nhân bản thương hiệu này.")
         
     cloned = crud.clone_brand(db, brand_id=brand_id)
     if not cloned:
         raise HTTPException(status_code=404, detail="Không tìm thấy Brand để nhân bản.")
+
+    if copy_data:
+        task_queues.update_brand_job_progress(
+            task_queues.BRAND_JOB_CLONE, cloned.id,
+            status="queued", owner_id=current_user.id, source_brand_id=brand_id,
+            processed_rows=0, started_at=time.time()
+        )
+        clone_brand_data.delay(brand_id, cloned.id)
     return cloned
 
+@app.get("/api/brands/{brand_id}/clone-progress", response_model=schemas.BrandJobProgressResponse)
+def get_brand_clone_progress(brand_id: int, current_user: models.User = Depends(get_current_user)):
+    """Tiến độ sao chép dữ liệu vào brand nhân bản (brand_id là brand MỚI)."""
+    return _brand_job_progress_response(task_queues.BRAND_JOB_CLONE, brand_id, current_user)
+
 @app.post("/api/brands/{brand_slug}/trigger-recalculation", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.MessageResponse)
 @limiter.limit("5/minute")
 def trigger_recalculation_api(request: Request, brand: models.Brand = Depends(get_brand_from_slug)):
@@ -212,7 +364,7 @@ def trigger_recalculation_api(request: Request, brand: models.Brand = Depends(ge
     Kích hoạt task chạy nền để tính toán lại toàn bộ dữ liệu cho brand.
     Trả về ngay lập tức.
     """
-    recalculate_all_brand_data.delay(brand.id)
+    enqueue_brand_recalculation(brand.id, full=True)
     return {"message": "Yêu cầu tính toán lại đã được gửi đi. Dữ liệu sẽ được cập nhật trong nền."}
 
 
@@ -241,18 +393,22 @@ async def upload_standard_file(
     )
     if result.get("status") == "error":
         raise HTTPException(status_code=400, detail=result.get("message"))
+    # Đọc ngay sau import (search, dashboard) đi primary tới khi replica theo kịp
+    replica.pin_brand_to_primary(db, brand.id)
     
     # [TỐI ƯU] Kích hoạt task tính toán lại thông minh
     affected_dates = result.get("affected_dates")
+    recosted_dates = result.get("recosted_dates") or []
     task = None
     
-    if affected_dates and isinstance(affected_dates, list) and len(affected_dates) > 0:
-        print(f"API: Kích hoạt tính toán lại cho {len(affected_dates)} ngày cụ thể.")
-        task = recalculate_brand_data_specific_dates.delay(brand.id, affected_dates)
+    if (affected_dates and isinstance(affected_dates, list) and len(affected_dates) > 0) or recosted_dates:
+        # Các ngày (kể cả ngày có đơn được tính lại giá vốn) đã được importer ghi vào sổ stats_dirty_days cùng transaction dữ liệu
+        print(f"API: Kích hoạt tính toán lại cho {len(set(affected_dates or []) | set(recosted_dates))} ngày cụ thể.")
+        task = enqueue_brand_recalculation(brand.id)
     else:
         # Fallback: Nếu không xác định được ngày (file rỗng?), tính lại toàn bộ cho chắc
         print("API: Không xác định được ngày cụ thể, tính toán lại TOÀN BỘ.")
-        task = recalculate_all_brand_data.delay(brand.id)
+        task = enqueue_brand_recalculation(brand.id, full=True, reason="import")
     
     # [UX IMPROVEMENT] Chờ worker hoàn thành (tối đa 60s) để Frontend hiển thị Loading đúng thực tế
     if task:
@@ -275,16 +431,49 @@ def recalculate_and_wait(request: Request, brand: models.Brand = Depends(get_bra
     print(f"API: Nhận yêu cầu recalculate-and-wait cho brand {brand.id}.")
     
     # Gửi task đến Worker và lấy về đối tượng AsyncResult
-    task_result = recalculate_all_brand_data.delay(brand.id)
+    task_result = enqueue_brand_recalculation(brand.id, full=True)
     
     try:
         # Dòng quan trọng: Chờ đợi kết quả của task, với timeout là 5 phút (300 giây)
-        task_result.get(timeout=300) 
+        deadline = time.monotonic() + 300
+        result = task_result.get(timeout=300)
+        # Tính toán lại song song: job drain trả về ngay sau khi chia shard -> chờ tiến độ hoàn tất
+        if isinstance(result, dict) and result.get("mode") == "parallel":
+            while task_queues.get_recalc_progress(brand.id).get("status") == "running":
+                if time.monotonic() > deadline:
+                    raise TimeoutError()
+                time.sleep(1)
         print(f"API: Worker đã hoàn thành recalculate cho brand {brand.id}.")
         return {"message": "Tính toán lại hoàn tất!"}
     except TimeoutError:
         raise HTTPException(status_code=504, detail="Quá trình tính toán mất quá nhiều thời gian.")
 
+@app.get("/api/brands/{brand_slug}/recalculation-progress", response_model=schemas.RecalculationProgressResponse)
+def get_recalculation_progress(brand: models.Brand = Depends(get_brand_from_slug), db: Session = Depends(get_db)):
+    """Tiến độ tính toán lại toàn bộ (theo khối ngày + checkpoint) và trạng thái job đang chờ."""
+    progress = task_queues.get_recalc_progress(brand.id)
+    total_days = int(progress.get("total_days", 0))
+    processed_days = int(progress.get("processed_days", 0))
+
+    def to_datetime(value):
+        return datetime.fromtimestamp(float(value)) if value else None
+
+    return {
+        "status": progress.get("status", "idle"),
+        "total_days": total_days,
+        "processed_days": processed_days,
+        "percent": round(processed_days * 100 / total_days, 1) if total_days else 0.0,
+        # Checkpoint chỉ có một giá trị khi chạy 1 shard; chạy song song thì xem shards_done
+        "checkpoint": progress.get("ckpt:0") if progress.get("shards_total") == "1" else None,
+        "shards_total": int(progress.get("shards_total", 0)),
+        "shards_done": int(progress.get("shards_done", 0)),
+        "attempts": int(progress.get("attempts", 0)),
+        "started_at": to_datetime(progress.get("started_at")),
+        "updated_at": to_datetime(progress.get("updated_at")),
+        "error": progress.get("error") or None,
+        "pending": task_queues.is_recalc_pending(brand.id) or data_service.has_dirty_days(db, brand.id),
+    }
+
 class DateRangePayload(BaseModel):
     start_date: date
     end_date: date
@@ -319,20 +508,8 @@ def delete_data_in_range(
             fully_deleted_sources = []
             
         # Kích hoạt tính toán lại dữ liệu trong nền (Chỉ tính các ngày bị ảnh hưởng)
-        from datetime import timedelta
-        
-        delta = payload.end_date - payload.start_date
-        affected_dates = []
-        # Tạo danh sách các ngày trong khoảng thời gian xóa
-        for i in range(delta.days + 1):
-            day = payload.start_date + timedelta(days=i)
-            affected_dates.append(day.isoformat())
-            
-        if affected_dates:
-            recalculate_brand_data_specific_dates.delay(brand.id, affected_dates)
-        else:
-            # Fallback nếu không xác định được ngày
-            recalculate_all_brand_data.delay(brand.id)
+        # Các ngày có số liệu trong khoảng đã được ghi vào sổ stats_dirty_days cùng transaction xóa
+        enqueue_brand_recalculation(brand.id)
         
         return {
             "message": "Yêu cầu xóa dữ liệu đã được thực hiện. Dữ liệu đang được tính toán lại.",
@@ -341,10 +518,19 @@ def delete_data_in_range(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi server khi xóa dữ liệu: {str(e)}")
 
-def generate_cache_key(brand_id: int, request_type: str, params: Dict[str, Any]) -> str:
-    """Tạo ra một cache key nhất quán từ thông tin request."""
-    param_string = ":".join(f"{k}={v}" for k, v in sorted(params.items()))
-    return f"data_req:{brand_id}:{request_type}:{param_string}"
+def build_cached_payload_response(request: Request, raw_payload: bytes) -> Response:
+    """
+    Trả về payload đã được worker nén sẵn (orjson + gzip) dưới dạng bytes thô.
+    Không parse lại JSON, không nén lại: GZipMiddleware bỏ qua response đã có Content-Encoding.
+    """
+    if "gzip" in request.headers.get("accept-encoding", "").lower():
+        return Response(
+            content=raw_payload,
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    # Client không hỗ trợ gzip (hiếm): giải nén một lần, vẫn không cần parse JSON
+    return Response(content=gzip.decompress(raw_payload), media_type="application/json")
 
 @app.post("/api/data-requests", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.TaskResponse)
 @limiter.limit("60/minute")
@@ -367,16 +553,15 @@ def request_data_processing(
     params = request_body.params
 
     cache_key = generate_cache_key(brand_id, request_type, params)
+    # Ghi nhận để job làm nóng cache học được các panel hay dùng
+    warmup_service.record_request_usage(brand_id, request_type, params)
     
-    # Bước 1: Kiểm tra cache
-    cached_result = redis_client.get(cache_key)
-    if cached_result:
+    # Bước 1: Kiểm tra cache (payload đã chứa sẵn envelope {"status", "data"} ở dạng gzip)
+    cached_result = redis_binary_client.get(cache_key)
+    if is_packed_payload(cached_result):
         print(f"API: Cache HIT cho key: {cache_key}")
         # Trả về ngay lập tức nếu tìm thấy
-        return ORJSONResponse(
-            content={"status": "SUCCESS", "data": json.loads(cached_result)},
-            status_code=status.HTTP_200_OK
-        )
+        return build_cached_payload_response(request, cached_result)
     
     # Bước 2: Cache miss -> Giao việc cho worker
     print(f"API: Cache MISS cho key: {cache_key}. Giao việc cho worker.")
@@ -390,16 +575,8 @@ def request_data_processing(
     # Trả về task_id để frontend có thể "hỏi thăm"
     return {"task_id": task.id, "status": "PROCESSING", "cache_key": cache_key}
 
-@app.get("/api/data-requests/status/{cache_key}", response_model=schemas.TaskStatusResponse)
-def get_request_status(
-    cache_key: str, 
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """
-    Endpoint để Frontend "hỏi thăm" xem dữ liệu đã được xử lý xong chưa.
-    Nó kiểm tra cache và quyền truy cập dựa trên brand_id trong cache_key.
-    """
+def _authorized_brand_id(db: Session, cache_key: str, current_user: models.User) -> int:
+    """Parse brand_id từ cache_key và kiểm tra quyền sở hữu brand."""
     # Parse brand_id từ cache_key (định dạng: data_req:brand_id:request_type:params)
     try:
         parts = cache_key.split(":")
@@ -413,26 +590,102 @@ def get_request_status(
     db_brand = db.query(models.Brand).filter(models.Brand.id == brand_id).first()
     if not db_brand or db_brand.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Bạn không có quyền xem dữ liệu này.")
+    return brand_id
+
+def get_brand_id_from_cache_key(
+    cache_key: str,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+) -> int:
+    return _authorized_brand_id(db, cache_key, current_user)
+
+def get_stream_brand_id(cache_key: str, token: str = Depends(oauth2_scheme)) -> int:
+    """
+    Như get_brand_id_from_cache_key nhưng dùng phiên DB ngắn: session của dependency `yield` sống tới hết
+    response, với SSE là cả luồng chờ (tới SSE_WAIT_TIMEOUT_SECONDS) -> vài dashboard mở là cạn pool.
+    """
+    token_data = _decode_token_data(token)
+    with SessionLocal() as db:
+        current_user = db.query(models.User).filter(models.User.username == token_data.username).first()
+        if current_user is None:
+            raise _credentials_exception()
+        return _authorized_brand_id(db, cache_key, current_user)
 
-    cached_result = redis_client.get(cache_key)
+@app.get("/api/data-requests/status/{cache_key}", response_model=schemas.TaskStatusResponse)
+def get_request_status(
+    request: Request,
+    cache_key: str, 
+    brand_id: int = Depends(get_brand_id_from_cache_key)
+):
+    """
+    Endpoint để Frontend "hỏi thăm" xem dữ liệu đã được xử lý xong chưa.
+    Nó kiểm tra cache và quyền truy cập dựa trên brand_id trong cache_key.
+    """
+    cached_result = redis_binary_client.get(cache_key)
     
-    if cached_result:
+    if is_packed_payload(cached_result):
         print(f"API: Polling HIT cho key: {cache_key}")
-        result = json.loads(cached_result)
-        # Kiểm tra xem worker có báo lỗi không
-        if isinstance(result, dict) and result.get("status") == "FAILED":
-            return {"status": "FAILED", "error": result.get("error", "Lỗi không xác định từ worker.")}
-        # Thành công
-        return {"status": "SUCCESS", "data": result}
+        # Envelope SUCCESS/FAILED đã được worker đóng gói sẵn -> trả thẳng bytes
+        return build_cached_payload_response(request, cached_result)
     else:
         # Vẫn đang xử lý
         return {"status": "PROCESSING"}
 
+# Thời gian tối đa giữ một kết nối SSE chờ worker, và chu kỳ gửi keep-alive (giữ proxy không cắt kết nối)
+SSE_WAIT_TIMEOUT_SECONDS = 120
+SSE_KEEPALIVE_SECONDS = 15
+
+def _sse_event(event: str, raw_payload: bytes) -> bytes:
+    """Đóng gói payload (orjson + gzip từ worker) thành một sự kiện SSE. orjson không sinh ký tự xuống dòng."""
+    return b"event: " + event.encode() + b"\ndata: " + gzip.decompress(raw_payload) + b"\n\n"
+
+@app.get("/api/data-requests/stream/{cache_key}")
+async def stream_request_result(
+    cache_key: str,
+    brand_id: int = Depends(get_stream_brand_id)
+):
+    """
+    Server-Sent Events: giữ MỘT kết nối và đẩy kết quả (SUCCESS/FAILED) ngay khi worker xử lý xong,
+    thay cho việc polling /status mỗi 2 giây. Xác thực + kiểm tra quyền chỉ chạy một lần.
+    """
+    async def event_stream():
+        pubsub = async_redis_binary_client.pubsub()
+        try:
+            await pubsub.subscribe(result_channel(cache_key))
+
+            # Kiểm tra cache SAU khi subscribe để không bỏ lỡ kết quả được publish giữa hai bước
+            cached_result = await async_redis_binary_client.get(cache_key)
+            if is_packed_payload(cached_result):
+                yield _sse_event("result", cached_result)
+                return
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + SSE_WAIT_TIMEOUT_SECONDS
+            while loop.time() < deadline:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=SSE_KEEPALIVE_SECONDS)
+                if message and is_packed_payload(message.get("data")):
+                    yield _sse_event("result", message["data"])
+                    return
+                yield b": keep-alive\n\n"
+
+            # Hết thời gian chờ: client tự chuyển sang polling
+            yield b"event: timeout\ndata: {}\n\n"
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/brands/{brand_slug}/recalculate", status_code=status.HTTP_200_OK, response_model=schemas.RecalculationResponse)
 @limiter.limit("5/minute")
 def recalculate_brand_data(request: Request, brand: models.Brand = Depends(get_brand_from_slug), db: Session = Depends(get_db)):
     """Tính toán lại toàn bộ dữ liệu của một brand một cách đồng bộ."""
     result = crud.recalculate_brand_data_sync(db, brand_id=brand.id)
+    replica.pin_brand_to_primary(db, brand.id)
     return result
 
 @app.get("/api/brands/{brand_slug}/download-sample-file")
@@ -547,22 +800,34 @@ def download_sample_file(brand: models.Brand = Depends(get_brand_from_slug)):
         headers={'Content-Disposition': f'attachment; filename="{filename}"'}
     )
 
+@app.get("/api/admin/queue-stats", response_model=schemas.QueueStatsResponse)
+def get_queue_stats(current_user: models.User = Depends(RoleChecker([models.UserRole.ADMIN]))):
+    """Độ sâu, thời gian chờ và số task đang chạy theo brand của từng hàng đợi worker."""
+    try:
+        return {
+            "queues": [task_queues.get_queue_stats(queue) for queue in task_queues.ALL_QUEUES],
+            "db_pools": {pool: get_pool_checkout_metrics(pool) for pool in ("gevent", "prefork")},
+        }
+    except Exception as e:
+        print(f"!!! LỖI ENDPOINT QUEUE STATS: {e}")
+        raise HTTPException(status_code=503, detail="Không đọc được thông tin hàng đợi.")
+
 # ==============================================================================
 # === 3. ENDPOINTS LẤY DỮ LIỆU CHO DASHBOARD (DATA RETRIEVAL) ===
 # ==============================================================================
 
 @app.get("/api/brands/{brand_slug}/customer-map-distribution", response_model=List[schemas.CustomerMapDistributionItem])
-def read_customer_map_distribution(
+async def read_customer_map_distribution(
     start_date: date,
     end_date: date,
     status: List[str] = Query(['completed'], description="Trạng thái đơn hàng cần lấy (completed, cancelled, bomb, refunded). Mặc định chỉ lấy completed."),
     source: List[str] = Query(None, description="Danh sách nguồn dữ liệu (e.g. shopee, lazada)"),
-    brand: models.Brand = Depends(get_brand_from_slug),
-    db: Session = Depends(get_db)
+    brand: models.Brand = Depends(get_async_read_brand),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Lấy dữ liệu phân bổ khách hàng theo tỉnh/thành để vẽ bản đồ."""
     try:
-        distribution_data = crud.get_aggregated_location_distribution(
+        distribution_data = await async_dashboard_service.get_aggregated_location_distribution(
             db, brand.id, start_date, end_date, status_filter=status, source_list=source
         )
         return distribution_data
@@ -589,30 +854,50 @@ def read_brand_kpis(
     # Chỉ tính lại khi có hành động cụ thể (Upload/Delete).
     return db_brand
 
-@app.get("/api/brands/{brand_slug}/daily-kpis", response_model=schemas.DailyKpiResponse)
-def read_brand_daily_kpis(
+@app.get(
+    "/api/brands/{brand_slug}/daily-kpis",
+    response_model=schemas.DailyKpiResponse,
+    responses={200: {"model": Union[schemas.DailyKpiResponse, schemas.ColumnarKpiResponse]}}
+)
+async def read_brand_daily_kpis(
     start_date: date, 
     end_date: date, 
     source: List[str] = Query(None), # Thêm tham số source
-    brand: models.Brand = Depends(get_brand_from_slug),
-    db: Session = Depends(get_db)
+    format: str = Query("rows", description="rows (mặc định, mỗi ngày một object) hoặc columnar (mỗi chỉ số một mảng)"),
+    metrics: List[str] = Query(None, description="Chỉ dùng với format=columnar: các chỉ số cần trả về (mặc định tất cả)"),
+    brand: models.Brand = Depends(get_async_read_brand),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Lấy dữ liệu KPI hàng ngày cho việc vẽ biểu đồ, có hỗ trợ lọc theo nguồn."""
-    daily_data = crud.get_daily_kpis_for_range(db, brand.id, start_date, end_date, source_list=source)
+    if format not in ("rows", "columnar"):
+        raise HTTPException(status_code=400, detail="format phải là 'rows' hoặc 'columnar'.")
+    if format == "columnar":
+        try:
+            metric_names = dashboard_service.resolve_columnar_metrics(metrics)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # DailyKpi / dạng cột chỉ có chỉ số dạng số -> không đọc cột JSONB
+    daily_data = await async_dashboard_service.get_daily_kpis_for_range(
+        db, brand.id, start_date, end_date, source_list=source, fields=dashboard_service.SCALAR_KPI_FIELDS
+    )
+    if format == "columnar":
+        # Trả thẳng qua orjson: không validate lại hàng nghìn giá trị qua response_model
+        return ORJSONResponse({"format": "columnar", **dashboard_service.build_columnar_kpis(daily_data, metric_names)})
     return {"data": daily_data}
 
 @app.get("/api/brands/{brand_slug}/top-products", response_model=List[schemas.TopProduct])
-def read_top_products(
+async def read_top_products(
     start_date: date,
     end_date: date,
     source: List[str] = Query(None, description="Lọc theo nguồn (shopee, lazada...)"),
-    brand: models.Brand = Depends(get_brand_from_slug),
+    brand: models.Brand = Depends(get_async_read_brand),
     limit: int = 10,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Lấy top N sản phẩm bán chạy nhất."""
     try:
-        top_products = crud.get_top_selling_products(db, brand.id, start_date, end_date, limit, source_list=source)
+        top_products = await async_dashboard_service.get_top_selling_products(db, brand.id, start_date, end_date, limit, source_list=source)
         return top_products
     except Exception as e:
         print(f"!!! LỖI ENDPOINT TOP PRODUCTS: {e}")
@@ -621,20 +906,20 @@ def read_top_products(
 
 @app.get("/api/brands/{brand_slug}/kpis/operation", response_model=schemas.OperationKpisResponse)
 @limiter.limit("30/minute")
-def get_operation_kpis (
+async def get_operation_kpis (
     request: Request,
     brand_slug: str,
     start_date: date = Query(..., description="Ngày bắt đầu (YYYY-MM-DD)"),
     end_date: date = Query(..., description="Ngày kết thúc (YYYY-MM-DD)"),
     source: List[str] = Query(None, description="Danh sách nguồn dữ liệu (e.g. shopee, lazada)"),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async)
 ): 
     """
     Lấy các chỉ số KPI vận hành tổng hợp cho OperationPage.
     Trả về giá trị trung bình trong khoảng thời gian được chọn.
     """
-    db_brand = crud.get_brand_by_slug(db, slug=brand_slug, owner_id=current_user.id)
+    db_brand = await async_dashboard_service.get_brand_by_slug(db, brand_slug, current_user.id)
     if not db_brand:
         raise HTTPException(status_code=404, detail="Không tìm thấy Brand.")
     
@@ -642,9 +927,12 @@ def get_operation_kpis (
     # Nếu không có source truyền vào, mặc định là ['all'] bên trong logic
     
     print(f"DEBUG_API: get_operation_kpis called with range: {start_date} -> {end_date}, sources: {source}")
+    await warmup_service.record_request_usage_async(
+        db_brand.id, "operation_kpis", {"start_date": start_date, "end_date": end_date, "source": source}
+    )
     
     # Sử dụng hàm aggregation mới từ crud (đã dùng kpi_utils để gộp JSON)
-    operation_kpis = crud.get_aggregated_operation_kpis(
+    operation_kpis = await async_dashboard_service.get_aggregated_operation_kpis(
         db, 
         db_brand.id, 
         start_date, 
@@ -657,23 +945,26 @@ def get_operation_kpis (
 
 @app.get("/api/brands/{brand_slug}/kpis/customer", response_model=schemas.CustomerKpisResponse)
 @limiter.limit("30/minute")
-def get_customer_kpis (
+async def get_customer_kpis (
     request: Request,
     brand_slug: str,
     start_date: date = Query(..., description="Ngày bắt đầu (YYYY-MM-DD)"),
     end_date: date = Query(..., description="Ngày kết thúc (YYYY-MM-DD)"),
     source: List[str] = Query(None, description="Danh sách nguồn dữ liệu"),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async)
 ):
     """
     Lấy các chỉ số KPI khách hàng cho CustomerPage.
     """
-    db_brand = crud.get_brand_by_slug(db, slug=brand_slug, owner_id=current_user.id)
+    db_brand = await async_dashboard_service.get_brand_by_slug(db, brand_slug, current_user.id)
     if not db_brand:
         raise HTTPException(status_code=404, detail="Không tìm thấy Brand.")
-        
-    customer_kpis = crud.get_aggregated_customer_kpis(
+
+    await warmup_service.record_request_usage_async(
+        db_brand.id, "customer_kpis", {"start_date": start_date, "end_date": end_date, "source": source}
+    )
+    customer_kpis = await async_dashboard_service.get_aggregated_customer_kpis(
         db,
         db_brand.id,
         start_date,
@@ -682,6 +973,31 @@ def get_customer_kpis (
     )
     return customer_kpis
 
+@app.post("/api/brands/{brand_slug}/dashboard-bundle", response_model=schemas.DashboardBundleResponse, response_model_exclude_none=True)
+@limiter.limit("30/minute")
+def get_dashboard_bundle(
+    request: Request,
+    payload: schemas.DashboardBundleRequest,
+    brand: models.Brand = Depends(get_brand_from_slug),
+    db: Session = Depends(get_db)
+):
+    """
+    Trả về nhiều panel (kpi_summary, daily_kpis_chart, operation_kpis, customer_kpis,
+    top_products, platform_comparison) cho cùng một khoảng thời gian trong một request.
+    Dữ liệu ngày của kỳ hiện tại + kỳ trước chỉ được đọc một lần.
+    """
+    if payload.end_date < payload.start_date:
+        raise HTTPException(status_code=400, detail="end_date phải lớn hơn hoặc bằng start_date.")
+
+    unknown_panels = [p for p in payload.panels if p not in crud.BUNDLE_PANELS]
+    if unknown_panels:
+        raise HTTPException(status_code=400, detail=f"Panel không hợp lệ: {', '.join(unknown_panels)}")
+
+    return crud.get_dashboard_bundle(
+        db, brand.id, payload.start_date, payload.end_date, payload.panels,
+        source_list=payload.source, interval=payload.interval, top_limit=payload.top_limit
+    )
+
 @app.get("/api/brands/{brand_slug}/customers", response_model=List[schemas.CustomerAnalyticsItem])
 @limiter.limit("30/minute")
 def get_top_customers(
@@ -722,17 +1038,13 @@ def get_top_customers(
 def search_anything(
     brand_slug: str,
     q: str = Query(..., min_length=1),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    brand: models.Brand = Depends(get_read_brand),
+    db: Session = Depends(get_read_db)
 ):
     """
     Tìm kiếm thông minh: Đơn hàng, Mã vận đơn, SĐT hoặc Tên khách hàng.
     """
-    db_brand = crud.get_brand_by_slug(db, slug=brand_slug, owner_id=current_user.id)
-    if not db_brand:
-        raise HTTPException(status_code=404, detail="Không tìm thấy Brand.")
-    
-    result = search_service.search_entities(db, db_brand.id, q)
+    result = search_service.search_entities(db, brand.id, q)
     if not result:
         # Trả về 200 kèm status not_found để frontend xử lý êm ái hơn là báo lỗi 404
         return {"status": "not_found", "message": "Không tìm thấy kết quả phù hợp."}
@@ -740,20 +1052,16 @@ def search_anything(
     return result
 
 @app.get("/api/brands/{brand_slug}/search-suggestions", response_model=List[schemas.SearchSuggestionItem])
-def get_search_suggestions(
+async def get_search_suggestions(
     brand_slug: str,
     q: str = Query(..., min_length=2),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    brand: models.Brand = Depends(get_async_read_brand),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """
     Gợi ý nhanh khi người dùng nhập vào ô tìm kiếm.
     """
-    db_brand = crud.get_brand_by_slug(db, slug=brand_slug, owner_id=current_user.id)
-    if not db_brand:
-        raise HTTPException(status_code=404, detail="Không tìm thấy Brand.")
-    
-    return search_service.suggest_entities(db, db_brand.id, q)
+    return await async_dashboard_service.suggest_entities(db, brand.id, q)
 
 @app.put("/api/brands/{brand_slug}/customers/{customer_identifier}", response_model=schemas.CustomerDetailResponse)
 def update_customer_api(
@@ -771,6 +1079,7 @@ def update_customer_api(
         raise HTTPException(status_code=404, detail="Không tìm thấy Brand.")
         
     updated_customer = crud.customer.update_customer_info(db, db_brand.id, customer_identifier, update_data)
+    replica.pin_brand_to_primary(db, db_brand.id)
     
     if not updated_customer:
         raise HTTPException(status_code=404, detail="Không tìm thấy Khách hàng.")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Float, Index, UniqueConstraint, DateTime, Boolean, func, Text, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, ForeignKeyConstraint, Date, Float, Index, UniqueConstraint, DateTime, Boolean, func, Text, Enum
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import JSONB 
 import enum
@@ -93,6 +93,7 @@ class Brand(Base):
     name = Column(String, index=True)
     slug = Column(String, index=True)
     owner_id = Column(String, ForeignKey("users.id"), index=True, nullable=True) # Map với User ID là String
+    is_deleting = Column(Boolean, default=False, server_default='false', nullable=False) # Đang xóa nền (ẩn khỏi danh sách)
 
     owner = relationship("User", backref="brands")
     products = relationship("Product", back_populates="owner_brand", cascade="all, delete-orphan")
@@ -103,6 +104,7 @@ class Brand(Base):
     daily_stats = relationship("DailyStat", back_populates="owner_brand", cascade="all, delete-orphan")
     daily_analytics = relationship("DailyAnalytics", back_populates="owner_brand", cascade="all, delete-orphan")
     import_logs = relationship("ImportLog", back_populates="owner_brand", cascade="all, delete-orphan")
+    stats_dirty_days = relationship("StatsDirtyDay", back_populates="owner_brand", cascade="all, delete-orphan")
     
     customers = relationship("Customer", back_populates="owner_brand", cascade="all, delete-orphan")
 
@@ -126,7 +128,8 @@ class Order(Base):
     id = Column(Integer, primary_key=True, index=True)
 
     order_code = Column(String, index=True)
-    order_date = Column(DateTime, nullable=True, index=True) 
+    # Khóa phân vùng (RANGE theo tháng) -> thuộc khóa chính của bảng, bắt buộc có giá trị
+    order_date = Column(DateTime, primary_key=True, nullable=False, index=True) 
     
     shipped_time = Column(DateTime, nullable=True)
     tracking_id = Column(String, nullable=True, index=True)    
@@ -148,7 +151,9 @@ class Order(Base):
 
     __table_args__ = (
         Index('ix_order_brand_id_order_date', 'brand_id', 'order_date'),
-        UniqueConstraint('order_code', 'brand_id', name='uq_order_brand_code'),
+        # Bảng phân vùng: ràng buộc UNIQUE phải chứa khóa phân vùng. order_code duy nhất theo brand được
+        # đảm bảo bằng khóa advisory partitioning.lock_brand_order_codes khi thêm đơn
+        UniqueConstraint('order_code', 'brand_id', 'order_date', name='uq_order_brand_code'),
         
         # Index GIN cho tìm kiếm nhanh (Order)
         Index('idx_order_search_gin', 'order_code', 'tracking_id', 'username',
@@ -158,9 +163,40 @@ class Order(Base):
                   'tracking_id': 'gin_trgm_ops',
                   'username': 'gin_trgm_ops'
               }),
+        {'postgresql_partition_by': 'RANGE (order_date)'},
     )
+    # id (từ sequence) vẫn là định danh duy nhất phía ORM; order_date chỉ nằm trong khóa chính của DB
+    __mapper_args__ = {"primary_key": [id]}
     
     owner_brand = relationship("Brand", back_populates="orders")
+    # Dòng sản phẩm của đơn (xóa đơn -> DB tự xóa dòng con qua ON DELETE CASCADE)
+    items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan",
+                         passive_deletes=True, order_by="OrderItem.id")
+
+class OrderItem(Base):
+    """
+    Từng dòng sản phẩm của một đơn (trước đây nằm trong Order.details['items']).
+    Tách bảng để thống kê theo SKU, đếm SKU phân biệt và drill-down sản phẩm chạy bằng SQL.
+    """
+    __tablename__ = "order_items"
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, nullable=False, index=True)
+    order_date = Column(DateTime, nullable=False) # Sao từ đơn: khóa ngoại tới orders (bảng phân vùng) gồm cả khóa phân vùng
+    brand_id = Column(Integer, ForeignKey("brands.id", ondelete="CASCADE"), nullable=False)
+
+    sku = Column(String, nullable=False)
+    quantity = Column(Integer, default=0)
+    original_price = Column(Float, default=0.0)
+    sku_price = Column(Float, default=0.0)
+    subsidy_amount = Column(Float, default=0.0)
+
+    order = relationship("Order", back_populates="items")
+
+    __table_args__ = (
+        ForeignKeyConstraint(['order_id', 'order_date'], ['orders.id', 'orders.order_date'],
+                             ondelete="CASCADE", name='order_items_order_fkey'),
+        Index('ix_order_items_brand_sku', 'brand_id', 'sku'),
+    )
 
 class Revenue(Base):
     __tablename__ = "revenues"
@@ -168,7 +204,8 @@ class Revenue(Base):
 
     order_code = Column(String, index=True)
     order_date = Column(Date, nullable=True) 
-    transaction_date = Column(Date, nullable=True)
+    # Khóa phân vùng (RANGE theo tháng) -> thuộc khóa chính của bảng, bắt buộc có giá trị
+    transaction_date = Column(Date, primary_key=True, nullable=False)
     net_revenue = Column(Float, default=0.0)
     gmv = Column(Float, default=0.0)
     
@@ -190,10 +227,34 @@ class Revenue(Base):
                   'order_code': 'gin_trgm_ops',
                   'order_refund': 'gin_trgm_ops'
               }),
+        {'postgresql_partition_by': 'RANGE (transaction_date)'},
     )
+    __mapper_args__ = {"primary_key": [id]}
 
     owner_brand = relationship("Brand", back_populates="revenues")
 
+class OrderFinancial(Base):
+    """
+    Tổng hợp tài chính theo đơn (cộng từ các dòng revenues cùng order_code), cập nhật ngay khi
+    import / xóa doanh thu - các nơi đọc chỉ cần join hoặc tra theo (brand_id, order_code).
+    """
+    __tablename__ = "order_financials"
+    id = Column(Integer, primary_key=True, index=True)
+    brand_id = Column(Integer, ForeignKey("brands.id", ondelete="CASCADE"), nullable=False)
+    order_code = Column(String, nullable=False)
+
+    net_revenue = Column(Float, default=0.0)
+    gmv = Column(Float, default=0.0)
+    total_fees = Column(Float, default=0.0)
+    refund_total = Column(Float, default=0.0)
+    is_refunded = Column(Boolean, default=False, server_default='false', nullable=False) # Có dòng refund < -0.1
+    refund_tracking_code = Column(String, nullable=True) # Mã vận đơn hoàn gần nhất
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('brand_id', 'order_code', name='uq_order_financials_brand_code'),
+    )
+
 class MarketingSpend(Base, MarketingMetricsMixin):
     __tablename__ = "marketing_spends"
 
@@ -254,6 +315,61 @@ class DailyAnalytics(Base, FinancialMetricsMixin, MarketingMetricsMixin, Operati
 
     owner_brand = relationship("Brand", back_populates="daily_analytics")
 
+class DailyStatCumulative(Base):
+    """
+    Tổng lũy kế (prefix sum) theo ngày của các chỉ số cộng dồn được, theo brand + nguồn
+    ('all' = DailyStat, còn lại = DailyAnalytics của nguồn đó). Mỗi cột là tổng từ ngày đầu tiên
+    tới `date` (bao gồm) -> tổng khoảng [a, b] = cum[b] - cum[trước a], hai lần đọc theo index.
+    Dựng lại từ ngày sớm nhất bị tính lại (data_service.refresh_cumulative_stats).
+    """
+    __tablename__ = "daily_stat_cumulatives"
+    id = Column(Integer, primary_key=True, index=True)
+    brand_id = Column(Integer, ForeignKey("brands.id", ondelete="CASCADE"), nullable=False)
+    source = Column(String, nullable=False)
+    date = Column(Date, nullable=False)
+
+    net_revenue = Column(Float, default=0.0)
+    gmv = Column(Float, default=0.0)
+    profit = Column(Float, default=0.0)
+    total_cost = Column(Float, default=0.0)
+    cogs = Column(Float, default=0.0)
+    execution_cost = Column(Float, default=0.0)
+    ad_spend = Column(Float, default=0.0)
+
+    impressions = Column(BigInteger, default=0)
+    clicks = Column(BigInteger, default=0)
+    conversions = Column(BigInteger, default=0)
+    reach = Column(BigInteger, default=0)
+
+    total_orders = Column(BigInteger, default=0)
+    completed_orders = Column(BigInteger, default=0)
+    cancelled_orders = Column(BigInteger, default=0)
+    refunded_orders = Column(BigInteger, default=0)
+    bomb_orders = Column(BigInteger, default=0)
+    unique_skus_sold = Column(BigInteger, default=0)
+    total_quantity_sold = Column(BigInteger, default=0)
+
+    total_customers = Column(BigInteger, default=0)
+    new_customers = Column(BigInteger, default=0)
+    returning_customers = Column(BigInteger, default=0)
+
+    # Tổng thời gian xử lý / giao hàng có trọng số số đơn (avg_*_time * total_orders) -> trung bình có trọng số
+    weighted_processing_time = Column(Float, default=0.0)
+    weighted_shipping_time = Column(Float, default=0.0)
+    # Chu kỳ mua lại * số khách quay lại, tỷ lệ rời bỏ * tổng khách (trọng số như kpi_utils.aggregate_data_points)
+    weighted_repurchase_cycle = Column(Float, default=0.0)
+    weighted_churn = Column(Float, default=0.0)
+    # Trung bình đơn giản dự phòng khi tổng trọng số = 0 (vd. daily_analytics không có total_customers):
+    # tổng giá trị > 0 và số ngày có giá trị > 0
+    repurchase_cycle_sum = Column(Float, default=0.0)
+    repurchase_cycle_days = Column(BigInteger, default=0)
+    churn_rate_sum = Column(Float, default=0.0)
+    churn_rate_days = Column(BigInteger, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('brand_id', 'source', 'date', name='uq_daily_stat_cumulative'),
+    )
+
 class Customer(Base):
     __tablename__ = "customers"
     id = Column(Integer, primary_key=True, index=True)
@@ -310,4 +426,25 @@ class ImportLog(Base):
     log = Column(String, nullable=True)
     created_at = Column(DateTime, default=func.now())
 
-    owner_brand = relationship("Brand", back_populates="import_logs")
\ No newline at end of file
+    owner_brand = relationship("Brand", back_populates="import_logs")
+
+class StatsDirtyDay(Base):
+    """
+    Sổ ghi các ngày cần tính lại KPI (DailyStat / DailyAnalytics).
+    Importer / thao tác xóa ghi vào đây CÙNG transaction với thay đổi dữ liệu thô;
+    job drain (giữ khóa tính lại của brand) đọc các dòng rồi chỉ xóa chúng khi tính lại thành công.
+    """
+    __tablename__ = "stats_dirty_days"
+
+    id = Column(Integer, primary_key=True, index=True)
+    brand_id = Column(Integer, ForeignKey("brands.id", ondelete="CASCADE"), nullable=False, index=True)
+    source = Column(String, nullable=True)   # NULL = mọi nguồn
+    day = Column(Date, nullable=True)        # NULL = tính lại toàn bộ brand
+    reason = Column(String, nullable=False)  # import, delete, manual, resume...
+    enqueued_at = Column(DateTime, default=func.now(), nullable=False)
+
+    owner_brand = relationship("Brand", back_populates="stats_dirty_days")
+
+    __table_args__ = (
+        Index('ix_stats_dirty_days_brand_enqueued', 'brand_id', 'enqueued_at'),
+    )
@@ -0,0 +1,138 @@
+# FILE: Backend/app/partitioning.py
+
+"""
+Phân vùng theo tháng (PARTITION BY RANGE) cho các bảng dữ liệu thô dùng chung giữa các brand.
+
+- orders   : phân vùng theo order_date
+- revenues : phân vùng theo transaction_date
+
+Mỗi tháng một partition `<bảng>_pYYYY_MM`, cộng thêm partition DEFAULT làm lưới an toàn
+(dòng rơi vào tháng chưa có partition vẫn ghi được, chỉ là không được prune).
+Partition CHỈ được tạo bởi job beat, trước PARTITION_MONTHS_AHEAD tháng; dữ liệu của tháng cũ
+chưa có partition (import dữ liệu lịch sử) nằm ở DEFAULT.
+
+Lưu ý: CREATE TABLE ... PARTITION OF cần khóa ACCESS EXCLUSIVE trên bảng cha -> chạy trên kết nối
+AUTOCOMMIT riêng với lock_timeout ngắn: nếu phải xếp hàng sau một transaction dài (tính lại, import...)
+thì bỏ cuộc thay vì chặn mọi truy vấn đọc/ghi khác đang xếp hàng sau nó; lần chạy sau sẽ thử lại.
+"""
+
+import os
+import time
+from datetime import date, datetime
+from typing import Dict, Iterable, List
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# SQLSTATE khi hết lock_timeout
+LOCK_NOT_AVAILABLE = "55P03"
+
+# Bảng phân vùng -> cột khóa phân vùng
+PARTITIONED_TABLES: Dict[str, str] = {
+    "orders": "order_date",
+    "revenues": "transaction_date",
+}
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+# Thời gian tối đa chờ khóa bảng cha cho mỗi lần CREATE, số lần thử lại và khoảng nghỉ giữa các lần
+PARTITION_LOCK_TIMEOUT_MS = int(os.getenv("PARTITION_LOCK_TIMEOUT_MS", 2000))
+PARTITION_LOCK_RETRIES = int(os.getenv("PARTITION_LOCK_RETRIES", 3))
+PARTITION_LOCK_RETRY_DELAY = float(os.getenv("PARTITION_LOCK_RETRY_DELAY", 5))
+
+def month_start(day) -> date:
+    if isinstance(day, datetime):
+        day = day.date()
+    return day.replace(day=1)
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + (month.month - 1) + count
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+def months_between(start, end) -> List[date]:
+    """Danh sách ngày đầu tháng từ tháng của `start` tới tháng của `end` (bao gồm cả hai)."""
+    months, current, last = [], month_start(start), month_start(end)
+    while current <= last:
+        months.append(current)
+        current = add_months(current, 1)
+    return months
+
+def get_existing_partitions(conn, table: str) -> set:
+    rows = conn.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+    """), {"table": table})
+    return {row[0] for row in rows}
+
+def _create_partition(conn, table: str, name: str, month: date) -> bool:
+    """Một lần CREATE ... PARTITION OF, thử lại khi hết lock_timeout. True nếu tạo được."""
+    statement = text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+    for attempt in range(1, PARTITION_LOCK_RETRIES + 1):
+        try:
+            conn.execute(statement)
+            return True
+        except OperationalError as e:
+            # lock_not_available: bảng cha đang bị transaction khác giữ -> nghỉ rồi thử lại, hết lượt thì bỏ qua
+            if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt == PARTITION_LOCK_RETRIES:
+                print(f"WARNING: Không tạo được partition {name}: {e}")
+                return False
+            time.sleep(PARTITION_LOCK_RETRY_DELAY)
+        except Exception as e:
+            print(f"WARNING: Không tạo được partition {name}: {e}")
+            return False
+    return False
+
+def ensure_monthly_partitions(bind, table: str, months: Iterable[date]) -> List[str]:
+    """
+    Tạo partition còn thiếu cho các tháng trong `months` (bind: Engine). Trả về tên các partition vừa tạo.
+    Không raise: tháng nào tạo lỗi (hết lượt chờ khóa, partition DEFAULT đã chứa dòng của tháng đó...)
+    chỉ ghi cảnh báo.
+    """
+    if table not in PARTITIONED_TABLES:
+        raise ValueError(f"Bảng '{table}' không được phân vùng theo tháng.")
+
+    wanted = sorted({month_start(month) for month in months})
+    if not wanted:
+        return []
+
+    created = []
+    with bind.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(text(f"SET lock_timeout = {PARTITION_LOCK_TIMEOUT_MS}"))
+        existing = get_existing_partitions(conn, table)
+        for month in wanted:
+            name = partition_name(table, month)
+            if name in existing:
+                continue
+            if _create_partition(conn, table, name, month):
+                created.append(name)
+
+    if created:
+        print(f"PARTITION: Đã tạo {len(created)} partition cho bảng {table}: {', '.join(created)}")
+    return created
+
+def ensure_future_partitions(bind, months_ahead: int = None) -> Dict[str, List[str]]:
+    """Tháng hiện tại + `months_ahead` tháng tới cho mọi bảng phân vùng (job beat hằng ngày)."""
+    months_ahead = PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    current = month_start(date.today())
+    months = [add_months(current, offset) for offset in range(months_ahead + 1)]
+    return {table: ensure_monthly_partitions(bind, table, months) for table in PARTITIONED_TABLES}
+
+# Không gian khóa advisory (dạng 2 số nguyên) cho việc ghi order_code của một brand
+ORDER_CODE_LOCK_SPACE = 4501
+
+def lock_brand_order_codes(db, brand_id: int):
+    """
+    Khóa advisory theo brand tới hết transaction của `db`. UNIQUE trên bảng phân vùng phải chứa
+    order_date nên DB không còn chặn trùng order_code trong một brand: mọi luồng thêm đơn
+    (kiểm tra mã đã có -> INSERT) phải giữ khóa này để hai lần import đồng thời không cùng thêm một mã.
+    """
+    db.execute(text("SELECT pg_advisory_xact_lock(:space, :brand_id)"), {"space": ORDER_CODE_LOCK_SPACE, "brand_id": brand_id})
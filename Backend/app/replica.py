@@ -0,0 +1,150 @@
+# FILE: Backend/app/replica.py
+
+"""
+Định tuyến phiên đọc sang read replica (REPLICA_DATABASE_URL) cho các endpoint / task chỉ đọc.
+
+Đọc-sau-ghi nhất quán theo brand: sau mỗi lần ghi (import, xóa, tính toán lại, nhân bản...)
+gọi `pin_brand_to_primary(db, brand_id)` để lưu WAL LSN hiện tại của primary vào Redis.
+Khi brand đang bị "ghim", phiên đọc chỉ được chuyển sang replica nếu replica đã replay tới LSN đó
+(pg_last_wal_replay_lsn); nếu chưa (hoặc replica lỗi) thì đọc từ primary.
+
+Khi chạy local, db-replica trong docker-compose là hot standby streaming từ primary
+(pg_basebackup -R). Một Postgres không ở chế độ recovery không có replay LSN -> brand vừa ghi
+luôn đọc từ primary cho tới khi ghim hết hạn (REPLICA_PIN_SECONDS).
+"""
+
+import os
+
+from sqlalchemy import text
+
+from cache import redis_client, async_redis_client
+
+# Để trống = tắt định tuyến, mọi phiên đọc dùng primary
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL") or None
+# Thời gian tối đa một brand bị ghim vào primary sau lần ghi gần nhất
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", 300))
+
+def _pin_key(brand_id: int) -> str:
+    return f"replica_pin:{brand_id}"
+
+def parse_lsn(value) -> int:
+    """'16/B374D848' -> số nguyên so sánh được (None nếu không có LSN)."""
+    if not value:
+        return None
+    high, low = str(value).split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+def pin_brand_to_primary(db, brand_id: int):
+    """
+    Gọi SAU khi commit dữ liệu của brand: ghi nhớ LSN hiện tại của primary. Không bao giờ raise.
+    Chỉ nâng LSN đã lưu (không hạ) - race nhỏ giữa hai lần ghi đồng thời chấp nhận được vì
+    ghim luôn có TTL.
+    """
+    if not REPLICA_DATABASE_URL:
+        return
+    try:
+        lsn = db.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+        key = _pin_key(brand_id)
+        current = redis_client.get(key)
+        if current and parse_lsn(current) >= parse_lsn(lsn):
+            redis_client.expire(key, REPLICA_PIN_SECONDS)
+        else:
+            redis_client.set(key, lsn, ex=REPLICA_PIN_SECONDS)
+    except Exception as e:
+        print(f"WARNING: Không ghim được brand {brand_id} vào primary: {e}")
+
+def _replica_caught_up(pinned_lsn, replay_lsn) -> bool:
+    replay = parse_lsn(replay_lsn)
+    return replay is not None and replay >= parse_lsn(pinned_lsn)
+
+def _replica_serves_brand(replica_db, brand_id: int) -> bool:
+    """Replica đã theo kịp lần ghi gần nhất của brand chưa (brand không bị ghim = luôn theo kịp)."""
+    pinned_lsn = redis_client.get(_pin_key(brand_id))
+    if not pinned_lsn:
+        return True
+    replay_lsn = replica_db.execute(text("SELECT pg_last_wal_replay_lsn()::text")).scalar()
+    return _replica_caught_up(pinned_lsn, replay_lsn)
+
+def open_read_session(brand_id: int, primary_factory, replica_factory):
+    """
+    Mở phiên đọc cho brand: replica nếu được cấu hình và đã theo kịp lần ghi gần nhất của brand,
+    ngược lại là primary. Caller chịu trách nhiệm close() như phiên thường.
+    """
+    if replica_factory is None:
+        return primary_factory()
+
+    replica_db = replica_factory()
+    try:
+        replica_db.connection()  # Lấy kết nối ngay: replica không kết nối được -> về primary
+        if _replica_serves_brand(replica_db, brand_id):
+            return replica_db
+    except Exception as e:
+        print(f"WARNING: Replica không dùng được cho brand {brand_id}, đọc từ primary: {e}")
+    replica_db.close()
+    return primary_factory()
+
+def open_brand_read_session(lookup, primary_factory, replica_factory):
+    """
+    Như open_read_session nhưng brand chưa biết trước: `lookup(db)` tìm brand (None = không thấy)
+    ngay trên phiên đọc, nên một request chỉ giữ MỘT kết nối. Brand chưa có trên replica (vừa tạo)
+    hoặc replica chưa theo kịp -> tra lại và đọc từ primary.
+    Trả về (db, brand); caller chịu trách nhiệm close() db.
+    """
+    if replica_factory is not None:
+        replica_db = replica_factory()
+        try:
+            brand = lookup(replica_db)
+            if brand is not None and _replica_serves_brand(replica_db, brand.id):
+                return replica_db, brand
+        except Exception as e:
+            print(f"WARNING: Replica không dùng được, đọc từ primary: {e}")
+        replica_db.close()
+
+    db = primary_factory()
+    try:
+        return db, lookup(db)
+    except Exception:
+        db.close()
+        raise
+
+async def _replica_serves_brand_async(replica_db, brand_id: int) -> bool:
+    """Bản async của `_replica_serves_brand`."""
+    pinned_lsn = await async_redis_client.get(_pin_key(brand_id))
+    if not pinned_lsn:
+        return True
+    replay_lsn = (await replica_db.execute(text("SELECT pg_last_wal_replay_lsn()::text"))).scalar()
+    return _replica_caught_up(pinned_lsn, replay_lsn)
+
+async def open_read_session_async(brand_id: int, primary_factory, replica_factory):
+    """Bản async của `open_read_session` (AsyncSession, Redis async)."""
+    if replica_factory is None:
+        return primary_factory()
+
+    replica_db = replica_factory()
+    try:
+        await replica_db.connection()
+        if await _replica_serves_brand_async(replica_db, brand_id):
+            return replica_db
+    except Exception as e:
+        print(f"WARNING: Replica không dùng được cho brand {brand_id}, đọc từ primary: {e}")
+    await replica_db.close()
+    return primary_factory()
+
+async def open_brand_read_session_async(lookup, primary_factory, replica_factory):
+    """Bản async của `open_brand_read_session` (`lookup` là coroutine function)."""
+    if replica_factory is not None:
+        replica_db = replica_factory()
+        try:
+            brand = await lookup(replica_db)
+            if brand is not None and await _replica_serves_brand_async(replica_db, brand.id):
+                return replica_db, brand
+        except Exception as e:
+            print(f"WARNING: Replica không dùng được, đọc từ primary: {e}")
+        await replica_db.close()
+
+    db = primary_factory()
+    try:
+        return db, await lookup(db)
+    except Exception:
+        await db.close()
+        raise
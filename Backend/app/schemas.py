@@ -53,6 +53,15 @@ class DataRequest(BaseModel):
     request_type: str
     params: Dict[str, Any]
 
+class DashboardBundleRequest(BaseModel):
+    """Yêu cầu nhiều panel cho cùng một khoảng thời gian (1 lần đọc dữ liệu)"""
+    start_date: datetime.date
+    end_date: datetime.date
+    panels: List[str] = ["kpi_summary"]
+    source: Optional[List[str]] = None
+    interval: str = "day"
+    top_limit: int = 10
+
 # --- PRODUCT ---
 class ProductBase(BaseModel):
     sku: str
@@ -229,6 +238,13 @@ class DailyKpi(KpiBase, FinanceMetricsMixin, MarketingMetricsMixin, OperationMet
 class DailyKpiResponse(BaseModel):
     data: List[DailyKpi]
 
+class ColumnarKpiResponse(BaseModel):
+    """Dạng cột (format=columnar): series[chỉ số][i] là giá trị của ngày dates[i]"""
+    format: str = "columnar"
+    dates: List[Optional[datetime.date]] = []
+    series: Dict[str, List[Union[int, float]]] = {}
+    aggregationType: Optional[str] = None
+
 class OperationKpisResponse(OperationMetricsMixin, BreakdownMetricsMixin, ORMBase):
     platform_comparison: List[PlatformComparisonItem] = []
 
@@ -236,6 +252,24 @@ class CustomerKpisResponse(CustomerMetricsMixin, ORMBase):
     trend_data: List[DailyKpi] = []; segment_data: List[Dict[str, Any]] = []
     frequency_data: List[Dict[str, Any]] = []; previous_period: Optional[Dict[str, Any]] = {}
 
+class BundlePeriodKpis(BaseModel):
+    current: KpiSet; previous: KpiSet
+
+class BundleChartData(BaseModel):
+    current: List[KpiSet] = []; previous: List[KpiSet] = []; aggregationType: str = "day"
+
+class DashboardBundleResponse(BaseModel):
+    """Kết quả bundle: chỉ các panel được yêu cầu mới có dữ liệu"""
+    start_date: datetime.date; end_date: datetime.date
+    previous_start_date: datetime.date; previous_end_date: datetime.date
+    panels: List[str] = []
+    kpi_summary: Optional[BundlePeriodKpis] = None
+    daily_kpis_chart: Optional[BundleChartData] = None
+    operation_kpis: Optional[OperationKpisResponse] = None
+    customer_kpis: Optional[CustomerKpisResponse] = None
+    top_products: Optional[List[TopProduct]] = None
+    platform_comparison: Optional[List[PlatformComparisonItem]] = None
+
 class CustomerAnalyticsItem(OrderCountersMixin):
     """Tái sử dụng OrderCountersMixin cho danh sách khách hàng"""
     username: str
@@ -329,6 +363,59 @@ class TaskStatusResponse(BaseModel):
     data: Optional[Any] = None
     error: Optional[str] = None
 
+class QueueStats(BaseModel):
+    """Độ sâu & thời gian chờ của một hàng đợi Celery"""
+    queue: str
+    depth: int
+    tasks_started: int
+    avg_wait_ms: float
+    recent_avg_wait_ms: float
+    recent_p95_wait_ms: float
+    last_wait_ms: float
+    per_brand_limit: int
+    active_by_brand: Dict[str, int] = {}
+
+class WorkerPoolStats(BaseModel):
+    """Thời gian chờ lấy kết nối DB của worker"""
+    checkouts: int
+    slow_checkouts: int
+    avg_wait_ms: float
+    max_wait_ms: float
+    last_wait_ms: float
+    checked_out: int
+    pool_size: int
+    max_overflow: int
+
+class RecalculationProgressResponse(BaseModel):
+    """Tiến độ của lần tính toán lại toàn bộ gần nhất"""
+    status: str = "idle"  # idle | running | failed | completed
+    total_days: int = 0
+    processed_days: int = 0
+    percent: float = 0.0
+    checkpoint: Optional[datetime.date] = None
+    shards_total: int = 0
+    shards_done: int = 0
+    attempts: int = 0
+    started_at: Optional[datetime.datetime] = None
+    updated_at: Optional[datetime.datetime] = None
+    error: Optional[str] = None
+    pending: bool = False
+
+class BrandJobProgressResponse(BaseModel):
+    """Tiến độ job nền của một brand (xóa / nhân bản), xử lý theo từng bảng"""
+    status: str = "queued"  # queued | running | failed | completed
+    current_table: Optional[str] = None
+    processed_rows: int = 0
+    total_rows: int = 0
+    percent: float = 0.0
+    started_at: Optional[datetime.datetime] = None
+    updated_at: Optional[datetime.datetime] = None
+    error: Optional[str] = None
+
+class QueueStatsResponse(BaseModel):
+    queues: List[QueueStats]
+    db_pools: Dict[str, WorkerPoolStats] = {}
+
 from models import UserRole
 
 # --- USER & AUTH ---
@@ -0,0 +1,145 @@
+# FILE: Backend/app/services/async_dashboard_service.py
+
+"""
+Luồng đọc async cho các route đọc nhiều (daily-kpis, kpis/operation, kpis/customer,
+top-products, customer-map, search-suggestions).
+
+- Redis: dùng client asyncio (không chiếm thread của threadpool).
+- DB: AsyncSession (asyncpg). Các query đồng bộ sẵn có trong dashboard_service được
+  tái sử dụng qua `AsyncSession.run_sync` để giữ một nguồn logic duy nhất cho cả worker và API.
+"""
+
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+import schemas
+import kpi_utils
+from cache import async_redis_client, async_index_cache_key
+from services import dashboard_service
+from services.search_service import search_service
+
+async def get_brand_by_slug(db: AsyncSession, slug: str, owner_id: str) -> Optional[models.Brand]:
+    result = await db.execute(
+        select(models.Brand).where(
+            models.Brand.slug == slug, models.Brand.owner_id == owner_id, models.Brand.is_deleting.is_(False)
+        )
+    )
+    return result.scalars().first()
+
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+async def get_daily_kpis_for_range(
+    db: AsyncSession,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    source_list: Optional[List[str]] = None,
+    cache_ttl: int = 3600,
+    fields: Optional[List[str]] = None
+) -> List[schemas.KpiSet]:
+    """Bản async của dashboard_service.get_daily_kpis_for_range (dùng chung cache key kpi_daily)."""
+    cache_key = dashboard_service.kpi_daily_cache_key(brand_id, start_date, end_date, source_list, fields)
+
+    try:
+        cached_data = await async_redis_client.get(cache_key)
+        if cached_data:
+            return dashboard_service.decode_daily_kpis(cached_data)
+    except Exception as e:
+        print(f"WARNING: Redis Error: {e}")
+
+    strategy, clean_sources = kpi_utils.normalize_source_strategy(source_list)
+    stat_rows, analytics_rows = await db.run_sync(
+        dashboard_service._load_daily_rows, brand_id, start_date, end_date, strategy, clean_sources, fields
+    )
+    result_data = dashboard_service._build_daily_kpis(start_date, end_date, strategy, stat_rows, analytics_rows)
+
+    try:
+        await async_redis_client.setex(
+            cache_key,
+            cache_ttl,
+            dashboard_service.encode_daily_kpis(result_data)
+        )
+        await async_index_cache_key(brand_id, cache_key, start_date, end_date, source_list, ttl_seconds=cache_ttl)
+    except Exception as e:
+        print(f"WARNING: Redis Set Error: {e}")
+
+    return result_data
+
+async def get_aggregated_operation_kpis(
+    db: AsyncSession,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    source_list: Optional[List[str]] = None
+) -> schemas.OperationKpisResponse:
+    fields = dashboard_service.kpi_endpoint_fields("operation_kpis", source_list)
+    daily_kpis = await get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list, fields=fields)
+    final_kpis_obj = dashboard_service._aggregate_daily_kpis(daily_kpis, start_date, end_date)
+    if fields is not None:
+        counters = await db.run_sync(dashboard_service.sum_json_counters, brand_id, start_date, end_date)
+        final_kpis_obj = final_kpis_obj.model_copy(update=counters)
+    platform_comparison = await db.run_sync(
+        dashboard_service.get_kpis_by_platform, brand_id, start_date, end_date, source_list
+    )
+    return dashboard_service._build_operation_kpis_response(final_kpis_obj, platform_comparison)
+
+async def get_aggregated_customer_kpis(
+    db: AsyncSession,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    source_list: Optional[List[str]] = None
+) -> schemas.CustomerKpisResponse:
+    prev_start_date, prev_end_date = dashboard_service._previous_period(start_date, end_date)
+    fields = dashboard_service.kpi_endpoint_fields("customer_kpis", source_list)
+    daily_kpis = await get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list, fields=fields)
+    previous_kpis = await db.run_sync(
+        dashboard_service.get_range_kpis, brand_id, prev_start_date, prev_end_date, source_list
+    )
+
+    frequency_distribution = None
+    if fields is dashboard_service.CUSTOMER_SQL_FIELDS:
+        counters = await db.run_sync(
+            dashboard_service.sum_json_counters, brand_id, start_date, end_date, ["frequency_distribution"]
+        )
+        frequency_distribution = counters["frequency_distribution"]
+
+    return dashboard_service._build_customer_kpis_response(
+        daily_kpis, [], start_date, end_date, prev_start_date, prev_end_date,
+        frequency_distribution=frequency_distribution, previous_kpis=previous_kpis
+    )
+
+async def get_top_selling_products(
+    db: AsyncSession,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    limit: int = 10,
+    source_list: Optional[List[str]] = None
+) -> List[schemas.TopProduct]:
+    return await db.run_sync(
+        dashboard_service.get_top_selling_products, brand_id, start_date, end_date, limit, source_list
+    )
+
+async def get_aggregated_location_distribution(
+    db: AsyncSession,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    status_filter: Optional[List[str]] = None,
+    source_list: Optional[List[str]] = None
+):
+    return await db.run_sync(
+        lambda session: dashboard_service.get_aggregated_location_distribution(
+            session, brand_id, start_date, end_date, status_filter=status_filter, source_list=source_list
+        )
+    )
+
+async def suggest_entities(db: AsyncSession, brand_id: int, query: str, limit: int = 10):
+    return await db.run_sync(lambda session: search_service.suggest_entities(session, brand_id, query, limit))
@@ -1,17 +1,20 @@
 from datetime import date, timedelta, datetime
 from typing import List, Dict, Any, Optional
 import json
+import hashlib
 from decimal import Decimal
 from collections import defaultdict
 
-from sqlalchemy import func
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Session
 import pandas as pd
 
 import models
 import schemas
 import kpi_utils
-from cache import redis_client
+from services import data_service
+from cache import redis_client, index_cache_key
 from province_centroids import PROVINCE_CENTROIDS
 
 # Helper xử lý JSON serialize cho Date và Decimal
@@ -28,15 +31,19 @@ def get_aggregated_kpis_chart(
     start_date: date, 
     end_date: date, 
     source_list: Optional[List[str]] = None,
-    interval: str = 'day'
+    interval: str = 'day',
+    fields: Optional[List[str]] = None
 ) -> List[schemas.KpiSet]:
     """
     Lấy dữ liệu KPI biểu đồ, hỗ trợ gom nhóm theo Tuần/Tháng ngay tại Backend.
     Giúp giảm tải cho Frontend khi xem khoảng thời gian dài.
     """
     # 1. Lấy dữ liệu thô theo ngày
-    daily_data_objs = get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list)
-    
+    daily_data_objs = get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list, fields=fields)
+    return _group_daily_kpis(daily_data_objs, interval)
+
+def _group_daily_kpis(daily_data_objs: List[schemas.KpiSet], interval: str = 'day') -> List[schemas.KpiSet]:
+    """Gom nhóm KpiSet theo ngày thành Tuần/Tháng (interval='day' trả về nguyên bản)."""
     if not daily_data_objs or interval == 'day':
         return daily_data_objs
 
@@ -81,74 +88,262 @@ def get_aggregated_kpis_chart(
     
     return results
 
-def get_daily_kpis_for_range(
-    db: Session, 
-    brand_id: int, 
-    start_date: date, 
-    end_date: date, 
-    source_list: Optional[List[str]] = None
-) -> List[schemas.KpiSet]:
+# Định dạng cột (format=columnar): chỉ các chỉ số dạng số của DailyKpi (không có breakdown JSON)
+COLUMNAR_METRICS = [name for name in schemas.DailyKpi.model_fields if name != "date"]
+
+def resolve_columnar_metrics(metrics: Optional[List[str]] = None) -> List[str]:
+    """Danh sách chỉ số cần trả về (mặc định: tất cả). Raise ValueError nếu có tên không hợp lệ."""
+    if not metrics:
+        return list(COLUMNAR_METRICS)
+    unknown = [name for name in metrics if name not in COLUMNAR_METRICS]
+    if unknown:
+        raise ValueError(f"Chỉ số không hợp lệ: {', '.join(unknown)}")
+    return list(dict.fromkeys(metrics))
+
+def build_columnar_kpis(kpi_items: List[schemas.KpiSet], metrics: List[str]) -> Dict[str, Any]:
     """
-    Sử dụng chiến lược Hybrid:
-    - ALL sources -> Query bảng DailyStat.
-    - Filtered sources -> Query DailyAnalytics & Aggregate.
+    Chuyển danh sách KpiSet (mỗi ngày một object) sang dạng cột: một mảng ngày + một mảng mỗi chỉ số.
+    Không model_dump từng ngày -> không kéo theo breakdown JSON mà biểu đồ không dùng.
     """
-    
-    # 1. CHECK CACHE REDIS
-    source_key = "all"
-    if source_list:
-        source_key = "-".join(sorted(source_list))
-    
-    cache_key = f"kpi_daily:{brand_id}:{start_date}:{end_date}:{source_key}"
-    
-    try:
-        cached_data = redis_client.get(cache_key)
-        if cached_data:
-            # Parse lại thành list các đối tượng KpiSet
-            raw_list = json.loads(cached_data)
-            return [schemas.KpiSet(**item) for item in raw_list]
-    except Exception as e:
-        print(f"WARNING: Redis Error: {e}")
+    return {
+        "dates": [item.date.isoformat() if item.date else None for item in kpi_items],
+        "series": {name: [getattr(item, name) for item in kpi_items] for name in metrics},
+    }
 
-    strategy, clean_sources = kpi_utils.normalize_source_strategy(source_list)
-    
-    # Chuẩn bị khung dữ liệu cho toàn bộ dải ngày (để tránh ngày bị thiếu)
-    date_map = {} # Dict[date, schemas.KpiSet]
-    curr = start_date
-    while curr <= end_date:
-        date_map[curr] = schemas.KpiSet(date=curr)
-        curr += timedelta(days=1)
+# Projection cho bản ghi ngày: các cột JSONB (breakdown) chỉ được đọc khi panel thực sự cần
+JSON_KPI_COLUMNS = [c.name for c in models.DailyStat.__table__.columns if isinstance(c.type, JSONB)]
+SCALAR_KPI_FIELDS = [
+    name for name in schemas.KpiSet.model_fields
+    if name in models.DailyStat.__table__.columns and name not in JSON_KPI_COLUMNS and name != "date"
+]
+CUSTOMER_KPI_FIELDS = SCALAR_KPI_FIELDS + ["frequency_distribution", "customer_segment_distribution"]
+
+# Cột JSONB dạng {key: số đếm}: khi xem toàn bộ nguồn được cộng dồn trong Postgres (sum_json_counters)
+JSON_COUNTER_COLUMNS = ["hourly_breakdown", "payment_method_breakdown", "cancel_reason_breakdown", "frequency_distribution"]
+OPERATION_SQL_FIELDS = [name for name in SCALAR_KPI_FIELDS + JSON_KPI_COLUMNS if name not in JSON_COUNTER_COLUMNS]
+CUSTOMER_SQL_FIELDS = SCALAR_KPI_FIELDS + ["customer_segment_distribution"]
+
+def kpi_endpoint_fields(request_type: str, source_list: Optional[List[str]] = None) -> Optional[List[str]]:
+    """
+    Projection mà kpis/operation & kpis/customer đọc từ tầng kpi_daily (job làm nóng cache dùng chung).
+    Toàn bộ nguồn: bỏ các cột counter (đã cộng trong SQL). Lọc nguồn: gộp bằng Python như cũ.
+    """
+    strategy, _ = kpi_utils.normalize_source_strategy(source_list)
+    if strategy == kpi_utils.STRATEGY_ALL:
+        return OPERATION_SQL_FIELDS if request_type == "operation_kpis" else CUSTOMER_SQL_FIELDS
+    return None if request_type == "operation_kpis" else CUSTOMER_KPI_FIELDS
+
+def _daily_columns(model, fields: Optional[List[str]]):
+    """Cột cần SELECT: cả entity khi fields=None, ngược lại date (+ source) và các cột được yêu cầu."""
+    if fields is None:
+        return [model]
+    key_columns = ["date", "source"] if model is models.DailyAnalytics else ["date"]
+    names = key_columns + [
+        name for name in dict.fromkeys(fields)
+        if name in model.__table__.columns and name not in key_columns
+    ]
+    return [getattr(model, name) for name in names]
+
+def _projection_key(fields: Optional[List[str]]) -> str:
+    """Hậu tố cache key cho projection (rỗng = cả dòng) để không lẫn với dữ liệu đầy đủ."""
+    if fields is None:
+        return ""
+    digest = hashlib.md5(",".join(sorted(set(fields))).encode()).hexdigest()[:8]
+    return f":p{digest}"
+
+def sum_json_counters(
+    db: Session,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    columns: Optional[List[str]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Cộng dồn các cột counter JSONB của DailyStat trong [start_date, end_date] ngay trong Postgres
+    (jsonb_each + SUM ... GROUP BY key, một truy vấn UNION ALL): chỉ kết quả đã gộp đi qua mạng.
+    Tương đương kpi_utils.merge_json_counters (giá trị không phải số bị bỏ qua).
+    Trả về {tên cột: {key: tổng}}.
+    """
+    columns = [c for c in (columns or JSON_COUNTER_COLUMNS) if c in JSON_COUNTER_COLUMNS]
+    result = {column: {} for column in columns}
+    if not columns:
+        return result
 
-    # --- EXECUTE QUERY ---
+    # Tên cột lấy từ danh sách cố định JSON_COUNTER_COLUMNS (không nhận input ngoài)
+    parts = [
+        f"""
+        SELECT {index} AS col, e.key AS key, SUM((e.value #>> '{{}}')::numeric) AS total
+        FROM daily_stats d
+        CROSS JOIN LATERAL jsonb_each(
+            CASE WHEN jsonb_typeof(d.{column}) = 'object' THEN d.{column} ELSE '{{}}'::jsonb END
+        ) AS e
+        WHERE d.brand_id = :brand_id AND d.date BETWEEN :start_date AND :end_date
+          AND jsonb_typeof(e.value) = 'number'
+        GROUP BY e.key
+        """
+        for index, column in enumerate(columns)
+    ]
+    rows = db.execute(
+        text(" UNION ALL ".join(parts) + " ORDER BY col, key"),
+        {"brand_id": brand_id, "start_date": start_date, "end_date": end_date}
+    ).all()
+    for col_index, key, total in rows:
+        result[columns[col_index]][key] = int(total) if total == int(total) else float(total)
+    return result
+
+# Tổng lũy kế -> (tổng, mẫu số) của trung bình có trọng số mà calculate_derived_metrics / KpiSet cần
+_RANGE_WEIGHTED_TARGETS = {
+    "weighted_processing_time": ("_sum_processing_time", "_count_processing"),
+    "weighted_shipping_time": ("_sum_shipping_time", "_count_shipping"),
+}
+# Trung bình có trọng số lưu thẳng trên KpiSet (không qua calculate_derived_metrics),
+# tổng trọng số = 0 -> trung bình đơn giản của các ngày có giá trị (data_service.CUMULATIVE_SIMPLE_AVERAGES)
+_RANGE_WEIGHTED_AVERAGES = ["weighted_repurchase_cycle", "weighted_churn"]
+
+def _range_totals_sql() -> str:
+    columns = data_service.CUMULATIVE_COLUMNS
+    lookup = """
+        SELECT {columns} FROM daily_stat_cumulatives
+        WHERE brand_id = :brand_id AND source = s.source AND date {op} :{param}
+        ORDER BY date DESC LIMIT 1
+    """
+    totals = ", ".join(f"SUM(COALESCE(hi.{c}, 0) - COALESCE(lo.{c}, 0)) AS {c}" for c in columns)
+    return f"""
+        SELECT {totals}
+        FROM unnest(CAST(:sources AS text[])) AS s(source)
+        LEFT JOIN LATERAL ({lookup.format(columns=", ".join(columns), op="<=", param="end_date")}) hi ON true
+        LEFT JOIN LATERAL ({lookup.format(columns=", ".join(columns), op="<", param="start_date")}) lo ON true
+    """
+
+_RANGE_TOTALS_SQL = _range_totals_sql()
+
+def get_range_totals(
+    db: Session,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    source_list: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    Tổng các chỉ số cộng dồn được trong [start_date, end_date] từ bảng tổng lũy kế:
+    cum[end] - cum[trước start] cho mỗi nguồn = 2 lần đọc theo index, không phụ thuộc độ dài khoảng.
+    Trả về dict dạng kpi_utils.aggregate_data_points (gồm các biến tạm _sum_* / _count_*) để
+    đưa thẳng vào calculate_derived_metrics. Phân bố JSONB không có ở đây.
+    """
+    strategy, clean_sources = kpi_utils.normalize_source_strategy(source_list)
     if strategy == kpi_utils.STRATEGY_EMPTY:
-        pass
+        return {}
+    sources = [data_service.CUMULATIVE_SOURCE_ALL] if strategy == kpi_utils.STRATEGY_ALL else clean_sources
+
+    row = db.execute(
+        text(_RANGE_TOTALS_SQL),
+        {"brand_id": brand_id, "sources": sources, "start_date": start_date, "end_date": end_date}
+    ).first()
+    if row is None:
+        return {}
+    # SUM(bigint) trả về numeric (Decimal) -> số đếm; cột Float giữ nguyên
+    return aggregate_from_range_totals({
+        key: int(value) if isinstance(value, Decimal) else float(value)
+        for key, value in row._mapping.items() if value is not None
+    })
+
+def aggregate_from_range_totals(totals: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Chuyển tổng các cột lũy kế của một khoảng thành dict dạng kpi_utils.aggregate_data_points.
+    Churn / chu kỳ mua lại: trung bình có trọng số, trọng số = 0 thì trung bình đơn giản của các
+    (nguồn, ngày) có giá trị > 0 - cùng quy tắc dự phòng với aggregate_data_points.
+    """
+    totals = dict(totals)
+    for column, (sum_key, count_key) in _RANGE_WEIGHTED_TARGETS.items():
+        totals[sum_key] = totals.pop(column, 0)
+        totals[count_key] = totals.get("total_orders", 0)
+    for column in _RANGE_WEIGHTED_AVERAGES:
+        target, weight_key = data_service.CUMULATIVE_WEIGHTED[column]
+        sum_key, days_key = data_service.CUMULATIVE_SIMPLE_AVERAGES[target]
+        weighted, weight = totals.pop(column, 0), totals.get(weight_key, 0)
+        simple_sum, simple_days = totals.pop(sum_key, 0), totals.pop(days_key, 0)
+        if weight > 0:
+            totals[target] = weighted / weight
+        elif simple_days > 0:
+            totals[target] = simple_sum / simple_days
+        else:
+            totals[target] = 0
+    return totals
+
+def get_range_kpis(
+    db: Session,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    source_list: Optional[List[str]] = None
+) -> schemas.KpiSet:
+    """KPI tổng hợp (chỉ số vô hướng) của cả khoảng từ get_range_totals + calculate_derived_metrics."""
+    totals = get_range_totals(db, brand_id, start_date, end_date, source_list)
+    if not totals:
+        return schemas.KpiSet()
+    totals['_day_count'] = (end_date - start_date).days + 1
+    return schemas.KpiSet(**kpi_utils.calculate_derived_metrics(totals))
 
-    elif strategy == kpi_utils.STRATEGY_ALL:
+def _load_daily_rows(
+    db: Session,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    strategy: str,
+    clean_sources: List[str],
+    fields: Optional[List[str]] = None
+):
+    """
+    Đọc các bản ghi ngày (một truy vấn duy nhất) theo chiến lược nguồn.
+    Trả về (stat_rows, analytics_rows): ALL -> DailyStat, FILTERED -> DailyAnalytics.
+    fields: chỉ SELECT các cột này (Row thay vì entity, cột JSONB không được giải mã); None = cả dòng.
+    """
+    if strategy == kpi_utils.STRATEGY_ALL:
         # Query DailyStat (Nhanh, đã tính sẵn)
-        stats = db.query(models.DailyStat).filter(
+        stats = db.query(*_daily_columns(models.DailyStat, fields)).filter(
             models.DailyStat.brand_id == brand_id,
             models.DailyStat.date.between(start_date, end_date)
         ).all()
-        
-        for stat in stats:
-            # Map model object -> Pydantic KpiSet
-            kpi_obj = schemas.KpiSet.model_validate(stat)
-            date_map[stat.date] = kpi_obj
+        return stats, []
 
-    elif strategy == kpi_utils.STRATEGY_FILTERED:
-        # Query DailyAnalytics và cộng gộp theo ngày
-        analytics = db.query(models.DailyAnalytics).filter(
+    if strategy == kpi_utils.STRATEGY_FILTERED:
+        # Query DailyAnalytics (cộng gộp theo ngày ở bước sau)
+        analytics = db.query(*_daily_columns(models.DailyAnalytics, fields)).filter(
             models.DailyAnalytics.brand_id == brand_id,
             models.DailyAnalytics.date.between(start_date, end_date),
             models.DailyAnalytics.source.in_(clean_sources)
         ).all()
-        
+        return [], analytics
+
+    return [], []
+
+def _build_daily_kpis(
+    start_date: date,
+    end_date: date,
+    strategy: str,
+    stat_rows: list,
+    analytics_rows: list
+) -> List[schemas.KpiSet]:
+    """Dựng danh sách KpiSet liên tục theo ngày (ngày thiếu = 0) từ các bản ghi đã tải."""
+    # Chuẩn bị khung dữ liệu cho toàn bộ dải ngày (để tránh ngày bị thiếu)
+    date_map = {} # Dict[date, schemas.KpiSet]
+    curr = start_date
+    while curr <= end_date:
+        date_map[curr] = schemas.KpiSet(date=curr)
+        curr += timedelta(days=1)
+
+    if strategy == kpi_utils.STRATEGY_ALL:
+        for stat in stat_rows:
+            if stat.date in date_map:
+                # Map model object -> Pydantic KpiSet
+                date_map[stat.date] = schemas.KpiSet.model_validate(stat)
+
+    elif strategy == kpi_utils.STRATEGY_FILTERED:
         # Group by Date in memory
-        data_by_date = {} 
-        for record in analytics:
-            d = record.date
-            if d not in data_by_date: data_by_date[d] = []
-            data_by_date[d].append(schemas.KpiSet.model_validate(record).model_dump())
+        data_by_date = defaultdict(list)
+        for record in analytics_rows:
+            if record.date in date_map:
+                data_by_date[record.date].append(schemas.KpiSet.model_validate(record).model_dump())
             
         # Aggregate từng ngày
         for d, records in data_by_date.items():
@@ -157,15 +352,65 @@ def get_daily_kpis_for_range(
             final_metrics['date'] = d
             date_map[d] = schemas.KpiSet(**final_metrics)
 
-    result_data = [date_map[d] for d in sorted(date_map.keys())]
+    return [date_map[d] for d in sorted(date_map.keys())]
+
+def kpi_daily_cache_key(
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    source_list: Optional[List[str]] = None,
+    fields: Optional[List[str]] = None
+) -> str:
+    """Key cache kpi_daily - dùng chung cho bản sync (worker làm nóng) và bản async (route đọc)."""
+    source_key = "-".join(sorted(source_list)) if source_list else "all"
+    return f"kpi_daily:{brand_id}:{start_date}:{end_date}:{source_key}{_projection_key(fields)}"
+
+def encode_daily_kpis(kpi_items: List[schemas.KpiSet]) -> str:
+    """Lưu dạng dict để json.dumps được."""
+    return json.dumps([item.model_dump(mode='json') for item in kpi_items])
+
+def decode_daily_kpis(cached_data) -> List[schemas.KpiSet]:
+    """Parse lại thành list các đối tượng KpiSet."""
+    return [schemas.KpiSet(**item) for item in json.loads(cached_data)]
+
+def get_daily_kpis_for_range(
+    db: Session, 
+    brand_id: int, 
+    start_date: date, 
+    end_date: date, 
+    source_list: Optional[List[str]] = None,
+    cache_ttl: int = 3600,
+    fields: Optional[List[str]] = None
+) -> List[schemas.KpiSet]:
+    """
+    Sử dụng chiến lược Hybrid:
+    - ALL sources -> Query bảng DailyStat.
+    - Filtered sources -> Query DailyAnalytics & Aggregate.
+    fields: chỉ đọc các trường này (vd. SCALAR_KPI_FIELDS - không chạm cột JSONB); None = đầy đủ.
+    """
+    
+    # 1. CHECK CACHE REDIS
+    cache_key = kpi_daily_cache_key(brand_id, start_date, end_date, source_list, fields)
+    
+    try:
+        cached_data = redis_client.get(cache_key)
+        if cached_data:
+            return decode_daily_kpis(cached_data)
+    except Exception as e:
+        print(f"WARNING: Redis Error: {e}")
+
+    strategy, clean_sources = kpi_utils.normalize_source_strategy(source_list)
+    stat_rows, analytics_rows = _load_daily_rows(db, brand_id, start_date, end_date, strategy, clean_sources, fields)
+    result_data = _build_daily_kpis(start_date, end_date, strategy, stat_rows, analytics_rows)
 
     # 3. SAVE CACHE (Lưu dạng dict để json.dumps được)
     try:
         redis_client.setex(
             cache_key,
-            3600, # 1 giờ
-            json.dumps([item.model_dump(mode='json') for item in result_data])
+            cache_ttl, # Mặc định 1 giờ, cache warming dùng TTL dài hơn
+            encode_daily_kpis(result_data)
         )
+        index_cache_key(brand_id, cache_key, start_date, end_date, source_list, ttl_seconds=cache_ttl)
     except Exception as e:
         print(f"WARNING: Redis Set Error: {e}")
 
@@ -176,17 +421,25 @@ def _fetch_and_aggregate_kpis(
     brand_id: int, 
     start_date: date, 
     end_date: date, 
-    source_list: Optional[List[str]] = None
+    source_list: Optional[List[str]] = None,
+    fields: Optional[List[str]] = None
 ) -> schemas.KpiSet:
     """
     Helper function: 
     1. Lấy dữ liệu KPI theo ngày (get_daily_kpis_for_range).
     2. Cộng dồn lại thành 1 cục tổng (aggregate_data_points).
     3. Tính toán các chỉ số phái sinh (calculate_derived_metrics).
+    Caller chỉ cần chỉ số vô hướng (fields không có cột JSONB): đọc thẳng tổng lũy kế (get_range_kpis).
     """
+    if fields is not None and not set(fields) & set(JSON_KPI_COLUMNS):
+        return get_range_kpis(db, brand_id, start_date, end_date, source_list)
+
     # 1. Lấy dữ liệu Daily
-    daily_kpis = get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list)
-    
+    daily_kpis = get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list, fields=fields)
+    return _aggregate_daily_kpis(daily_kpis, start_date, end_date)
+
+def _aggregate_daily_kpis(daily_kpis: List[schemas.KpiSet], start_date: date, end_date: date) -> schemas.KpiSet:
+    """Cộng dồn danh sách KpiSet theo ngày (đã có trong bộ nhớ) thành 1 KpiSet tổng."""
     if not daily_kpis:
         # Trả về object rỗng nếu không có dữ liệu
         return schemas.KpiSet()
@@ -213,11 +466,21 @@ def get_aggregated_operation_kpis(
     Dùng cho các Card chỉ số tổng quan ở đầu Dashboard.
     """
     # Sử dụng helper function đã refactor
-    final_kpis_obj = _fetch_and_aggregate_kpis(db, brand_id, start_date, end_date, source_list)
-    
+    fields = kpi_endpoint_fields("operation_kpis", source_list)
+    final_kpis_obj = _fetch_and_aggregate_kpis(db, brand_id, start_date, end_date, source_list, fields=fields)
+    if fields is not None:
+        # Toàn bộ nguồn: các counter JSONB được cộng trong Postgres thay vì gộp từng ngày bằng Python
+        final_kpis_obj = final_kpis_obj.model_copy(update=sum_json_counters(db, brand_id, start_date, end_date))
+    platform_comparison = get_kpis_by_platform(db, brand_id, start_date, end_date, source_list)
+    return _build_operation_kpis_response(final_kpis_obj, platform_comparison)
+
+def _build_operation_kpis_response(
+    final_kpis_obj: schemas.KpiSet,
+    platform_comparison: List[schemas.PlatformComparisonItem]
+) -> schemas.OperationKpisResponse:
     # Dump ra dict để bổ sung thêm trường platform_comparison trước khi validate vào response schema
     response_data = final_kpis_obj.model_dump()
-    response_data['platform_comparison'] = get_kpis_by_platform(db, brand_id, start_date, end_date, source_list)
+    response_data['platform_comparison'] = platform_comparison
 
     return schemas.OperationKpisResponse(**response_data)
 
@@ -255,16 +518,21 @@ def get_top_selling_products(
     if not records:
         return []
 
+    # record là một tuple (top_products,), lấy phần tử đầu tiên
+    return _merge_top_products([record[0] for record in records], limit)
+
+def _merge_top_products(daily_top_lists: List[Any], limit: int = 10) -> List[schemas.TopProduct]:
+    """Cộng dồn các danh sách top_products theo ngày thành Top N theo số lượng bán."""
     # 3. Aggregate dữ liệu JSON (Cộng dồn quantity theo SKU)
     product_map = {} # SKU -> {name, total_quantity, revenue}
 
-    for record in records:
-        # record là một tuple (top_products,), lấy phần tử đầu tiên
-        daily_top = record[0]
+    for daily_top in daily_top_lists:
         if not daily_top or not isinstance(daily_top, list):
             continue
             
         for item in daily_top:
+            if hasattr(item, 'model_dump'):
+                item = item.model_dump()
             if not isinstance(item, dict): continue
             
             sku = item.get('sku')
@@ -308,7 +576,7 @@ def get_brand_details(db: Session, brand_id: int, start_date: date, end_date: da
 
     # 2. Lấy dữ liệu KPI tổng hợp (Sử dụng Helper mới)
     # Mặc định lấy ALL source cho Dashboard tổng
-    final_kpis = _fetch_and_aggregate_kpis(db, brand_id, start_date, end_date, source_list=None)
+    final_kpis = _fetch_and_aggregate_kpis(db, brand_id, start_date, end_date, source_list=None, fields=SCALAR_KPI_FIELDS)
     
     # 3. Gán KPI vào object Brand (để Pydantic serialize)
     setattr(brand, 'kpis', final_kpis)
@@ -357,7 +625,37 @@ def get_kpis_by_platform(
         query = query.filter(models.DailyAnalytics.source.in_(clean_sources))
 
     results = query.group_by(models.DailyAnalytics.source).all()
-    
+    return _build_platform_comparison([row._asdict() for row in results])
+
+def _platform_rows_from_analytics(analytics_rows: list) -> List[Dict[str, Any]]:
+    """Tương đương phần GROUP BY source của get_kpis_by_platform, nhưng tính trên bản ghi đã tải."""
+    sums = {}
+    for record in analytics_rows:
+        row = sums.setdefault(record.source, {
+            'source': record.source, 'netRevenue': 0, 'gmv': 0, 'profit': 0, 'totalCost': 0,
+            'adSpend': 0, 'cogs': 0, 'executionCost': 0, 'completedOrders': 0, 'totalOrders': 0,
+            'cancelledOrders': 0, 'refundedOrders': 0, 'bombOrders': 0,
+            'weighted_proc_time': 0, 'weighted_ship_time': 0,
+        })
+        n_orders = record.total_orders or 0
+        row['netRevenue'] += record.net_revenue or 0
+        row['gmv'] += record.gmv or 0
+        row['profit'] += record.profit or 0
+        row['totalCost'] += record.total_cost or 0
+        row['adSpend'] += record.ad_spend or 0
+        row['cogs'] += record.cogs or 0
+        row['executionCost'] += record.execution_cost or 0
+        row['completedOrders'] += record.completed_orders or 0
+        row['totalOrders'] += n_orders
+        row['cancelledOrders'] += record.cancelled_orders or 0
+        row['refundedOrders'] += record.refunded_orders or 0
+        row['bombOrders'] += record.bomb_orders or 0
+        row['weighted_proc_time'] += (record.avg_processing_time or 0) * n_orders
+        row['weighted_ship_time'] += (record.avg_shipping_time or 0) * n_orders
+    return list(sums.values())
+
+def _build_platform_comparison(rows: List[Dict[str, Any]]) -> List[schemas.PlatformComparisonItem]:
+    """Dựng bảng so sánh sàn (kèm dòng 'Tổng cộng') từ các dòng tổng theo source."""
     final_data = []
     total_summary_dict = {
         'platform': 'Tổng cộng',
@@ -373,28 +671,28 @@ def get_kpis_by_platform(
     total_weighted_proc = 0
     total_weighted_ship = 0
     
-    for row in results:
-        source = row.source or "Unknown"
-        n_orders = row.totalOrders or 0
+    for row in rows:
+        source = row['source'] or "Unknown"
+        n_orders = row['totalOrders'] or 0
         
         # Tính Average Time (Weighted)
-        avg_proc = (row.weighted_proc_time / n_orders) if n_orders > 0 else 0
-        avg_ship = (row.weighted_ship_time / n_orders) if n_orders > 0 else 0
+        avg_proc = ((row['weighted_proc_time'] or 0) / n_orders) if n_orders > 0 else 0
+        avg_ship = ((row['weighted_ship_time'] or 0) / n_orders) if n_orders > 0 else 0
         
         item_dict = {
             'platform': source.capitalize(),
-            'net_revenue': float(row.netRevenue or 0),
-            'gmv': float(row.gmv or 0),
-            'profit': float(row.profit or 0),
-            'total_cost': float(row.totalCost or 0),
-            'ad_spend': float(row.adSpend or 0),
-            'cogs': float(row.cogs or 0),
-            'execution_cost': float(row.executionCost or 0),
-            'completed_orders': int(row.completedOrders or 0),
-            'total_orders': int(row.totalOrders or 0),
-            'cancelled_orders': int(row.cancelledOrders or 0),
-            'refunded_orders': int(row.refundedOrders or 0),
-            'bomb_orders': int(row.bombOrders or 0),
+            'net_revenue': float(row['netRevenue'] or 0),
+            'gmv': float(row['gmv'] or 0),
+            'profit': float(row['profit'] or 0),
+            'total_cost': float(row['totalCost'] or 0),
+            'ad_spend': float(row['adSpend'] or 0),
+            'cogs': float(row['cogs'] or 0),
+            'execution_cost': float(row['executionCost'] or 0),
+            'completed_orders': int(row['completedOrders'] or 0),
+            'total_orders': int(row['totalOrders'] or 0),
+            'cancelled_orders': int(row['cancelledOrders'] or 0),
+            'refunded_orders': int(row['refundedOrders'] or 0),
+            'bomb_orders': int(row['bombOrders'] or 0),
             'avg_processing_time': float(avg_proc),
             'avg_shipping_time': float(avg_ship)
         }
@@ -411,8 +709,8 @@ def get_kpis_by_platform(
                 total_summary_dict[k] += item_dict[k]
         
         # Cộng dồn trọng số thời gian cho tổng
-        total_weighted_proc += (row.weighted_proc_time or 0)
-        total_weighted_ship += (row.weighted_ship_time or 0)
+        total_weighted_proc += (row['weighted_proc_time'] or 0)
+        total_weighted_ship += (row['weighted_ship_time'] or 0)
                 
     # Tính lại tỷ lệ tổng
     total_summary_dict['roi'] = (total_summary_dict['profit'] / total_summary_dict['total_cost']) if total_summary_dict['total_cost'] > 0 else 0
@@ -470,20 +768,52 @@ def get_aggregated_customer_kpis(
     """
     Service lấy KPI Khách hàng tổng hợp và dữ liệu cho các biểu đồ CustomerPage.
     """
-    # 1. Lấy dữ liệu Aggregate hiện tại (KPI Card & Segment Data)
-    aggregated_obj = _fetch_and_aggregate_kpis(db, brand_id, start_date, end_date, source_list)
-    aggregated_dict = aggregated_obj.model_dump()
-    
-    # Lấy thêm dữ liệu Daily để vẽ biểu đồ Trend
-    daily_kpis = get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list)
+    # 1. Dữ liệu ngày chỉ cần cho kỳ hiện tại (KPI Card, Trend); kỳ trước (Comparison) chỉ là tổng -> tổng lũy kế
+    prev_start_date, prev_end_date = _previous_period(start_date, end_date)
+    fields = kpi_endpoint_fields("customer_kpis", source_list)
+    daily_kpis = get_daily_kpis_for_range(db, brand_id, start_date, end_date, source_list, fields=fields)
+    previous_kpis = get_range_kpis(db, brand_id, prev_start_date, prev_end_date, source_list)
 
-    # --- 2.1 Tính toán dữ liệu kỳ trước (Comparison) ---
+    # Toàn bộ nguồn: phân bố tần suất mua của kỳ hiện tại được cộng trong Postgres
+    frequency_distribution = None
+    if fields is CUSTOMER_SQL_FIELDS:
+        frequency_distribution = sum_json_counters(
+            db, brand_id, start_date, end_date, ["frequency_distribution"]
+        )["frequency_distribution"]
+
+    return _build_customer_kpis_response(
+        daily_kpis, [], start_date, end_date, prev_start_date, prev_end_date,
+        frequency_distribution=frequency_distribution, previous_kpis=previous_kpis
+    )
+
+def _previous_period(start_date: date, end_date: date):
+    """Kỳ so sánh: cùng độ dài, kết thúc ngay trước start_date."""
     duration = end_date - start_date
     prev_end_date = start_date - timedelta(days=1)
-    prev_start_date = prev_end_date - duration
-    
-    # Sử dụng helper mới cho kỳ trước
-    prev_aggregated_obj = _fetch_and_aggregate_kpis(db, brand_id, prev_start_date, prev_end_date, source_list)
+    return prev_end_date - duration, prev_end_date
+
+def _build_customer_kpis_response(
+    daily_kpis: List[schemas.KpiSet],
+    prev_daily_kpis: List[schemas.KpiSet],
+    start_date: date,
+    end_date: date,
+    prev_start_date: date,
+    prev_end_date: date,
+    frequency_distribution: Optional[Dict[str, int]] = None,
+    previous_kpis: Optional[schemas.KpiSet] = None
+) -> schemas.CustomerKpisResponse:
+    """
+    Tính toàn bộ panel CustomerPage từ dữ liệu ngày đã có trong bộ nhớ.
+    frequency_distribution: đã cộng sẵn (SQL) cho kỳ hiện tại; None = gộp từ dữ liệu ngày.
+    previous_kpis: tổng kỳ trước đã có sẵn (get_range_kpis); None = gộp từ prev_daily_kpis.
+    """
+    # --- 2.1 Aggregate kỳ hiện tại (KPI Card & Segment Data) và kỳ trước (Comparison) ---
+    aggregated_dict = _aggregate_daily_kpis(daily_kpis, start_date, end_date).model_dump()
+    if frequency_distribution is not None:
+        aggregated_dict['frequency_distribution'] = frequency_distribution
+    prev_aggregated_obj = previous_kpis
+    if prev_aggregated_obj is None:
+        prev_aggregated_obj = _aggregate_daily_kpis(prev_daily_kpis, prev_start_date, prev_end_date)
 
     # --- 2.2 Xử lý Frequency Data (Sử dụng Helper mới) ---
     frequency_data = _process_frequency_data(aggregated_dict.get('frequency_distribution', {}))
@@ -624,3 +954,122 @@ def _create_empty_daily_stat(date_obj):
     empty_data = schemas.KpiSet().model_dump()
     empty_data['date'] = date_obj.isoformat()
     return empty_data
+
+# ==============================================================================
+# DASHBOARD BUNDLE: 1 lần đọc dữ liệu ngày -> nhiều panel
+# ==============================================================================
+BUNDLE_PANELS = {
+    "kpi_summary", "daily_kpis_chart", "operation_kpis",
+    "customer_kpis", "top_products", "platform_comparison",
+}
+
+# Cột JSONB mà từng panel của bundle cần (None = mọi breakdown); panel không có ở đây chỉ cần cột số
+BUNDLE_PANEL_JSON_FIELDS = {
+    "daily_kpis_chart": None,
+    "operation_kpis": None,
+    "customer_kpis": ["frequency_distribution", "customer_segment_distribution"],
+    "top_products": ["top_products"],
+}
+
+def _bundle_fields(panels: List[str]) -> Optional[List[str]]:
+    """Projection cho bundle: cột số + cột JSONB của các panel được yêu cầu (None = cả dòng)."""
+    fields = list(SCALAR_KPI_FIELDS)
+    for panel in panels:
+        if panel not in BUNDLE_PANEL_JSON_FIELDS:
+            continue
+        json_fields = BUNDLE_PANEL_JSON_FIELDS[panel]
+        if json_fields is None:
+            return None
+        fields.extend(json_fields)
+    return fields
+
+def get_dashboard_bundle(
+    db: Session,
+    brand_id: int,
+    start_date: date,
+    end_date: date,
+    panels: List[str],
+    source_list: Optional[List[str]] = None,
+    interval: str = 'day',
+    top_limit: int = 10
+) -> schemas.DashboardBundleResponse:
+    """
+    Tính nhiều panel của một trang từ MỘT tập dữ liệu trong bộ nhớ:
+    - Bản ghi ngày của kỳ trước + kỳ hiện tại được đọc bằng một truy vấn duy nhất.
+    - DailyAnalytics (theo sàn) chỉ đọc thêm khi panel cần so sánh sàn mà đang xem ALL nguồn.
+    """
+    requested = [p for p in dict.fromkeys(panels or []) if p in BUNDLE_PANELS]
+    prev_start_date, prev_end_date = _previous_period(start_date, end_date)
+    strategy, clean_sources = kpi_utils.normalize_source_strategy(source_list)
+
+    # 1. Đọc dữ liệu 1 lần cho toàn bộ [prev_start_date, end_date], chỉ các cột mà panel được yêu cầu cần
+    fields = _bundle_fields(requested)
+    stat_rows, analytics_rows = _load_daily_rows(db, brand_id, prev_start_date, end_date, strategy, clean_sources, fields)
+
+    needs_platform = any(p in requested for p in ("operation_kpis", "platform_comparison"))
+    platform_source_rows = [r for r in analytics_rows if r.date >= start_date]
+    if needs_platform and strategy == kpi_utils.STRATEGY_ALL:
+        # DailyStat không có chiều source -> đọc DailyAnalytics của kỳ hiện tại (1 truy vấn, chỉ cột số)
+        platform_source_rows = db.query(*_daily_columns(models.DailyAnalytics, SCALAR_KPI_FIELDS)).filter(
+            models.DailyAnalytics.brand_id == brand_id,
+            models.DailyAnalytics.date.between(start_date, end_date)
+        ).all()
+
+    # 2. Dựng dữ liệu ngày trong bộ nhớ rồi tách kỳ hiện tại / kỳ trước
+    all_daily = _build_daily_kpis(prev_start_date, end_date, strategy, stat_rows, analytics_rows)
+    daily_kpis = [item for item in all_daily if item.date >= start_date]
+    prev_daily_kpis = [item for item in all_daily if item.date <= prev_end_date]
+
+    current_agg = None
+    def current_aggregate():
+        nonlocal current_agg
+        if current_agg is None:
+            current_agg = _aggregate_daily_kpis(daily_kpis, start_date, end_date)
+        return current_agg
+
+    platform_comparison = None
+    def platform_data():
+        nonlocal platform_comparison
+        if platform_comparison is None:
+            platform_comparison = _build_platform_comparison(_platform_rows_from_analytics(platform_source_rows))
+        return platform_comparison
+
+    # 3. Tính từng panel được yêu cầu
+    response = schemas.DashboardBundleResponse(
+        start_date=start_date, end_date=end_date,
+        previous_start_date=prev_start_date, previous_end_date=prev_end_date,
+        panels=requested
+    )
+
+    if "kpi_summary" in requested:
+        response.kpi_summary = schemas.BundlePeriodKpis(
+            current=current_aggregate(),
+            previous=_aggregate_daily_kpis(prev_daily_kpis, prev_start_date, prev_end_date)
+        )
+
+    if "daily_kpis_chart" in requested:
+        response.daily_kpis_chart = schemas.BundleChartData(
+            current=_group_daily_kpis(daily_kpis, interval),
+            previous=_group_daily_kpis(prev_daily_kpis, interval),
+            aggregationType=interval
+        )
+
+    if "operation_kpis" in requested:
+        response.operation_kpis = _build_operation_kpis_response(current_aggregate(), platform_data())
+
+    if "platform_comparison" in requested:
+        response.platform_comparison = platform_data()
+
+    if "customer_kpis" in requested:
+        response.customer_kpis = _build_customer_kpis_response(
+            daily_kpis, prev_daily_kpis, start_date, end_date, prev_start_date, prev_end_date
+        )
+
+    if "top_products" in requested:
+        if strategy == kpi_utils.STRATEGY_FILTERED:
+            top_lists = [r.top_products for r in analytics_rows if r.date >= start_date]
+        else:
+            top_lists = [r.top_products for r in stat_rows if r.date >= start_date]
+        response.top_products = _merge_top_products(top_lists, top_limit)
+
+    return response
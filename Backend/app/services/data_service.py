@@ -1,11 +1,13 @@
-from datetime import date
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from datetime import date, datetime, timedelta
+from sqlalchemy.orm import Session, selectinload, aliased
+from sqlalchemy import func, distinct, select, insert, delete, literal, String, text
 import traceback
 
 import kpi_utils
 import models
-from cache import redis_client
+import partitioning
+import replica
+from cache import redis_client, evict_cache_for_dates
 
 def clear_brand_cache(brand_id: int):
     """
@@ -23,6 +25,11 @@ def clear_brand_cache(brand_id: int):
         # Quét cache kpi daily
         for key in redis_client.scan_iter(f"kpi_daily:{brand_id}:*"):
             cache_keys_to_delete.append(key)
+
+        # Index theo tháng (dùng cho xóa chọn lọc) cũng không còn giá trị
+        for key in redis_client.scan_iter(f"cache_idx:{brand_id}:*"):
+            cache_keys_to_delete.append(key)
+        cache_keys_to_delete.append(f"cache_idx_meta:{brand_id}")
         
         if cache_keys_to_delete:
             redis_client.delete(*cache_keys_to_delete)
@@ -30,75 +37,131 @@ def clear_brand_cache(brand_id: int):
     except Exception as e:
         print(f"WARNING: Redis clear cache failed: {e}")
 
-def update_daily_stats(db: Session, brand_id: int, target_date: date):
+def invalidate_brand_cache(brand_id: int, affected_dates, source: str = None):
+    """
+    Xóa chọn lọc: chỉ các cache key có khoảng thời gian giao với affected_dates
+    và bộ lọc nguồn bao gồm `source`. Fallback về xóa toàn bộ nếu Redis index lỗi.
+    """
+    if not affected_dates:
+        return
+    try:
+        evicted = evict_cache_for_dates(brand_id, affected_dates, source)
+        print(f"INFO: Evicted {evicted} cache keys for brand_id {brand_id} (source={source or 'all'}).")
+    except Exception as e:
+        print(f"WARNING: Date-scoped cache eviction failed ({e}). Falling back to full clear.")
+        clear_brand_cache(brand_id)
+
+def order_date_in_range(start_date: date, end_date: date = None):
+    """
+    Điều kiện order_date thuộc [start_date, end_date] dạng khoảng nửa mở trên chính cột
+    (thay cho func.date(order_date)) -> dùng được index và planner prune được partition theo tháng.
+    """
+    end_date = end_date or start_date
+    return (
+        (models.Order.order_date >= datetime.combine(start_date, datetime.min.time())) &
+        (models.Order.order_date < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    )
+
+def _upsert_kpi_entry(db: Session, model_class, brand_id: int, target_date: date, data_subset, source=None, history=None):
+    """
+    Xử lý logic chung cho DailyStat / DailyAnalytics: Kiểm tra rỗng -> Xóa hoặc Tính toán & Upsert.
+    """
+    s_orders, s_revenues, s_marketing, s_codes, s_financials = data_subset
+
+    filters = [model_class.brand_id == brand_id, model_class.date == target_date]
+    if source and hasattr(model_class, 'source'):
+        filters.append(model_class.source == source)
+
+    # A. Logic Xóa: Nếu không có dữ liệu -> Xóa bản ghi cũ (nếu có) và Return
+    if not s_orders and not s_revenues and not s_marketing:
+        existing_entry = db.query(model_class).filter(*filters).first()
+        if existing_entry:
+            db.delete(existing_entry)
+        return
+
+    # B. Logic Tính toán: Nếu có dữ liệu
+    kpis = kpi_utils.calculate_daily_kpis(
+        s_orders, s_revenues, s_marketing, 
+        s_codes, target_date, db_session=db,
+        brand_id=brand_id, source=source, history=history,
+        order_financials=s_financials
+    )
+
+    # C. Logic Upsert (Thêm mới hoặc Cập nhật)
+    _apply_kpis(db, model_class, brand_id, target_date, kpis, filters, source=source)
+
+def _apply_kpis(db: Session, model_class, brand_id: int, target_date: date, kpis: dict, filters: list, source=None):
+    entry = db.query(model_class).filter(*filters).first()
+
+    if not entry:
+        entry = model_class(brand_id=brand_id, date=target_date)
+        if source and hasattr(model_class, 'source'):
+            entry.source = source
+        db.add(entry)
+        db.flush()
+
+    if kpis:
+        for key, value in kpis.items():
+            if hasattr(entry, key):
+                setattr(entry, key, value)
+        db.add(entry)
+
+def _load_day_financials(db: Session, brand_id: int, target_date: date, source: str = None):
+    """
+    Dòng revenues (cho nhật ký tài chính) và order_financials (số liệu đã cộng theo đơn)
+    của các đơn đặt trong ngày - join với orders theo (brand_id, order_code).
+    """
+    day_orders = (models.Order.brand_id == brand_id) & (order_date_in_range(target_date))
+    if source:
+        day_orders = day_orders & (models.Order.source == source)
+
+    revenue_q = db.query(models.Revenue).join(
+        models.Order,
+        (models.Order.brand_id == models.Revenue.brand_id) & (models.Order.order_code == models.Revenue.order_code)
+    ).filter(models.Revenue.brand_id == brand_id, day_orders)
+    if source:
+        revenue_q = revenue_q.filter(models.Revenue.source == source)
+
+    return revenue_q.all(), _load_day_order_financials(db, brand_id, target_date, source=source)
+
+def _load_day_order_financials(db: Session, brand_id: int, target_date: date, source: str = None):
+    """order_financials của các đơn đặt trong ngày (source=None: mọi nguồn)."""
+    day_orders = (models.Order.brand_id == brand_id) & (order_date_in_range(target_date))
+    if source:
+        day_orders = day_orders & (models.Order.source == source)
+    return db.query(models.OrderFinancial).join(
+        models.Order,
+        (models.Order.brand_id == models.OrderFinancial.brand_id) & (models.Order.order_code == models.OrderFinancial.order_code)
+    ).filter(models.OrderFinancial.brand_id == brand_id, day_orders).all()
+
+def update_daily_stats(db: Session, brand_id: int, target_date: date, history=None, source: str = None):
     """
     Worker function: Tính toán lại KPI cho một ngày cụ thể và lưu vào DB.
     Đã được tối ưu hóa (Refactored) để dùng chung logic cho cả DailyStat và DailyAnalytics.
+    history: CustomerHistorySnapshot nạp sẵn cho shard (tính toán lại song song), None = query trực tiếp.
+    source: chỉ tính lại DailyAnalytics của nguồn này, DailyStat được gộp từ các dòng DailyAnalytics
+            (xem update_daily_stats_for_source).
     """
+    if source:
+        return update_daily_stats_for_source(db, brand_id, target_date, source, history=history)
+
     # 1. Lấy dữ liệu thô
     marketing_spends = db.query(models.MarketingSpend).filter(
         models.MarketingSpend.brand_id == brand_id,
         models.MarketingSpend.date == target_date
     ).all()
 
-    orders_created_today = db.query(models.Order).filter(
+    # Dòng sản phẩm (top sản phẩm, SKU phân biệt) nạp kèm bằng một query IN thay vì lazy-load từng đơn
+    orders_created_today = db.query(models.Order).options(selectinload(models.Order.items)).filter(
         models.Order.brand_id == brand_id, 
-        func.date(models.Order.order_date) == target_date
+        order_date_in_range(target_date)
     ).all()
 
-    # Lấy Revenue liên quan (để tính KPI tài chính chính xác)
+    # Lấy Revenue + tổng hợp tài chính của các đơn trong ngày (join theo order_code, không truyền danh sách IN)
     created_today_codes = {o.order_code for o in orders_created_today}
-    revenues = []
+    revenues, financials = [], []
     if created_today_codes:
-        revenues = db.query(models.Revenue).filter(
-            models.Revenue.brand_id == brand_id,
-            models.Revenue.order_code.in_(created_today_codes)
-        ).all()
-
-    # === HELPER FUNCTION: XỬ LÝ LOGIC CHUNG (DRY) ===
-    def process_kpi_entry(model_class, data_subset, source=None):
-        """
-        Hàm nội bộ xử lý logic: Kiểm tra rỗng -> Xóa hoặc Tính toán & Upsert.
-        """
-        s_orders, s_revenues, s_marketing, s_codes = data_subset
-
-        # A. Logic Xóa: Nếu không có dữ liệu -> Xóa bản ghi cũ (nếu có) và Return
-        if not s_orders and not s_revenues and not s_marketing:
-            filters = [model_class.brand_id == brand_id, model_class.date == target_date]
-            if source and hasattr(model_class, 'source'):
-                filters.append(model_class.source == source)
-            
-            existing_entry = db.query(model_class).filter(*filters).first()
-            if existing_entry:
-                db.delete(existing_entry)
-            return
-
-        # B. Logic Tính toán: Nếu có dữ liệu
-        kpis = kpi_utils.calculate_daily_kpis(
-            s_orders, s_revenues, s_marketing, 
-            s_codes, target_date, db_session=db,
-            brand_id=brand_id, source=source
-        )
-
-        # C. Logic Upsert (Thêm mới hoặc Cập nhật)
-        filters = [model_class.brand_id == brand_id, model_class.date == target_date]
-        if source and hasattr(model_class, 'source'):
-            filters.append(model_class.source == source)
-            
-        entry = db.query(model_class).filter(*filters).first()
-
-        if not entry:
-            entry = model_class(brand_id=brand_id, date=target_date)
-            if source and hasattr(model_class, 'source'):
-                entry.source = source
-            db.add(entry)
-            db.flush()
-
-        if kpis:
-            for key, value in kpis.items():
-                if hasattr(entry, key):
-                    setattr(entry, key, value)
-            db.add(entry)
+        revenues, financials = _load_day_financials(db, brand_id, target_date)
 
     # 2. Xử lý từng Source (DailyAnalytics)
     active_sources = set()
@@ -112,31 +175,129 @@ def update_daily_stats(db: Session, brand_id: int, target_date: date):
         filtered_marketing = [m for m in marketing_spends if m.source == current_source]
         filtered_orders = [o for o in orders_created_today if o.source == current_source]
         filtered_codes = {o.order_code for o in filtered_orders}
+        filtered_financials = [f for f in financials if f.order_code in filtered_codes]
 
         # Gọi hàm chung
-        process_kpi_entry(
-            models.DailyAnalytics, 
-            (filtered_orders, filtered_revenues, filtered_marketing, filtered_codes), 
-            source=current_source
+        _upsert_kpi_entry(
+            db, models.DailyAnalytics, brand_id, target_date,
+            (filtered_orders, filtered_revenues, filtered_marketing, filtered_codes, filtered_financials), 
+            source=current_source, history=history
         )
 
     # 3. Xử lý Tổng (DailyStat)
     # Gọi hàm chung với toàn bộ dữ liệu và source=None
-    process_kpi_entry(
-        models.DailyStat,
-        (orders_created_today, revenues, marketing_spends, created_today_codes),
-        source=None
+    _upsert_kpi_entry(
+        db, models.DailyStat, brand_id, target_date,
+        (orders_created_today, revenues, marketing_spends, created_today_codes, financials),
+        source=None, history=history
     )
     
     # Commit handled by caller or worker logic usually
     return True
 
+def update_daily_stats_for_source(db: Session, brand_id: int, target_date: date, source: str, history=None):
+    """
+    Tính toán lại theo nguồn: chỉ dữ liệu thô của `source` được nạp và tính lại (DailyAnalytics),
+    các nguồn khác giữ nguyên. DailyStat sau đó được gộp từ mọi dòng DailyAnalytics của ngày.
+    """
+    # 1. Lấy dữ liệu thô của riêng nguồn này
+    marketing_spends = db.query(models.MarketingSpend).filter(
+        models.MarketingSpend.brand_id == brand_id,
+        models.MarketingSpend.date == target_date,
+        models.MarketingSpend.source == source
+    ).all()
+
+    orders_created_today = db.query(models.Order).options(selectinload(models.Order.items)).filter(
+        models.Order.brand_id == brand_id,
+        models.Order.source == source,
+        order_date_in_range(target_date)
+    ).all()
+
+    created_today_codes = {o.order_code for o in orders_created_today}
+    revenues, financials = [], []
+    if created_today_codes:
+        revenues, financials = _load_day_financials(db, brand_id, target_date, source=source)
+
+    # 2. DailyAnalytics của nguồn
+    _upsert_kpi_entry(
+        db, models.DailyAnalytics, brand_id, target_date,
+        (orders_created_today, revenues, marketing_spends, created_today_codes, financials),
+        source=source, history=history
+    )
+    # Session của worker không autoflush -> đẩy thay đổi xuống trước khi đọc lại các dòng DailyAnalytics
+    db.flush()
+
+    # 3. Gộp DailyStat từ các nguồn
+    rebuild_daily_stat_from_analytics(db, brand_id, target_date, history=history)
+    return True
+
+def rebuild_daily_stat_from_analytics(db: Session, brand_id: int, target_date: date, history=None):
+    """
+    Dựng DailyStat của một ngày bằng cách gộp các dòng DailyAnalytics (kpi_utils.aggregate_data_points).
+    Những gì không cộng được giữa các nguồn được tính lại trên toàn bộ đơn của ngày (không nạp lại
+    revenues): khách / SKU phân biệt, top sản phẩm, phân bổ tần suất mua, phân khúc khách và churn.
+    """
+    analytics_rows = db.query(models.DailyAnalytics).filter(
+        models.DailyAnalytics.brand_id == brand_id,
+        models.DailyAnalytics.date == target_date
+    ).all()
+
+    filters = [models.DailyStat.brand_id == brand_id, models.DailyStat.date == target_date]
+    if not analytics_rows:
+        existing_entry = db.query(models.DailyStat).filter(*filters).first()
+        if existing_entry:
+            db.delete(existing_entry)
+        return
+
+    records = [{c.name: getattr(row, c.name) for c in row.__table__.columns} for row in analytics_rows]
+    merged = kpi_utils.aggregate_data_points(records)
+
+    orders = db.query(models.Order).options(selectinload(models.Order.items)).filter(
+        models.Order.brand_id == brand_id,
+        order_date_in_range(target_date)
+    ).all()
+    financials = _load_day_order_financials(db, brand_id, target_date)
+    merged.update(kpi_utils.calculate_order_distributions(orders, financials, target_date, db, brand_id=brand_id, history=history))
+    merged.update(_cross_source_distinct_counts(db, brand_id, target_date, orders))
+    merged["churn_rate"] = kpi_utils._calculate_churn_rate(target_date, db, brand_id, None, history=history)
+
+    merged = kpi_utils.calculate_derived_metrics(merged)
+    _apply_kpis(db, models.DailyStat, brand_id, target_date, merged, filters)
+
+def _cross_source_distinct_counts(db: Session, brand_id: int, target_date: date, orders) -> dict:
+    """
+    Hiệu chỉnh: một khách / một SKU có thể xuất hiện ở nhiều nguồn trong cùng ngày,
+    nên tổng khách, khách mới/cũ và số SKU phân biệt phải đếm lại trên toàn brand (orders = mọi đơn của ngày).
+    Cùng định nghĩa với calculate_daily_kpis (khách cũ = đã có đơn bất kỳ trước ngày này).
+    """
+    day_start = datetime.combine(target_date, datetime.min.time())
+    usernames = {o.username for o in orders if o.username}
+    unique_skus = len({item.sku for o in orders for item in o.items if item.sku})
+
+    returning = 0
+    if usernames:
+        returning = db.query(func.count(distinct(models.Order.username))).filter(
+            models.Order.brand_id == brand_id,
+            models.Order.username.in_(usernames),
+            models.Order.order_date < day_start
+        ).scalar() or 0
+
+    return {
+        "total_customers": len(usernames),
+        "returning_customers": returning,
+        "new_customers": len(usernames) - returning,
+        "unique_skus_sold": unique_skus,
+    }
+
 def delete_brand_data_in_range(db: Session, brand_id: int, start_date: date, end_date: date, source: str = None):
     """
     Xóa dữ liệu Brand theo khoảng thời gian và Source (Optional).
     Logic xóa dây chuyền: Revenue -> Order -> Customer -> Stats.
     """
     try:
+        # 0. Ghi các ngày có số liệu trong khoảng vào sổ tính lại (cùng transaction với lệnh xóa)
+        mark_range_dirty(db, brand_id, start_date, end_date, source, reason="delete")
+
         # 1. Xác định danh sách Order Code cần xóa (Từ Revenue + Order)
         target_order_codes = set()
 
@@ -151,7 +312,7 @@ def delete_brand_data_in_range(db: Session, brand_id: int, start_date: date, end
         # Từ Order
         ord_q = db.query(models.Order.order_code).filter(
             models.Order.brand_id == brand_id,
-            func.date(models.Order.order_date).between(start_date, end_date)
+            order_date_in_range(start_date, end_date)
         )
         if source: ord_q = ord_q.filter(models.Order.source == source)
         target_order_codes.update({r[0] for r in ord_q.distinct().all() if r[0]})
@@ -163,7 +324,9 @@ def delete_brand_data_in_range(db: Session, brand_id: int, start_date: date, end
                 models.Order.order_code.in_(target_order_codes)
             ).delete(synchronize_session=False)
 
-        # 3. Xóa Revenue
+        # 3. Xóa Revenue: DELETE theo transaction_date (khóa phân vùng -> planner chỉ quét các tháng liên quan).
+        #    Không TRUNCATE partition: partition dùng chung giữa các brand, TRUNCATE không an toàn MVCC
+        #    và giữ khóa ACCESS EXCLUSIVE tới hết transaction xóa.
         del_rev = db.query(models.Revenue).filter(
             models.Revenue.brand_id == brand_id,
             models.Revenue.transaction_date.between(start_date, end_date)
@@ -171,6 +334,9 @@ def delete_brand_data_in_range(db: Session, brand_id: int, start_date: date, end
         if source: del_rev = del_rev.filter(models.Revenue.source == source)
         del_rev.delete(synchronize_session=False)
 
+        # 4. Tổng hợp tài chính của các đơn bị chạm (mọi dòng revenues bị xóa đều thuộc target_order_codes)
+        refresh_order_financials(db, brand_id, target_order_codes)
+
         # 5. Xóa Marketing Spend
         del_mkt = db.query(models.MarketingSpend).filter(
             models.MarketingSpend.brand_id == brand_id,
@@ -194,14 +360,438 @@ def delete_brand_data_in_range(db: Session, brand_id: int, start_date: date, end
             models.DailyStat.brand_id == brand_id,
             models.DailyStat.date.between(start_date, end_date)
         ).delete(synchronize_session=False)
+        # Tổng lũy kế KHÔNG dựng lại ở đây (request API không giữ khóa tính lại của brand):
+        # các ngày đã ghi sổ ở bước 0, job drain tính lại rồi dựng tổng lũy kế dưới khóa.
 
         db.commit()
+        replica.pin_brand_to_primary(db, brand_id)
         
-        # Clear Cache
-        clear_brand_cache(brand_id)
+        # Clear Cache (chỉ các khoảng thời gian giao với dải ngày bị xóa)
+        affected_dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        invalidate_brand_cache(brand_id, affected_dates, source)
         
     except Exception as e:
         db.rollback()
         print(f"ERROR: Failed to delete data: {e}")
         traceback.print_exc()
         raise e
+
+# Bảng con của brand theo thứ tự xóa (bảng tham chiếu tới bảng khác xóa trước)
+BRAND_CHILD_MODELS = [
+    models.StatsDirtyDay,
+    models.ImportLog,
+    models.DailyStatCumulative,
+    models.DailyAnalytics,
+    models.DailyStat,
+    models.Customer,
+    models.OrderFinancial,
+    models.Revenue,
+    models.MarketingSpend,
+    models.OrderItem,
+    models.Order,
+    models.Product,
+]
+
+# Bảng được sao chép khi nhân bản brand kèm dữ liệu (số liệu đã tính sẵn đi theo -> không cần tính lại)
+BRAND_CLONE_MODELS = [
+    models.Product,
+    models.Order,
+    models.OrderItem,
+    models.Revenue,
+    models.OrderFinancial,
+    models.MarketingSpend,
+    models.Customer,
+    models.DailyStat,
+    models.DailyAnalytics,
+    models.DailyStatCumulative,
+]
+
+def count_brand_rows(db: Session, brand_id: int, child_models=None) -> int:
+    return sum(
+        db.query(func.count(model.id)).filter(model.brand_id == brand_id).scalar() or 0
+        for model in (child_models or BRAND_CHILD_MODELS)
+    )
+
+def delete_brand_in_batches(db: Session, brand_id: int, batch_size: int = 5000, on_table=None, on_batch=None):
+    """
+    Xóa brand phía server theo lô: DELETE ... WHERE id IN (SELECT id ... WHERE brand_id = :id LIMIT n)
+    cho từng bảng con, commit sau mỗi lô -> không nạp row nào vào session (khác với cascade ORM)
+    và không giữ một transaction khổng lồ. Cuối cùng xóa dòng brand bằng câu DELETE Core.
+    on_table(table_name) / on_batch(deleted_rows): callback báo tiến độ.
+    """
+    for model in BRAND_CHILD_MODELS:
+        if on_table:
+            on_table(model.__tablename__)
+        while True:
+            batch_ids = select(model.id).where(model.brand_id == brand_id).limit(batch_size)
+            result = db.execute(
+                delete(model).where(model.id.in_(batch_ids)),
+                execution_options={"synchronize_session": False}
+            )
+            db.commit()
+            if not result.rowcount:
+                break
+            if on_batch:
+                on_batch(result.rowcount)
+
+    db.execute(delete(models.Brand).where(models.Brand.id == brand_id), execution_options={"synchronize_session": False})
+    db.commit()
+    clear_brand_cache(brand_id)
+
+def clone_brand_data(db: Session, source_brand_id: int, target_brand_id: int, on_table=None):
+    """
+    Sao chép dữ liệu phía server: mỗi bảng một câu INSERT ... SELECT (đổi brand_id).
+    Không có row nào đi qua Python. on_table(table_name, copied_rows): callback báo tiến độ.
+    Mọi bảng chạy trong MỘT transaction REPEATABLE READ: đọc cùng một snapshot của brand nguồn
+    (import / tính lại của brand nguồn chen vào giữa các bảng không làm lệch đơn - dòng - số liệu),
+    lỗi giữa chừng thì rollback toàn bộ thay vì để lại brand đích sao chép dở.
+    """
+    # SET TRANSACTION phải là câu đầu tiên của transaction
+    db.commit()
+    db.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+    # Brand đích nhận đơn mới: giữ khóa ghi order_code như các luồng import
+    partitioning.lock_brand_order_codes(db, target_brand_id)
+
+    for model in BRAND_CLONE_MODELS:
+        columns = [c.name for c in model.__table__.columns if c.name not in ("id", "brand_id")]
+        if model is models.OrderItem:
+            rows = _clone_order_items_select(source_brand_id, target_brand_id, columns)
+        else:
+            rows = select(
+                literal(target_brand_id), *[getattr(model, name) for name in columns]
+            ).where(model.brand_id == source_brand_id).order_by(model.id)
+        result = db.execute(insert(model).from_select(["brand_id", *columns], rows))
+        if on_table:
+            on_table(model.__tablename__, result.rowcount or 0)
+    db.commit()
+
+    replica.pin_brand_to_primary(db, target_brand_id)
+    clear_brand_cache(target_brand_id)
+
+def _clone_order_items_select(source_brand_id: int, target_brand_id: int, columns):
+    """
+    order_id phải trỏ sang đơn MỚI: ghép đơn gốc với đơn đã sao chép qua (order_code, order_date)
+    - khóa duy nhất uq_order_brand_code của bảng phân vùng, và order_date giúp prune partition.
+    """
+    source_order = aliased(models.Order)
+    target_order = aliased(models.Order)
+    selected = [
+        target_order.id if name == "order_id" else getattr(models.OrderItem, name)
+        for name in columns
+    ]
+    return select(literal(target_brand_id), *selected).select_from(models.OrderItem).join(
+        source_order,
+        (source_order.id == models.OrderItem.order_id) & (source_order.order_date == models.OrderItem.order_date)
+    ).join(
+        target_order,
+        (target_order.brand_id == target_brand_id)
+        & (target_order.order_code == source_order.order_code)
+        & (target_order.order_date == source_order.order_date)
+    ).where(models.OrderItem.brand_id == source_brand_id).order_by(models.OrderItem.id)
+
+# ==============================================================================
+# TÍNH LẠI GIÁ VỐN (COGS) KHI BẢNG GIÁ VỐN THAY ĐỔI
+# ==============================================================================
+
+# Một câu UPDATE ... FROM duy nhất: cộng số lượng x giá vốn hiện tại trên order_items của các đơn
+# chứa SKU bị đổi rồi ghi đè cogs. Chỉ đơn có cogs thực sự đổi mới được ghi.
+_RECOST_ORDERS_SQL = """
+WITH product_costs AS (
+    SELECT DISTINCT ON (sku) sku, cost_price
+    FROM products
+    WHERE brand_id = :brand_id
+    ORDER BY sku, id DESC
+),
+recost AS (
+    SELECT oi.order_id, oi.order_date,
+           SUM(COALESCE(oi.quantity, 0) * COALESCE(pc.cost_price, 0)) AS new_cogs
+    FROM order_items oi
+    LEFT JOIN product_costs pc ON pc.sku = oi.sku
+    WHERE oi.brand_id = :brand_id {sku_filter}
+    GROUP BY oi.order_id, oi.order_date
+),
+updated AS (
+    UPDATE orders o
+    SET cogs = r.new_cogs
+    FROM recost r
+    -- order_date (khóa phân vùng) + brand_id: planner chỉ dò partition của các tháng có đơn bị đổi
+    WHERE o.brand_id = :brand_id AND o.id = r.order_id AND o.order_date = r.order_date
+      AND o.cogs IS DISTINCT FROM r.new_cogs::float8
+    RETURNING o.order_date, o.source, o.username
+)
+SELECT DISTINCT CAST(order_date AS date) AS day, source, username
+FROM updated
+WHERE order_date IS NOT NULL
+"""
+
+# Đơn có ít nhất một dòng thuộc SKU bị đổi (dùng index (brand_id, sku) của order_items)
+_RECOST_SKU_FILTER_SQL = """
+      AND (oi.order_id, oi.order_date) IN (
+          SELECT changed.order_id, changed.order_date FROM order_items changed
+          WHERE changed.brand_id = :brand_id AND changed.sku = ANY(:skus)
+      )"""
+
+def recost_orders_for_skus(db: Session, brand_id: int, skus=None):
+    """
+    Tính lại cogs cho mọi đơn chứa các SKU trong `skus` (None = toàn bộ đơn của brand) theo giá vốn
+    hiện tại của bảng products - set-based trên Postgres, không nạp đơn lên Python.
+    Các ngày có đơn bị đổi cogs được ghi vào sổ stats_dirty_days (reason 'recost') theo đúng nguồn.
+    KHÔNG commit (giống các hàm ghi sổ). Trả về (tập ngày bị ảnh hưởng, tập username cần đồng bộ lại).
+    """
+    params = {"brand_id": brand_id}
+    sku_filter = ""
+    if skus is not None:
+        skus = sorted({str(sku) for sku in skus if sku})
+        if not skus:
+            return set(), set()
+        params["skus"] = skus
+        sku_filter = _RECOST_SKU_FILTER_SQL
+
+    # Giá vốn vừa upsert qua ORM phải xuống DB trước khi UPDATE đọc bảng products
+    db.flush()
+    rows = db.execute(text(_RECOST_ORDERS_SQL.format(sku_filter=sku_filter)), params).all()
+
+    days_by_source = {}
+    affected_usernames = set()
+    for day, source, username in rows:
+        days_by_source.setdefault(source, set()).add(day)
+        if username:
+            affected_usernames.add(username)
+
+    for source, days in days_by_source.items():
+        mark_days_dirty(db, brand_id, days, source, reason="recost")
+
+    affected_days = set().union(*days_by_source.values()) if days_by_source else set()
+    print(f"RECOST: Brand {brand_id} - cogs đổi trên {len(affected_days)} ngày, {len(affected_usernames)} khách hàng.")
+    return affected_days, affected_usernames
+
+# ==============================================================================
+# TỔNG HỢP TÀI CHÍNH THEO ĐƠN (order_financials)
+# ==============================================================================
+
+# Cộng lại các dòng revenues của những order_code bị chạm rồi upsert (ON CONFLICT) vào order_financials
+_REFRESH_ORDER_FINANCIALS_SQL = """
+INSERT INTO order_financials (brand_id, order_code, net_revenue, gmv, total_fees, refund_total,
+                              is_refunded, refund_tracking_code, updated_at)
+SELECT brand_id, order_code,
+       COALESCE(SUM(net_revenue), 0), COALESCE(SUM(gmv), 0), COALESCE(SUM(total_fees), 0),
+       COALESCE(SUM(refund), 0), COALESCE(BOOL_OR(refund < -0.1), false),
+       (ARRAY_AGG(order_refund ORDER BY id DESC) FILTER (WHERE COALESCE(order_refund, '') <> ''))[1],
+       now()
+FROM revenues
+WHERE brand_id = :brand_id AND order_code IS NOT NULL {code_filter}
+GROUP BY brand_id, order_code
+ON CONFLICT (brand_id, order_code) DO UPDATE SET
+    net_revenue = EXCLUDED.net_revenue,
+    gmv = EXCLUDED.gmv,
+    total_fees = EXCLUDED.total_fees,
+    refund_total = EXCLUDED.refund_total,
+    is_refunded = EXCLUDED.is_refunded,
+    refund_tracking_code = EXCLUDED.refund_tracking_code,
+    updated_at = EXCLUDED.updated_at
+"""
+
+# Đơn không còn dòng revenues nào (đã bị xóa) thì bỏ dòng tổng hợp
+_PRUNE_ORDER_FINANCIALS_SQL = """
+DELETE FROM order_financials f
+WHERE f.brand_id = :brand_id {code_filter}
+  AND NOT EXISTS (
+      SELECT 1 FROM revenues r WHERE r.brand_id = f.brand_id AND r.order_code = f.order_code
+  )
+"""
+
+def refresh_order_financials(db: Session, brand_id: int, order_codes=None):
+    """
+    Cập nhật order_financials cho các order_code vừa có dòng revenues thêm / xóa (None = toàn brand).
+    KHÔNG commit: caller commit cùng transaction với thay đổi trên bảng revenues.
+    """
+    params = {"brand_id": brand_id}
+    if order_codes is None:
+        insert_filter = prune_filter = ""
+    else:
+        order_codes = sorted({code for code in order_codes if code})
+        if not order_codes:
+            return
+        params["codes"] = order_codes
+        insert_filter = "AND order_code = ANY(:codes)"
+        prune_filter = "AND f.order_code = ANY(:codes)"
+
+    # Dòng revenues thêm qua bulk_insert_mappings / ORM phải xuống DB trước khi cộng lại
+    db.flush()
+    db.execute(text(_REFRESH_ORDER_FINANCIALS_SQL.format(code_filter=insert_filter)), params)
+    db.execute(text(_PRUNE_ORDER_FINANCIALS_SQL.format(code_filter=prune_filter)), params)
+
+# ==============================================================================
+# TỔNG LŨY KẾ THEO NGÀY (daily_stat_cumulatives)
+# ==============================================================================
+CUMULATIVE_SOURCE_ALL = "all"
+CUMULATIVE_COLUMNS = [
+    c.name for c in models.DailyStatCumulative.__table__.columns
+    if c.name not in ("id", "brand_id", "source", "date")
+]
+# Cột có trọng số: giá trị ngày = trung bình * trọng số (cột nguồn, cột trọng số)
+CUMULATIVE_WEIGHTED = {
+    "weighted_processing_time": ("avg_processing_time", "total_orders"),
+    "weighted_shipping_time": ("avg_shipping_time", "total_orders"),
+    "weighted_repurchase_cycle": ("avg_repurchase_cycle", "returning_customers"),
+    "weighted_churn": ("churn_rate", "total_customers"),
+}
+# Trung bình đơn giản dự phòng (như kpi_utils.aggregate_data_points): cột trung bình -> (cột tổng, cột số ngày)
+CUMULATIVE_SIMPLE_AVERAGES = {
+    "avg_repurchase_cycle": ("repurchase_cycle_sum", "repurchase_cycle_days"),
+    "churn_rate": ("churn_rate_sum", "churn_rate_days"),
+}
+
+def _cumulative_day_value(model, column: str) -> str:
+    """Biểu thức giá trị của một ngày cho cột lũy kế (cột không có ở bảng nguồn = 0)."""
+    for source_column, (sum_column, days_column) in CUMULATIVE_SIMPLE_AVERAGES.items():
+        if column in (sum_column, days_column):
+            if source_column not in model.__table__.columns:
+                return "0"
+            value = source_column if column == sum_column else "1"
+            return f"CASE WHEN {source_column} > 0 THEN {value} ELSE 0 END"
+    names = CUMULATIVE_WEIGHTED.get(column, (column,))
+    if any(name not in model.__table__.columns for name in names):
+        return "0"
+    return " * ".join(f"COALESCE({name}, 0)" for name in names)
+
+def _refresh_cumulative_sql() -> str:
+    columns = ", ".join(CUMULATIVE_COLUMNS)
+    stat_values = ", ".join(f"{_cumulative_day_value(models.DailyStat, c)} AS {c}" for c in CUMULATIVE_COLUMNS)
+    analytics_values = ", ".join(f"{_cumulative_day_value(models.DailyAnalytics, c)} AS {c}" for c in CUMULATIVE_COLUMNS)
+    running = ", ".join(
+        f"COALESCE(b.{c}, 0) + SUM(d.{c}) OVER (PARTITION BY d.source ORDER BY d.date)" for c in CUMULATIVE_COLUMNS
+    )
+    return f"""
+        WITH daily AS (
+            SELECT '{CUMULATIVE_SOURCE_ALL}' AS source, date, {stat_values}
+            FROM daily_stats WHERE brand_id = :brand_id AND date >= :from_date
+            UNION ALL
+            SELECT source, date, {analytics_values}
+            FROM daily_analytics WHERE brand_id = :brand_id AND date >= :from_date
+        ),
+        base AS (
+            SELECT DISTINCT ON (source) source, {columns}
+            FROM daily_stat_cumulatives
+            WHERE brand_id = :brand_id AND date < :from_date
+            ORDER BY source, date DESC
+        )
+        INSERT INTO daily_stat_cumulatives (brand_id, source, date, {columns})
+        SELECT :brand_id, d.source, d.date, {running}
+        FROM daily d LEFT JOIN base b ON b.source = d.source
+        WHERE :all_sources OR d.source = ANY(:sources)
+    """
+
+# Danh sách cột cố định (lấy từ model) -> dựng câu SQL một lần khi import module
+_REFRESH_CUMULATIVE_SQL = _refresh_cumulative_sql()
+
+def refresh_cumulative_stats(db: Session, brand_id: int, from_date: date = None, source: str = None):
+    """
+    Dựng lại tổng lũy kế của brand từ `from_date` trở đi (None = toàn bộ) sau khi
+    DailyStat / DailyAnalytics thay đổi. Các dòng trước from_date giữ nguyên và làm mốc cộng tiếp.
+    source: chỉ nguồn này (và 'all') thay đổi -> các nguồn khác giữ nguyên; None = mọi nguồn.
+
+    Chi phí: prefix sum buộc viết lại MỌI dòng từ from_date tới ngày cuối (một dòng / ngày có số liệu
+    / nguồn), nên sửa một ngày cũ tốn bằng dựng lại phần đuôi lịch sử. Với vài năm dữ liệu đây là
+    vài nghìn dòng trong một câu INSERT ... SELECT, rẻ hơn nhiều so với tính lại số liệu ngày.
+    Chỉ gọi khi đang giữ khóa tính lại của brand (job drain), để không có hai lần dựng cùng lúc
+    ghi trùng khóa (brand_id, source, date).
+    KHÔNG commit: caller commit cùng transaction với số liệu ngày.
+    """
+    from_date = from_date or date(1970, 1, 1)
+    # Số liệu ngày vừa ghi qua ORM phải xuống DB trước khi cộng dồn
+    db.flush()
+    stale = delete(models.DailyStatCumulative).where(
+        models.DailyStatCumulative.brand_id == brand_id,
+        models.DailyStatCumulative.date >= from_date
+    )
+    sources = [CUMULATIVE_SOURCE_ALL, source] if source else []
+    if source:
+        stale = stale.where(models.DailyStatCumulative.source.in_(sources))
+    db.execute(stale, execution_options={"synchronize_session": False})
+    db.execute(
+        text(_REFRESH_CUMULATIVE_SQL),
+        {"brand_id": brand_id, "from_date": from_date, "all_sources": not source, "sources": sources}
+    )
+
+# ==============================================================================
+# SỔ NGÀY CẦN TÍNH LẠI (stats_dirty_days)
+# ==============================================================================
+# Các hàm ghi KHÔNG commit: caller commit cùng với thay đổi dữ liệu thô,
+# nên không thể có dữ liệu mới mà thiếu yêu cầu tính lại (và ngược lại).
+
+def mark_days_dirty(db: Session, brand_id: int, days, source: str = None, reason: str = "import"):
+    """Ghi một dòng cho mỗi ngày bị ảnh hưởng."""
+    for day in sorted(set(days)):
+        db.add(models.StatsDirtyDay(brand_id=brand_id, source=source, day=day, reason=reason))
+
+def mark_full_recalculation(db: Session, brand_id: int, reason: str = "manual"):
+    """Yêu cầu tính lại toàn bộ brand (day = NULL)."""
+    db.add(models.StatsDirtyDay(brand_id=brand_id, source=None, day=None, reason=reason))
+
+def mark_range_dirty(db: Session, brand_id: int, start_date: date, end_date: date, source: str = None, reason: str = "delete"):
+    """
+    INSERT ... SELECT: chỉ những ngày thực sự có số liệu (DailyStat) trong khoảng,
+    thay vì sinh một dòng cho mỗi ngày lịch (khoảng nhiều năm vẫn rẻ).
+    """
+    days_with_stats = select(
+        literal(brand_id), literal(source, String), models.DailyStat.date, literal(reason), func.now()
+    ).where(
+        models.DailyStat.brand_id == brand_id,
+        models.DailyStat.date.between(start_date, end_date)
+    ).distinct()
+    db.execute(
+        insert(models.StatsDirtyDay).from_select(
+            ["brand_id", "source", "day", "reason", "enqueued_at"], days_with_stats
+        )
+    )
+
+def peek_dirty_days(db: Session, brand_id: int, limit: int = None, exclude_ids=None):
+    """
+    Đọc (không xóa, không khóa) các dòng của brand theo thứ tự ghi. Chỉ job drain đang giữ khóa
+    tính lại của brand gọi hàm này, nên không có hai worker cùng xử lý một dòng.
+    exclude_ids: dòng đã tính lỗi trong lần drain này (để lại cho job quét định kỳ).
+    Trả về danh sách (id, day, source, reason).
+    """
+    query = db.query(
+        models.StatsDirtyDay.id, models.StatsDirtyDay.day, models.StatsDirtyDay.source, models.StatsDirtyDay.reason
+    ).filter(models.StatsDirtyDay.brand_id == brand_id).order_by(models.StatsDirtyDay.id)
+    if exclude_ids:
+        query = query.filter(models.StatsDirtyDay.id.notin_(list(exclude_ids)))
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+def ack_dirty_days(db: Session, ids):
+    """
+    Xóa các dòng đã được tính lại THÀNH CÔNG (theo id đã đọc, không theo khoảng: dòng ghi thêm trong
+    lúc tính vẫn ở lại sổ cho lần drain sau). KHÔNG commit.
+    """
+    ids = list(ids)
+    if ids:
+        db.execute(
+            delete(models.StatsDirtyDay).where(models.StatsDirtyDay.id.in_(ids)),
+            execution_options={"synchronize_session": False}
+        )
+
+def mark_dirty_days_reason(db: Session, ids, reason: str):
+    """Đổi reason của các dòng (vd. yêu cầu của lần chạy lỗi -> resume). KHÔNG commit."""
+    ids = list(ids)
+    if ids:
+        db.query(models.StatsDirtyDay).filter(
+            models.StatsDirtyDay.id.in_(ids)
+        ).update({models.StatsDirtyDay.reason: reason}, synchronize_session=False)
+
+def has_dirty_days(db: Session, brand_id: int) -> bool:
+    return db.query(
+        db.query(models.StatsDirtyDay.id).filter(models.StatsDirtyDay.brand_id == brand_id).exists()
+    ).scalar()
+
+def get_brands_with_stale_dirty_days(db: Session, older_than_seconds: int):
+    """Brand còn dòng trong sổ quá lâu (job drain bị mất / lỗi) - dùng cho job quét định kỳ."""
+    # So với now() của DB (cùng nguồn thời gian với enqueued_at)
+    rows = db.query(distinct(models.StatsDirtyDay.brand_id)).filter(
+        models.StatsDirtyDay.enqueued_at < func.now() - timedelta(seconds=older_than_seconds)
+    ).all()
+    return [row[0] for row in rows]
+
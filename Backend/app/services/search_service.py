@@ -1,7 +1,7 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from sqlalchemy import or_, and_, func
 from collections import defaultdict
-from models import Order, Revenue, Product, Customer
+from models import Order, Revenue, Product, Customer, OrderFinancial
 from kpi_utils import _classify_order_status
 import schemas
 
@@ -215,15 +215,18 @@ class SearchService:
 
     def _build_order_search_result(self, db: Session, brand_id: int, order: Order) -> schemas.OrderSearchResult:
         """Xây dựng kết quả trả về khi tìm thấy Order."""
-        rev = db.query(Revenue).filter(Revenue.brand_id == brand_id, Revenue.order_code == order.order_code).first()
-        is_refunded = (rev.refund or 0) < -0.1 if rev else False
+        # Tổng hợp tài chính của đơn (order_financials): một lần tra theo khóa (brand_id, order_code)
+        rev = db.query(OrderFinancial).filter(
+            OrderFinancial.brand_id == brand_id, OrderFinancial.order_code == order.order_code
+        ).first()
+        is_refunded = rev.is_refunded if rev else False
         category = _classify_order_status(order, is_financial_refund=is_refunded)
         
         # --- ENRICH CUSTOMER DATA ---
         customer_info = self._get_enriched_customer_info(db, brand_id, order)
 
         # --- ENRICH PRODUCT NAMES ---
-        enriched_items = self._enrich_order_items(db, brand_id, order.details)
+        enriched_items = self._enrich_order_items(db, brand_id, order)
 
         if category == 'refunded':
             calc_cogs = 0.0
@@ -232,10 +235,7 @@ class SearchService:
 
         net_profit = rev.net_revenue - calc_cogs if rev else 0.0
 
-        calculated_original_price = sum((
-            item.get("original_price", 0.0) * item.get("quantity") or 0)
-            for item in order.details.get("items", [])
-        ) if order.details else 0.0
+        calculated_original_price = self._calculate_original_price(order)
 
         return schemas.OrderSearchResult(
             type= "order",
@@ -248,7 +248,7 @@ class SearchService:
             source= order.source,
             trackingCode= order.tracking_id or "---",
             orderCode= order.order_code or "---",
-            return_tracking_code= rev.order_refund if rev and rev.order_refund else "---",
+            return_tracking_code= rev.refund_tracking_code if rev and rev.refund_tracking_code else "---",
             carrier= order.details.get("shipping_provider_name") if order.details else "---",
             
             customer= customer_info,
@@ -331,26 +331,35 @@ class SearchService:
         
         return customer_info
 
-    def _enrich_order_items(self, db: Session, brand_id: int, details: dict):
+    def _enrich_order_items(self, db: Session, brand_id: int, order: Order):
         """Map SKU to Product Name."""
-        items = details.get("items", []) if details else []
-        
         # Optimize: Chỉ fetch những SKU có trong đơn hàng
-        skus = [item.get('sku') for item in items if item.get('sku')]
+        skus = [item.sku for item in order.items if item.sku]
         product_map = self._get_product_map(db, brand_id, skus=skus)
-        
-        for item in items:
-            sku = item.get('sku')
-            if sku and sku in product_map:
-                item['product_name'] = product_map[sku]
-            else:
-                item['product_name'] = item.get('name') or item.get('item_name') or sku
-        return items
+        return self._order_items_payload(order, product_map)
+
+    def _order_items_payload(self, order: Order, product_map: dict = None) -> list:
+        """Dòng sản phẩm (order_items) theo định dạng UI vẫn dùng (giống details['items'] trước đây)."""
+        product_map = product_map or {}
+        return [
+            {
+                "sku": item.sku,
+                "quantity": item.quantity or 0,
+                "original_price": item.original_price or 0.0,
+                "sku_price": item.sku_price or 0.0,
+                "subsidy_amount": item.subsidy_amount or 0.0,
+                "product_name": product_map.get(item.sku) or item.sku,
+            }
+            for item in order.items
+        ]
+
+    def _calculate_original_price(self, order: Order) -> float:
+        return sum((item.original_price or 0.0) * (item.quantity or 0) for item in order.items)
 
     def get_customer_profile(self, db: Session, brand_id: int, customer: Customer):
         """Lấy dữ liệu chi tiết khách hàng để hiển thị."""
         # 1. Lấy lịch sử đơn hàng
-        all_orders = db.query(Order).filter(
+        all_orders = db.query(Order).options(selectinload(Order.items)).filter(
             Order.brand_id == brand_id,
             Order.username == customer.username
         ).order_by(Order.order_date.desc()).limit(100).all()
@@ -360,12 +369,7 @@ class SearchService:
         revenue_map, fees_map, gmv_map, refunded_codes, refund_tracking_map = self._get_revenue_map(db, brand_id, order_codes)
         
         # Optimize: Gom tất cả SKU từ 100 đơn hàng để query 1 lần
-        all_skus = set()
-        for o in all_orders:
-            if o.details and isinstance(o.details, dict):
-                for item in o.details.get("items", []):
-                    if item.get("sku"):
-                        all_skus.add(item.get("sku"))
+        all_skus = {item.sku for o in all_orders for item in o.items if item.sku}
         
         product_map = self._get_product_map(db, brand_id, skus=list(all_skus))
 
@@ -433,13 +437,9 @@ class SearchService:
 
     def _format_unified_order(self, order: Order, net_revenue: float, gmv: float, total_fees: float, category: str, refund_tracking_code: str = None, product_map: dict = None) -> schemas.Order:
         """Helper chuẩn hóa dữ liệu đơn hàng cho UI."""
-        full_details = order.details if order.details and isinstance(order.details, dict) else {}
-        
-        if product_map and 'items' in full_details and isinstance(full_details['items'], list):
-            for item in full_details['items']:
-                sku = item.get('sku')
-                if sku and sku in product_map:
-                    item['product_name'] = product_map[sku]
+        full_details = dict(order.details) if order.details and isinstance(order.details, dict) else {}
+        # UI vẫn đọc details.items -> ghép lại từ order_items
+        full_details['items'] = self._order_items_payload(order, product_map)
 
         # --- Logic tính toán tài chính (Giống _build_order_search_result) ---
         if category == 'refunded':
@@ -457,10 +457,7 @@ class SearchService:
         if gmv and gmv > 0:
             take_rate = (total_fees / gmv) * 100
 
-        calculated_original_price = sum((
-            item.get("original_price", 0.0) * item.get("quantity") or 0)
-            for item in order.details.get("items", [])
-        ) if order.details else 0.0
+        calculated_original_price = self._calculate_original_price(order)
 
         return schemas.Order(
             id=order.id,
@@ -505,7 +502,7 @@ class SearchService:
         return {p.sku: p.name for p in products}
 
     def _get_revenue_map(self, db: Session, brand_id: int, order_codes: list):
-        """Helper: Lấy dữ liệu tài chính."""
+        """Helper: Lấy dữ liệu tài chính đã tổng hợp theo đơn (order_financials)."""
         revenue_map = defaultdict(float)
         fees_map = defaultdict(float)
         gmv_map = defaultdict(float)
@@ -515,27 +512,24 @@ class SearchService:
         if not order_codes:
             return revenue_map, fees_map, gmv_map, refunded_codes, refund_tracking_map
 
-        chunk_size = 1000
-        for i in range(0, len(order_codes), chunk_size):
-            chunk = order_codes[i:i + chunk_size]
-            rev_records = db.query(
-                Revenue.order_code, 
-                Revenue.net_revenue,
-                Revenue.total_fees,
-                Revenue.gmv,
-                Revenue.refund,
-                Revenue.order_refund
-            ).filter(
-                Revenue.brand_id == brand_id, 
-                Revenue.order_code.in_(chunk)
-            ).all()
-            
-            for code, net_rev, fees, gmv, refund, order_refund in rev_records:
-                if net_rev: revenue_map[code] += net_rev
-                if fees: fees_map[code] += fees
-                if gmv: gmv_map[code] += gmv
-                if (refund or 0) < -0.1: refunded_codes.add(code)
-                if order_refund: refund_tracking_map[code] = order_refund
+        fin_records = db.query(
+            OrderFinancial.order_code,
+            OrderFinancial.net_revenue,
+            OrderFinancial.total_fees,
+            OrderFinancial.gmv,
+            OrderFinancial.is_refunded,
+            OrderFinancial.refund_tracking_code
+        ).filter(
+            OrderFinancial.brand_id == brand_id,
+            OrderFinancial.order_code.in_(order_codes)
+        ).all()
+
+        for code, net_rev, fees, gmv, is_refunded, refund_tracking_code in fin_records:
+            if net_rev: revenue_map[code] = net_rev
+            if fees: fees_map[code] = fees
+            if gmv: gmv_map[code] = gmv
+            if is_refunded: refunded_codes.add(code)
+            if refund_tracking_code: refund_tracking_map[code] = refund_tracking_code
 
         return revenue_map, fees_map, gmv_map, refunded_codes, refund_tracking_map
 
@@ -0,0 +1,232 @@
+# FILE: Backend/app/services/warmup_service.py
+
+"""
+Làm nóng cache (Cache Warming).
+
+- Ghi nhận lịch sử request của người dùng (dạng "template" tương đối theo ngày hôm nay)
+  để biết panel / khoảng thời gian nào được xem nhiều nhất.
+- Xây dựng "kế hoạch làm nóng" = các request mặc định (cấu hình qua ENV) + các request học được.
+- Worker (celery_worker.warm_brand_cache) thực thi kế hoạch sau mỗi lần tính toán lại và theo lịch beat.
+"""
+
+import os
+import json
+import calendar
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Any, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from cache import redis_client, async_redis_client
+
+# --- CẤU HÌNH (ENV) ---
+APP_TIMEZONE = os.getenv("APP_TIMEZONE", "Asia/Ho_Chi_Minh")
+
+def _env_list(name: str, default: str) -> List[str]:
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+# Các loại data request (POST /api/data-requests) được làm nóng mặc định
+WARM_REQUEST_TYPES = _env_list("CACHE_WARM_REQUEST_TYPES", "kpi_summary,daily_kpis_chart,top_products,kpis_by_platform")
+# Các endpoint KPI đọc trực tiếp (kpis/operation, kpis/customer) - làm nóng cache kpi_daily phía dưới
+WARM_KPI_ENDPOINTS = _env_list("CACHE_WARM_KPI_ENDPOINTS", "operation_kpis,customer_kpis")
+# Các khoảng thời gian mặc định
+WARM_RANGE_PRESETS = _env_list("CACHE_WARM_PRESETS", "last_7_days,last_30_days,last_90_days,month_to_date")
+# Số lượng template học được từ log request được đưa vào kế hoạch
+WARM_LEARNED_LIMIT = int(os.getenv("CACHE_WARM_LEARNED_LIMIT", 20))
+# Số ngày log request được dùng để học
+WARM_USAGE_WINDOW_DAYS = int(os.getenv("CACHE_WARM_USAGE_WINDOW_DAYS", 14))
+# Bỏ qua các khoảng thời gian quá xa trong quá khứ (không có giá trị làm nóng)
+MAX_RELATIVE_OFFSET_DAYS = 400
+
+# Tham số mặc định cho từng loại request (phải khớp với cách Frontend gửi lên để trùng cache key)
+DEFAULT_REQUEST_PARAMS = {
+    "kpi_summary": {},
+    "daily_kpis_chart": {"interval": "day"},
+    "top_products": {},
+    "kpis_by_platform": {},
+}
+
+KPI_ENDPOINT_TYPES = {"operation_kpis", "customer_kpis"}
+
+def local_today() -> date:
+    """Ngày hiện tại theo múi giờ của người dùng (không phải UTC của container)."""
+    return datetime.now(ZoneInfo(APP_TIMEZONE)).date()
+
+def _usage_key(brand_id: int, day: date) -> str:
+    return f"warm_usage:{brand_id}:{day.strftime('%Y%m%d')}"
+
+# ==============================================================================
+# 1. MÔ TẢ KHOẢNG THỜI GIAN TƯƠNG ĐỐI
+# ==============================================================================
+
+def resolve_preset(preset: str, today: date) -> Optional[Tuple[date, date]]:
+    """Chuyển tên preset thành (start_date, end_date)."""
+    if preset == "month_to_date":
+        return today.replace(day=1), today
+    if preset.startswith("last_") and preset.endswith("_days"):
+        try:
+            days = int(preset[len("last_"):-len("_days")])
+        except ValueError:
+            return None
+        return today - timedelta(days=days - 1), today
+    return None
+
+def previous_period(start_date: date, end_date: date) -> Tuple[date, date]:
+    """Kỳ trước có cùng độ dài, kết thúc ngay trước start_date."""
+    duration = end_date - start_date
+    prev_end = start_date - timedelta(days=1)
+    return prev_end - duration, prev_end
+
+def _month_shift(day: date, months_back: int) -> date:
+    month_index = day.year * 12 + (day.month - 1) - months_back
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def _describe_range(start_date: date, end_date: date, today: date) -> Optional[Dict[str, Any]]:
+    """
+    Mô tả khoảng thời gian tương đối so với 'today' để tái tạo lại ở ngày khác.
+    Ví dụ: 'Tháng này', 'Tháng trước', '7 ngày qua' đều được quy về một template ổn định.
+    """
+    if start_date.day == 1:
+        months_back = (today.year - start_date.year) * 12 + (today.month - start_date.month)
+        month_end = start_date.replace(day=calendar.monthrange(start_date.year, start_date.month)[1])
+        if 0 <= months_back <= 24:
+            if end_date == month_end:
+                return {"anchor": "month", "months_back": months_back, "to": "month_end"}
+            if months_back == 0 and end_date == today:
+                return {"anchor": "month", "months_back": 0, "to": "today"}
+
+    start_offset = (today - start_date).days
+    end_offset = (today - end_date).days
+    if start_offset < end_offset or start_offset > MAX_RELATIVE_OFFSET_DAYS:
+        return None
+    return {"anchor": "day", "start_offset": start_offset, "end_offset": end_offset}
+
+def _resolve_range(desc: Dict[str, Any], today: date) -> Optional[Tuple[date, date]]:
+    if desc.get("anchor") == "month":
+        start = _month_shift(today, int(desc.get("months_back", 0)))
+        if desc.get("to") == "today":
+            return start, today
+        return start, start.replace(day=calendar.monthrange(start.year, start.month)[1])
+    if desc.get("anchor") == "day":
+        return today - timedelta(days=int(desc["start_offset"])), today - timedelta(days=int(desc["end_offset"]))
+    return None
+
+# ==============================================================================
+# 2. GHI NHẬN & HỌC TỪ LOG REQUEST
+# ==============================================================================
+
+def _usage_entry(brand_id: int, request_type: str, params: Dict[str, Any], today: Optional[date]) -> Optional[Tuple[str, str]]:
+    """Trả về (key, member) cho sorted set usage, hoặc None nếu khoảng thời gian không làm nóng được."""
+    today = today or local_today()
+    start_date = date.fromisoformat(str(params.get("start_date")))
+    end_date = date.fromisoformat(str(params.get("end_date")))
+    range_desc = _describe_range(start_date, end_date, today)
+    if not range_desc:
+        return None
+
+    template = {
+        "type": request_type,
+        "params": {k: v for k, v in params.items() if k not in ("start_date", "end_date")},
+        "range": range_desc,
+    }
+    return _usage_key(brand_id, today), json.dumps(template, sort_keys=True, default=str)
+
+def record_request_usage(brand_id: int, request_type: str, params: Dict[str, Any], today: Optional[date] = None):
+    """
+    Ghi nhận một request (data request hoặc KPI endpoint) vào sorted set theo ngày.
+    Không bao giờ raise lỗi - việc học chỉ là phụ trợ cho request chính.
+    """
+    try:
+        entry = _usage_entry(brand_id, request_type, params, today)
+        if not entry:
+            return
+        key, member = entry
+
+        pipe = redis_client.pipeline()
+        pipe.zincrby(key, 1, member)
+        pipe.expire(key, timedelta(days=WARM_USAGE_WINDOW_DAYS + 1))
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi nhận được usage cho cache warming: {e}")
+
+async def record_request_usage_async(brand_id: int, request_type: str, params: Dict[str, Any], today: Optional[date] = None):
+    """Phiên bản async của `record_request_usage` cho các endpoint async."""
+    try:
+        entry = _usage_entry(brand_id, request_type, params, today)
+        if not entry:
+            return
+        key, member = entry
+
+        pipe = async_redis_client.pipeline()
+        pipe.zincrby(key, 1, member)
+        pipe.expire(key, timedelta(days=WARM_USAGE_WINDOW_DAYS + 1))
+        await pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi nhận được usage cho cache warming: {e}")
+
+def get_learned_templates(brand_id: int, limit: int = WARM_LEARNED_LIMIT, today: Optional[date] = None) -> List[Dict[str, Any]]:
+    """Lấy các template được dùng nhiều nhất trong WARM_USAGE_WINDOW_DAYS ngày gần nhất."""
+    if limit <= 0:
+        return []
+    today = today or local_today()
+    keys = [_usage_key(brand_id, today - timedelta(days=i)) for i in range(WARM_USAGE_WINDOW_DAYS)]
+    try:
+        scored = redis_client.zunion(keys, withscores=True)
+    except Exception as e:
+        print(f"WARNING: Không đọc được usage log: {e}")
+        return []
+
+    scored = sorted(scored, key=lambda item: item[1], reverse=True)[:limit]
+    templates = []
+    for member, _score in scored:
+        try:
+            templates.append(json.loads(member))
+        except (TypeError, ValueError):
+            continue
+    return templates
+
+# ==============================================================================
+# 3. KẾ HOẠCH LÀM NÓNG
+# ==============================================================================
+
+def build_warm_plan(brand_id: int, today: Optional[date] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Trả về danh sách (request_type, params) cần làm nóng, đã khử trùng lặp.
+    params luôn chứa start_date / end_date dạng ISO.
+    """
+    today = today or local_today()
+    plan: List[Tuple[str, Dict[str, Any]]] = []
+    seen = set()
+
+    def add(request_type: str, base_params: Dict[str, Any], start_date: date, end_date: date):
+        params = {**base_params, "start_date": start_date.isoformat(), "end_date": end_date.isoformat()}
+        marker = (request_type, json.dumps(params, sort_keys=True, default=str))
+        if marker in seen:
+            return
+        seen.add(marker)
+        plan.append((request_type, params))
+
+    # A. Mặc định: mỗi preset + kỳ trước tương ứng (Dashboard luôn tải cả 2 để so sánh)
+    for preset in WARM_RANGE_PRESETS:
+        date_range = resolve_preset(preset, today)
+        if not date_range:
+            print(f"WARNING: Preset cache warming không hợp lệ: {preset}")
+            continue
+        start_date, end_date = date_range
+        prev_start, prev_end = previous_period(start_date, end_date)
+
+        for request_type in WARM_REQUEST_TYPES:
+            base_params = DEFAULT_REQUEST_PARAMS.get(request_type, {})
+            add(request_type, base_params, start_date, end_date)
+            add(request_type, base_params, prev_start, prev_end)
+
+        for endpoint in WARM_KPI_ENDPOINTS:
+            add(endpoint, {}, start_date, end_date)
+
+    # B. Học từ log: đúng params / khoảng thời gian mà người dùng thực sự hay mở
+    for template in get_learned_templates(brand_id, today=today):
+        date_range = _resolve_range(template.get("range", {}), today)
+        if not date_range:
+            continue
+        add(template.get("type"), template.get("params") or {}, *date_range)
+
+    return plan
@@ -5,7 +5,9 @@ from sqlalchemy.orm import Session
 import traceback
 import io
 import models
+import partitioning
 import crud
+from services import data_service
 import schemas
 import re # Import Regex
 import hashlib # Import hashlib for MD5
@@ -260,23 +262,40 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
         revenue_sheet = find_sheet_name(sheet_names, ['doanh thu', 'revenue'])
         marketing_sheet = find_sheet_name(sheet_names, ['marketing'])
         
+        affected_usernames = set() # Tập hợp các username cần đồng bộ
+        recosted_dates = set()
+
         # --- BƯỚC 1: XỬ LÝ SHEET GIÁ VỐN ---
         if cost_sheet:
             print(f"Đang xử lý sheet '{cost_sheet}'...")
             df_cost = pd.read_excel(xls, sheet_name=cost_sheet, header=1)
             if not df_cost.empty:
+                # Giá vốn trước khi nạp để biết SKU nào thực sự đổi (SKU mới cũng tính là đổi: đơn cũ đang có giá vốn 0)
+                old_cost_map = {sku: cost for sku, cost in db.query(models.Product.sku, models.Product.cost_price).filter(models.Product.brand_id == brand_id)}
+                new_cost_map = {}
                 count = 0
                 for _, row in df_cost.dropna(subset=['sku']).iterrows():
+                    sku = to_clean_str(row['sku'])
+                    cost_price = to_int(row.get('cost_price'))
                     crud.upsert_product(
                         db=db,
                         brand_id=brand_id,
-                        sku=to_clean_str(row['sku']),
+                        sku=sku,
                         name=str(row.get('name', '')),
-                        cost_price=to_int(row.get('cost_price'))
+                        cost_price=cost_price
                     )
+                    new_cost_map[sku] = cost_price
                     count += 1
                 results['cost_sheet'] = f"Đã xử lý {count} dòng giá vốn."
                 print(results['cost_sheet'])
+
+                # Tính lại cogs của các đơn đã có chứa SKU bị đổi giá (một câu UPDATE) và ghi ngày vào sổ tính lại
+                changed_skus = [sku for sku, cost in new_cost_map.items() if old_cost_map.get(sku) != cost]
+                if changed_skus:
+                    recosted_dates, recosted_usernames = data_service.recost_orders_for_skus(db, brand_id, changed_skus)
+                    affected_usernames.update(recosted_usernames)
+                    results['recost'] = f"Đã tính lại giá vốn cho {len(changed_skus)} SKU, ảnh hưởng {len(recosted_dates)} ngày."
+                    print(results['recost'])
         else:
             print("Không tìm thấy sheet Giá vốn.")
 
@@ -288,7 +307,6 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
         print(f"Đã tải {len(product_cost_map)} sản phẩm có giá vốn từ DB sau khi flush.")
 
         # --- BƯỚC 2: XỬ LÝ SHEET ĐƠN HÀNG ---
-        affected_usernames = set() # Tập hợp các username cần đồng bộ
         if order_sheet:
             print(f"Đang xử lý sheet '{order_sheet}'...")
             df_order = pd.read_excel(xls, sheet_name=order_sheet, header=1, dtype=str).fillna('')
@@ -298,6 +316,9 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                     affected_usernames.update(df_order['username'].dropna().unique().tolist())
                 
                 order_codes_in_file = df_order['order_id'].dropna().unique().tolist()
+                # order_code duy nhất theo brand chỉ được đảm bảo ở tầng ứng dụng (xem partitioning):
+                # giữ khóa tới khi commit để import đồng thời cùng brand không chèn trùng mã
+                partitioning.lock_brand_order_codes(db, brand_id)
                 existing_codes = {c for c, in db.query(models.Order.order_code).filter(models.Order.brand_id == brand_id, models.Order.order_code.in_(order_codes_in_file)).all()}
                 
                 # Tách ra 2 luồng: Thêm mới và Cập nhật
@@ -315,6 +336,7 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
 
                 orders_to_insert = []
                 orders_to_update = []
+                items_by_code = {} # order_code -> dòng sản phẩm, ghi vào order_items sau khi có ID đơn
                 
                 # --- HÀM HELPER ĐỂ XỬ LÝ DỮ LIỆU ĐƠN HÀNG ---
                 def process_order_group(group, is_update=False):
@@ -368,28 +390,14 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                         order_sku_price += item_sku_price
                         order_subsidy_amount += item_subsidy_amount
 
-                        item_dict = row.to_dict()
-                        item_dict['sku'] = sku
-                        item_dict['quantity'] = quantity
-                        item_dict['original_price'] = item_original_price
-                        item_dict['sku_price'] = item_sku_price
-                        item_dict['subsidy_amount'] = item_subsidy_amount
-                        
-                        redundant_keys = [
-                            'order_date', 'delivered_date', 'payment_method', 
-                            'cancel_reason', 'order_status', 'province', 
-                            'district', 'order_id', 'username', 
-                            'shipping_provider_name'
-                        ]
-                        # Remove also dynamic cols if exist
-                        if col_phone: redundant_keys.append(col_phone)
-                        if col_email: redundant_keys.append(col_email)
-                        if col_address: redundant_keys.append(col_address)
-                        if col_gender: redundant_keys.append(col_gender)
-
-                        for key in redundant_keys:
-                            item_dict.pop(key, None)
-                        items_list.append(item_dict)
+                        # Dòng sản phẩm -> bảng order_items (details chỉ giữ thuộc tính cấp đơn)
+                        items_list.append({
+                            "sku": sku,
+                            "quantity": quantity,
+                            "original_price": item_original_price,
+                            "sku_price": item_sku_price,
+                            "subsidy_amount": item_subsidy_amount,
+                        })
 
                     # Thông tin chung
                     username = first_row.get('username')
@@ -407,7 +415,6 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
 
                     # Tạo dict chi tiết (Quan trọng để lưu cancel_reason)
                     extra_details = {
-                        "items": items_list, 
                         "payment_method": payment_method_val,
                         "cancel_reason": cancel_reason_val, 
                         "shipping_provider_name": str(first_row.get('shipping_provider_name', '')),
@@ -436,7 +443,8 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                         "cogs": order_cogs, 
                         "details": extra_details, 
                         "brand_id": brand_id, 
-                        "source": source 
+                        "source": source,
+                        "items": items_list
                     }
 
                 # --- 2.1 XỬ LÝ ĐƠN HÀNG MỚI (INSERT) ---
@@ -444,6 +452,7 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                     for order_code, group in df_new_orders.groupby('order_id'):
                         data = process_order_group(group, is_update=False)
                         if data:
+                            items_by_code[data['order_code']] = data.pop('items')
                             orders_to_insert.append(data)
                     
                     if orders_to_insert:
@@ -466,6 +475,7 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                         
                         data = process_order_group(group, is_update=True)
                         if data:
+                            items_by_code[order_code] = data.pop('items')
                             # Với update, ta chỉ cập nhật các trường có thể thay đổi
                             update_data = {
                                 "id": existing_orders_map[order_code], # Bắt buộc phải có PK cho bulk_update
@@ -484,6 +494,29 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                         db.bulk_update_mappings(models.Order, orders_to_update)
                         results['order_update'] = f"Đã cập nhật trạng thái cho {len(orders_to_update)} đơn hàng cũ."
                         print(results['order_update'])
+
+                # --- 2.3 GHI DÒNG SẢN PHẨM (ORDER_ITEMS) ---
+                # Đơn cập nhật: thay toàn bộ dòng sản phẩm cũ bằng dòng trong file (giống việc ghi đè details trước đây)
+                if items_by_code:
+                    # (id, order_date) của đơn: khóa ngoại order_items -> orders (bảng phân vùng)
+                    order_keys = {
+                        code: (order_id, order_date) for order_id, code, order_date in db.query(
+                            models.Order.id, models.Order.order_code, models.Order.order_date
+                        ).filter(models.Order.brand_id == brand_id, models.Order.order_code.in_(list(items_by_code.keys())))
+                    }
+                    if orders_to_update:
+                        db.query(models.OrderItem).filter(
+                            models.OrderItem.order_id.in_([row['id'] for row in orders_to_update])
+                        ).delete(synchronize_session=False)
+
+                    item_rows = [
+                        {**item, "order_id": order_keys[code][0], "order_date": order_keys[code][1], "brand_id": brand_id}
+                        for code, items in items_by_code.items() if code in order_keys
+                        for item in items
+                    ]
+                    if item_rows:
+                        db.bulk_insert_mappings(models.OrderItem, item_rows)
+                        print(f"Đã ghi {len(item_rows)} dòng sản phẩm vào order_items.")
                 
                 results['order_sheet'] = f"Tổng xử lý: {len(orders_to_insert)} thêm mới, {len(orders_to_update)} cập nhật."
 
@@ -523,8 +556,12 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                 for _, row in df_revenue.iterrows():
                     # Chuẩn hóa dữ liệu từ file excel
                     order_code = to_clean_str(row.get('order_id'))
-                    transaction_date = parse_date(row.get('transaction_date'))
                     order_date = parse_date(row.get('order_date'))
+                    # transaction_date là khóa phân vùng của revenues: thiếu thì lấy ngày đặt đơn
+                    transaction_date = parse_date(row.get('transaction_date')) or order_date
+                    if not transaction_date:
+                        print(f"Bỏ qua dòng doanh thu thiếu ngày giao dịch và ngày đặt: Code='{order_code}'")
+                        continue
 
                     # [TỐI ƯU] Ghi nhận ngày order gốc để tính lại
                     if order_date:
@@ -567,6 +604,8 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
                 
                 if revenues_to_insert:
                     db.bulk_insert_mappings(models.Revenue, revenues_to_insert)
+                    # Cập nhật tổng hợp tài chính của các đơn vừa có dòng doanh thu mới (trước bước đồng bộ khách hàng)
+                    data_service.refresh_order_financials(db, brand_id, {r["order_code"] for r in revenues_to_insert})
                 results['revenue_sheet'] = f"Đã chuẩn bị import {len(revenues_to_insert)} dòng doanh thu mới."
                 print(results['revenue_sheet'])
 
@@ -616,6 +655,10 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
             print(f"Đang đồng bộ dữ liệu cho {len(affected_usernames)} khách hàng...")
             crud.customer.upsert_customers_from_orders(db, brand_id, list(affected_usernames))
 
+        # Ghi các ngày bị ảnh hưởng vào sổ tính lại - cùng transaction với dữ liệu vừa nạp
+        if affected_dates:
+            data_service.mark_days_dirty(db, brand_id, affected_dates, source, reason="import")
+
         # --- BƯỚC 6: COMMIT GIAO DỊCH ---
         print("Đang thực hiện commit dữ liệu vào DB...")
         db.commit()
@@ -634,7 +677,8 @@ def process_standard_file(db: Session, file_content: bytes, brand_id: int, sourc
             "status": "success", 
             "message": "Xử lý file và nạp dữ liệu thành công!", 
             "details": results,
-            "affected_dates": sorted_affected_dates
+            "affected_dates": sorted_affected_dates,
+            "recosted_dates": sorted(d.isoformat() for d in recosted_dates)
         }
 
     except Exception as e:
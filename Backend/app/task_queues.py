@@ -0,0 +1,363 @@
+# FILE: Backend/app/task_queues.py
+
+"""
+Hàng đợi Celery & giới hạn theo brand.
+
+- INTERACTIVE_QUEUE: request người dùng đang chờ (process_data_request) - worker gevent.
+- BULK_QUEUE: tính toán lại / làm nóng cache (chạy lâu) - worker prefork riêng.
+- Semaphore theo brand (Redis sorted set) để một brand không chiếm hết worker của một queue.
+- Metric: độ sâu hàng đợi (LLEN trên broker) và thời gian chờ (từ lúc publish đến lúc worker nhận).
+- Gộp (coalesce) yêu cầu tính toán lại: một job drain duy nhất theo brand (ngày "bẩn" nằm trong
+  bảng stats_dirty_days, xem data_service).
+"""
+
+import os
+import time
+import uuid
+from typing import Optional, Dict, Any, List
+
+import redis
+
+from cache import redis_client
+
+INTERACTIVE_QUEUE = "interactive"
+BULK_QUEUE = "bulk"
+ALL_QUEUES = [INTERACTIVE_QUEUE, BULK_QUEUE]
+
+# Số task tối đa của MỘT brand chạy đồng thời trên mỗi queue
+BRAND_CONCURRENCY_LIMITS = {
+    INTERACTIVE_QUEUE: int(os.getenv("INTERACTIVE_PER_BRAND_LIMIT", 20)),
+    BULK_QUEUE: int(os.getenv("BULK_PER_BRAND_LIMIT", 1)),
+}
+# Thời gian chờ trước khi thử lại khi brand đã hết slot
+BRAND_SLOT_RETRY_SECONDS = {
+    INTERACTIVE_QUEUE: int(os.getenv("INTERACTIVE_SLOT_RETRY_SECONDS", 1)),
+    BULK_QUEUE: int(os.getenv("BULK_SLOT_RETRY_SECONDS", 15)),
+}
+# Slot tự hết hạn nếu worker chết giữa chừng (không kịp release)
+BRAND_SLOT_TTL_SECONDS = int(os.getenv("BRAND_SLOT_TTL_SECONDS", 3 * 3600))
+
+# Số mẫu thời gian chờ gần nhất được giữ lại cho mỗi queue (tính avg / p95)
+WAIT_SAMPLE_SIZE = 500
+
+# Broker (Redis db1): mỗi queue là một LIST cùng tên (+ các list phụ theo priority step)
+_broker_client = redis.Redis(
+    host=os.getenv("REDIS_HOST", "cache"),
+    port=6379,
+    db=1,
+    decode_responses=True,
+    password=os.getenv("REDIS_PASSWORD")
+)
+_PRIORITY_SEP = "\x06\x16"
+_PRIORITY_STEPS = [3, 6, 9]
+
+def _slot_key(queue: str, brand_id: int) -> str:
+    return f"brand_slots:{queue}:{brand_id}"
+
+def _wait_metrics_key(queue: str) -> str:
+    return f"queue_metrics:{queue}"
+
+def _wait_samples_key(queue: str) -> str:
+    return f"queue_wait_samples:{queue}"
+
+# ==============================================================================
+# 1. SEMAPHORE THEO BRAND
+# ==============================================================================
+
+# Xóa slot hết hạn -> nếu còn chỗ thì chiếm slot (atomic)
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+_acquire = redis_client.register_script(_ACQUIRE_SCRIPT)
+
+def acquire_brand_slot(queue: str, brand_id: int, token: Optional[str] = None) -> Optional[str]:
+    """
+    Chiếm một slot chạy cho brand trên queue. Trả về token (dùng để release) hoặc None nếu hết slot.
+    Redis lỗi -> cho chạy luôn (không chặn xử lý vì lỗi giám sát).
+    """
+    limit = BRAND_CONCURRENCY_LIMITS.get(queue)
+    token = token or uuid.uuid4().hex
+    if not limit or limit <= 0:
+        return token
+    now = time.time()
+    try:
+        acquired = _acquire(
+            keys=[_slot_key(queue, brand_id)],
+            args=[now, now + BRAND_SLOT_TTL_SECONDS, limit, token, BRAND_SLOT_TTL_SECONDS],
+        )
+    except Exception as e:
+        print(f"WARNING: Không kiểm tra được giới hạn brand {brand_id} ({queue}): {e}")
+        return token
+    return token if acquired else None
+
+def release_brand_slot(queue: str, brand_id: int, token: str):
+    try:
+        redis_client.zrem(_slot_key(queue, brand_id), token)
+    except Exception as e:
+        print(f"WARNING: Không trả được slot brand {brand_id} ({queue}): {e}")
+
+def run_with_brand_slot(task, queue: str, brand_id: int, func, *args, **kwargs):
+    """
+    Chạy func(*args, **kwargs) khi brand còn slot trên queue.
+    Hết slot -> task.retry (countdown) để trả worker cho brand khác. Gọi trực tiếp (không qua worker) thì chạy luôn.
+    """
+    if task.request.called_directly:
+        return func(*args, **kwargs)
+
+    token = acquire_brand_slot(queue, brand_id, token=task.request.id)
+    if token is None:
+        print(f"WORKER: Brand {brand_id} đã dùng hết slot trên queue '{queue}', thử lại sau.")
+        raise task.retry(countdown=BRAND_SLOT_RETRY_SECONDS.get(queue, 5), max_retries=None)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        release_brand_slot(queue, brand_id, token)
+
+def active_brand_slots(queue: str) -> Dict[str, int]:
+    """Số task đang chạy theo từng brand trên queue (bỏ qua slot đã hết hạn)."""
+    now = time.time()
+    usage = {}
+    for key in redis_client.scan_iter(f"brand_slots:{queue}:*"):
+        count = redis_client.zcount(key, now, "+inf")
+        if count:
+            usage[key.rsplit(":", 1)[-1]] = count
+    return usage
+
+# ==============================================================================
+# 2. METRIC HÀNG ĐỢI
+# ==============================================================================
+
+def record_queue_wait(queue: str, wait_seconds: float):
+    """Ghi nhận thời gian chờ của một task (gọi từ signal task_prerun)."""
+    if not queue or wait_seconds < 0:
+        return
+    wait_ms = round(wait_seconds * 1000, 1)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(_wait_metrics_key(queue), "tasks", 1)
+        pipe.hincrbyfloat(_wait_metrics_key(queue), "total_wait_ms", wait_ms)
+        pipe.hset(_wait_metrics_key(queue), "last_wait_ms", wait_ms)
+        pipe.lpush(_wait_samples_key(queue), wait_ms)
+        pipe.ltrim(_wait_samples_key(queue), 0, WAIT_SAMPLE_SIZE - 1)
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi được metric queue '{queue}': {e}")
+
+def get_queue_depth(queue: str) -> int:
+    keys = [queue] + [f"{queue}{_PRIORITY_SEP}{step}" for step in _PRIORITY_STEPS]
+    pipe = _broker_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.llen(key)
+    return sum(pipe.execute())
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))
+    return ordered[index]
+
+def get_queue_stats(queue: str) -> Dict[str, Any]:
+    metrics = redis_client.hgetall(_wait_metrics_key(queue))
+    samples = [float(v) for v in redis_client.lrange(_wait_samples_key(queue), 0, -1)]
+    tasks = int(metrics.get("tasks", 0))
+    total_wait = float(metrics.get("total_wait_ms", 0))
+    return {
+        "queue": queue,
+        "depth": get_queue_depth(queue),
+        "tasks_started": tasks,
+        "avg_wait_ms": round(total_wait / tasks, 1) if tasks else 0.0,
+        "recent_avg_wait_ms": round(sum(samples) / len(samples), 1) if samples else 0.0,
+        "recent_p95_wait_ms": _percentile(samples, 0.95),
+        "last_wait_ms": float(metrics.get("last_wait_ms", 0)),
+        "per_brand_limit": BRAND_CONCURRENCY_LIMITS.get(queue, 0),
+        "active_by_brand": active_brand_slots(queue),
+    }
+
+# ==============================================================================
+# 3. GỘP YÊU CẦU TÍNH TOÁN LẠI THEO BRAND (DEBOUNCE / COALESCE)
+# ==============================================================================
+
+# Cửa sổ debounce: các upload/xóa liên tiếp trong khoảng này được gộp vào một lần tính
+RECALC_DEBOUNCE_SECONDS = int(os.getenv("RECALC_DEBOUNCE_SECONDS", 3))
+# Cờ "đã có job drain đang chờ" tự hết hạn để không kẹt vĩnh viễn nếu task bị mất
+RECALC_PENDING_TTL_SECONDS = int(os.getenv("RECALC_PENDING_TTL_SECONDS", 900))
+# Khóa brand: chỉ một job tính toán lại chạy cho mỗi brand tại một thời điểm
+RECALC_LOCK_TIMEOUT_SECONDS = int(os.getenv("RECALC_LOCK_TIMEOUT_SECONDS", 2 * 3600))
+
+def _pending_key(brand_id: int) -> str:
+    return f"recalc_pending:{brand_id}"
+
+def recalc_lock(brand_id: int):
+    """Khóa Redis (không chặn) cho việc tính toán lại của một brand."""
+    return redis_client.lock(f"recalc_lock:{brand_id}", timeout=RECALC_LOCK_TIMEOUT_SECONDS, blocking=False)
+
+def release_recalc_lock(brand_id: int, token: str):
+    """Nhả khóa theo token - dùng khi khóa được chuyển giao cho task khác (callback của chord)."""
+    try:
+        recalc_lock(brand_id).do_release(token)
+    except Exception as e:
+        print(f"WARNING: Không nhả được khóa tính toán lại của brand {brand_id}: {e}")
+
+def claim_pending_drain(brand_id: int, task_id: str) -> Optional[str]:
+    """
+    Đăng ký job drain cho brand. Trả về None nếu đăng ký thành công (caller phải enqueue task_id),
+    hoặc task id của job drain đang chờ sẵn (caller chỉ cần chờ job đó).
+    """
+    key = _pending_key(brand_id)
+    for _ in range(3):
+        if redis_client.set(key, task_id, nx=True, ex=RECALC_PENDING_TTL_SECONDS):
+            return None
+        existing_task_id = redis_client.get(key)
+        if existing_task_id:
+            return existing_task_id
+        # Cờ vừa được gỡ giữa SET và GET (job drain đã bắt đầu chạy) -> đăng ký lại
+    # Cờ liên tục đổi chủ: enqueue thêm một job cũng an toàn (khóa brand + sổ stats_dirty_days)
+    return None
+
+def clear_pending_drain(brand_id: int):
+    """
+    Gỡ cờ pending khi job drain bắt đầu chạy.
+    Producer ghi thêm vào sổ stats_dirty_days sau thời điểm này sẽ tự lên lịch một job drain mới.
+    """
+    redis_client.delete(_pending_key(brand_id))
+
+# ==============================================================================
+# 4. TIẾN ĐỘ & CHECKPOINT CỦA LẦN TÍNH TOÁN LẠI TOÀN BỘ
+# ==============================================================================
+
+# Số lần tự động chạy tiếp (resume) sau khi lỗi trước khi dừng hẳn
+RECALC_MAX_RESUME_ATTEMPTS = int(os.getenv("RECALC_MAX_RESUME_ATTEMPTS", 3))
+# reason của dòng stats_dirty_days do resume tự động ghi - chỉ yêu cầu loại này mới được chạy tiếp checkpoint
+RECALC_RESUME_REASON = "resume"
+# Checkpoint quá cũ thì bỏ, tính lại từ đầu
+RECALC_CHECKPOINT_MAX_AGE_SECONDS = int(os.getenv("RECALC_CHECKPOINT_MAX_AGE_SECONDS", 24 * 3600))
+
+def _progress_key(brand_id: int) -> str:
+    return f"recalc_progress:{brand_id}"
+
+def get_recalc_progress(brand_id: int) -> Dict[str, Any]:
+    return redis_client.hgetall(_progress_key(brand_id))
+
+def start_recalc_progress(brand_id: int, **fields):
+    """Bắt đầu một lần chạy mới: xóa tiến độ / checkpoint của lần trước."""
+    try:
+        redis_client.delete(_progress_key(brand_id))
+    except Exception as e:
+        print(f"WARNING: Không xóa được tiến độ cũ của brand {brand_id}: {e}")
+    update_recalc_progress(brand_id, status="running", started_at=time.time(), **fields)
+
+def increment_recalc_progress(brand_id: int, field: str, amount: int = 1):
+    """Cộng dồn atomic (nhiều shard cùng ghi)."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(_progress_key(brand_id), field, amount)
+        pipe.hset(_progress_key(brand_id), "updated_at", time.time())
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi được tiến độ tính toán lại của brand {brand_id}: {e}")
+
+def update_recalc_progress(brand_id: int, **fields):
+    """Cập nhật một phần hash tiến độ (bỏ qua giá trị None)."""
+    mapping = {k: v for k, v in fields.items() if v is not None}
+    mapping["updated_at"] = time.time()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(_progress_key(brand_id), mapping=mapping)
+        pipe.expire(_progress_key(brand_id), 7 * 24 * 3600)
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi được tiến độ tính toán lại của brand {brand_id}: {e}")
+
+# Đổi run_id chỉ khi lần chạy hiện tại vẫn là ARGV[1] (atomic với các shard đang đọc run_id)
+_FENCE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run_id') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'run_id', ARGV[2], 'fenced_run_id', ARGV[1])
+    return 1
+end
+return 0
+"""
+_fence = redis_client.register_script(_FENCE_SCRIPT)
+
+def fence_recalc_run(brand_id: int, run_id: str) -> Optional[str]:
+    """
+    Chặn (fence) lần chạy run_id: đổi sang run_id mới, giữ nguyên checkpoint để lần resume chạy tiếp.
+    Các shard còn đang chạy của run_id cũ thấy run_id đã đổi trước khi commit khối tiếp theo và tự dừng.
+    Trả về run_id mới, hoặc None nếu run_id không còn là lần chạy hiện tại.
+    """
+    new_run_id = uuid.uuid4().hex
+    try:
+        if _fence(keys=[_progress_key(brand_id)], args=[run_id, new_run_id]):
+            return new_run_id
+    except Exception as e:
+        print(f"WARNING: Không fence được lần tính {run_id} của brand {brand_id}: {e}")
+    return None
+
+def is_current_recalc_run(brand_id: int, run_id: str) -> bool:
+    """Shard kiểm tra trước mỗi lần commit: False khi lần chạy đã bị fence / thay thế."""
+    try:
+        return redis_client.hget(_progress_key(brand_id), "run_id") == run_id
+    except Exception as e:
+        # Redis lỗi: không thể biết -> dừng shard (resume sẽ tính lại khối này)
+        print(f"WARNING: Không đọc được run_id của brand {brand_id}: {e}")
+        return False
+
+def get_resume_checkpoint(brand_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Trả về lần chạy dang dở (failed / running nhưng worker đã chết) còn đủ mới để chạy tiếp,
+    hoặc None nếu phải bắt đầu lại từ đầu.
+    Chỉ gọi cho yêu cầu RECALC_RESUME_REASON: yêu cầu tính lại mới luôn bắt đầu lần chạy mới và
+    start_recalc_progress xóa checkpoint cũ.
+    """
+    progress = get_recalc_progress(brand_id)
+    if not progress or progress.get("status") == "completed" or not progress.get("run_id"):
+        return None
+    if time.time() - float(progress.get("updated_at", 0)) > RECALC_CHECKPOINT_MAX_AGE_SECONDS:
+        return None
+    return progress
+
+def is_recalc_pending(brand_id: int) -> bool:
+    return bool(redis_client.exists(_pending_key(brand_id)))
+
+# ==============================================================================
+# 5. TIẾN ĐỘ JOB NỀN THEO BRAND (XÓA / NHÂN BẢN)
+# ==============================================================================
+
+BRAND_JOB_DELETE = "delete"
+BRAND_JOB_CLONE = "clone"
+# Giữ tiến độ một thời gian sau khi xong để client kịp đọc trạng thái cuối
+BRAND_JOB_PROGRESS_TTL_SECONDS = int(os.getenv("BRAND_JOB_PROGRESS_TTL_SECONDS", 24 * 3600))
+
+def _brand_job_key(job: str, brand_id: int) -> str:
+    return f"brand_{job}_progress:{brand_id}"
+
+def get_brand_job_progress(job: str, brand_id: int) -> Dict[str, Any]:
+    return redis_client.hgetall(_brand_job_key(job, brand_id))
+
+def update_brand_job_progress(job: str, brand_id: int, **fields):
+    """Cập nhật một phần hash tiến độ (bỏ qua giá trị None)."""
+    mapping = {k: v for k, v in fields.items() if v is not None}
+    mapping["updated_at"] = time.time()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(_brand_job_key(job, brand_id), mapping=mapping)
+        pipe.expire(_brand_job_key(job, brand_id), BRAND_JOB_PROGRESS_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi được tiến độ job {job} của brand {brand_id}: {e}")
+
+def increment_brand_job_progress(job: str, brand_id: int, rows: int):
+    """Cộng dồn số dòng đã xử lý."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(_brand_job_key(job, brand_id), "processed_rows", rows)
+        pipe.hset(_brand_job_key(job, brand_id), "updated_at", time.time())
+        pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Không ghi được tiến độ job {job} của brand {brand_id}: {e}")
@@ -0,0 +1,33 @@
+"""Định dạng cột của daily-kpis (format=columnar): cùng số liệu với định dạng từng ngày."""
+
+from datetime import date
+
+import pytest
+
+import schemas
+from services import dashboard_service
+
+
+def test_resolve_columnar_metrics():
+    assert dashboard_service.resolve_columnar_metrics(None) == dashboard_service.COLUMNAR_METRICS
+    # Giữ thứ tự, bỏ trùng
+    assert dashboard_service.resolve_columnar_metrics(["gmv", "net_revenue", "gmv"]) == ["gmv", "net_revenue"]
+    with pytest.raises(ValueError):
+        dashboard_service.resolve_columnar_metrics(["gmv", "top_products"])
+
+
+def test_columnar_series_match_rows():
+    items = [
+        schemas.KpiSet(date=date(2024, 1, 1), gmv=100.0, net_revenue=80.0, total_orders=3),
+        schemas.KpiSet(date=date(2024, 1, 2), gmv=50.0, net_revenue=40.0, total_orders=1),
+    ]
+    metrics = ["gmv", "total_orders"]
+
+    columnar = dashboard_service.build_columnar_kpis(items, metrics)
+
+    assert columnar["dates"] == ["2024-01-01", "2024-01-02"]
+    assert set(columnar["series"]) == set(metrics)
+    for index, item in enumerate(items):
+        row = item.model_dump()
+        for name in metrics:
+            assert columnar["series"][name][index] == row[name]
@@ -0,0 +1,57 @@
+"""Tên / khoảng tháng của partition và việc thử lại CREATE ... PARTITION OF khi hết lock_timeout."""
+
+from datetime import date, datetime
+
+from sqlalchemy.exc import OperationalError
+
+import partitioning
+
+
+class _PgError(Exception):
+    def __init__(self, pgcode):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+class _FakeConn:
+    """Raise lần lượt các lỗi trong `errors`, sau đó chạy thành công."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+        if self.errors:
+            raise OperationalError(str(statement), {}, self.errors.pop(0))
+
+
+def test_month_helpers():
+    assert partitioning.month_start(datetime(2024, 3, 17, 10, 30)) == date(2024, 3, 1)
+    assert partitioning.add_months(date(2024, 11, 1), 3) == date(2025, 2, 1)
+    assert partitioning.partition_name("orders", date(2024, 2, 1)) == "orders_p2024_02"
+    assert partitioning.months_between(date(2024, 11, 20), date(2025, 1, 5)) == [
+        date(2024, 11, 1), date(2024, 12, 1), date(2025, 1, 1)
+    ]
+
+
+def test_create_partition_retries_on_lock_timeout(monkeypatch):
+    monkeypatch.setattr(partitioning, "PARTITION_LOCK_RETRY_DELAY", 0)
+    conn = _FakeConn([_PgError(partitioning.LOCK_NOT_AVAILABLE)])
+
+    assert partitioning._create_partition(conn, "orders", "orders_p2024_02", date(2024, 2, 1))
+    assert len(conn.statements) == 2
+    assert "FOR VALUES FROM ('2024-02-01') TO ('2024-03-01')" in conn.statements[-1]
+
+
+def test_create_partition_gives_up(monkeypatch):
+    monkeypatch.setattr(partitioning, "PARTITION_LOCK_RETRY_DELAY", 0)
+    # Hết lượt chờ khóa
+    conn = _FakeConn([_PgError(partitioning.LOCK_NOT_AVAILABLE)] * partitioning.PARTITION_LOCK_RETRIES)
+    assert not partitioning._create_partition(conn, "orders", "orders_p2024_02", date(2024, 2, 1))
+    assert len(conn.statements) == partitioning.PARTITION_LOCK_RETRIES
+
+    # Lỗi khác (vd. DEFAULT đã chứa dòng của tháng) -> không thử lại
+    conn = _FakeConn([_PgError("23514")])
+    assert not partitioning._create_partition(conn, "orders", "orders_p2024_02", date(2024, 2, 1))
+    assert len(conn.statements) == 1
@@ -0,0 +1,33 @@
+"""Metric chờ checkout pool DB: mỗi lần checkout chỉ một lần gọi Redis (script giả)."""
+
+import worker_utils
+
+
+class _FakeScript:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, keys, args):
+        if self.fail:
+            raise ConnectionError("redis down")
+        self.calls.append((keys, args))
+        return 1
+
+
+def test_record_checkout_wait_is_one_round_trip(monkeypatch):
+    script = _FakeScript()
+    monkeypatch.setattr(worker_utils, "_record_checkout", script)
+
+    worker_utils._record_checkout_wait(12.34567)
+    worker_utils._record_checkout_wait(250.0)
+
+    assert len(script.calls) == 2
+    keys, args = script.calls[0]
+    assert keys == [worker_utils.POOL_METRICS_KEY]
+    assert args[:4] == [12.346, worker_utils.SLOW_CHECKOUT_MS, worker_utils.POOL_SIZE, worker_utils.POOL_MAX_OVERFLOW]
+
+
+def test_record_checkout_wait_never_raises(monkeypatch):
+    monkeypatch.setattr(worker_utils, "_record_checkout", _FakeScript(fail=True))
+    worker_utils._record_checkout_wait(5.0)
@@ -0,0 +1,96 @@
+"""
+Giá trị mỗi ngày của các cột lũy kế (data_service._cumulative_day_value) cộng qua một khoảng, rồi
+dashboard_service.aggregate_from_range_totals, phải cho cùng KPI như kpi_utils.aggregate_data_points
+khi lọc theo một nguồn (dòng daily_analytics không có total_customers).
+
+Biểu thức SQL của từng ngày được chạy thật (SQLite in-memory). Phần window / LATERAL của
+_REFRESH_CUMULATIVE_SQL và _RANGE_TOTALS_SQL cần Postgres và KHÔNG được kiểm tra ở đây.
+"""
+
+import sqlite3
+
+import pytest
+
+import models
+
+import kpi_utils
+from services import dashboard_service, data_service
+
+# Dòng daily_analytics của MỘT nguồn qua nhiều ngày (không có total_customers -> churn dùng trung bình đơn giản)
+ANALYTICS_ROWS = [
+    {
+        "net_revenue": 1200.0, "gmv": 1500.0, "profit": 300.0, "total_cost": 900.0, "cogs": 700.0,
+        "execution_cost": 150.0, "ad_spend": 50.0, "impressions": 1000, "clicks": 40, "conversions": 4, "reach": 800,
+        "total_orders": 10, "completed_orders": 8, "cancelled_orders": 1, "refunded_orders": 1, "bomb_orders": 0,
+        "unique_skus_sold": 5, "total_quantity_sold": 14, "new_customers": 6, "returning_customers": 2,
+        "avg_processing_time": 1.5, "avg_shipping_time": 3.0, "avg_repurchase_cycle": 20.0, "churn_rate": 0.3,
+    },
+    {
+        "net_revenue": 800.0, "gmv": 950.0, "profit": 120.0, "total_cost": 680.0, "cogs": 500.0,
+        "execution_cost": 100.0, "ad_spend": 80.0, "impressions": 2000, "clicks": 50, "conversions": 2, "reach": 1500,
+        "total_orders": 6, "completed_orders": 5, "cancelled_orders": 1, "refunded_orders": 0, "bomb_orders": 1,
+        "unique_skus_sold": 3, "total_quantity_sold": 7, "new_customers": 3, "returning_customers": 0,
+        "avg_processing_time": 2.0, "avg_shipping_time": 2.5, "avg_repurchase_cycle": 35.0, "churn_rate": 0.0,
+    },
+    {
+        "net_revenue": 0.0, "gmv": 0.0, "profit": 0.0, "total_cost": 0.0, "cogs": 0.0,
+        "execution_cost": 0.0, "ad_spend": 20.0, "impressions": 500, "clicks": 10, "conversions": 0, "reach": 400,
+        "total_orders": 0, "completed_orders": 0, "cancelled_orders": 0, "refunded_orders": 0, "bomb_orders": 0,
+        "unique_skus_sold": 0, "total_quantity_sold": 0, "new_customers": 0, "returning_customers": 0,
+        "avg_processing_time": 0.0, "avg_shipping_time": 0.0, "avg_repurchase_cycle": 0.0, "churn_rate": 0.5,
+    },
+]
+
+COMPARED_METRICS = [
+    "net_revenue", "gmv", "profit", "total_cost", "ad_spend", "total_orders", "completed_orders",
+    "cancelled_orders", "new_customers", "returning_customers", "roi", "profit_margin", "aov", "upt",
+    "take_rate", "completion_rate", "cancellation_rate", "bomb_rate", "ctr", "cpc", "cpm", "cpa", "roas",
+    "avg_processing_time", "avg_shipping_time", "avg_repurchase_cycle", "churn_rate", "avg_daily_orders",
+]
+
+
+def _range_totals(rows):
+    """Tổng trên các ngày của biểu thức _cumulative_day_value (đúng SQL được dựng cho daily_analytics)."""
+    columns = sorted(rows[0])
+    conn = sqlite3.connect(":memory:")
+    conn.execute(f"CREATE TABLE daily_analytics ({', '.join(columns)})")
+    conn.executemany(
+        f"INSERT INTO daily_analytics VALUES ({', '.join('?' for _ in columns)})",
+        [[row[c] for c in columns] for row in rows]
+    )
+    totals = {}
+    for column in data_service.CUMULATIVE_COLUMNS:
+        expression = data_service._cumulative_day_value(models.DailyAnalytics, column)
+        totals[column] = conn.execute(f"SELECT SUM({expression}) FROM daily_analytics").fetchone()[0]
+    conn.close()
+    return totals
+
+
+def test_cumulative_day_value_expressions():
+    # Cột không có ở bảng nguồn (daily_analytics.total_customers) -> 0
+    assert data_service._cumulative_day_value(models.DailyAnalytics, "total_customers") == "0"
+    assert data_service._cumulative_day_value(models.DailyAnalytics, "weighted_churn") == "0"
+    assert data_service._cumulative_day_value(models.DailyStat, "weighted_churn") == \
+        "COALESCE(churn_rate, 0) * COALESCE(total_customers, 0)"
+    # Trung bình đơn giản dự phòng: tổng và số ngày chỉ tính ngày có giá trị > 0
+    assert data_service._cumulative_day_value(models.DailyAnalytics, "churn_rate_sum") == \
+        "CASE WHEN churn_rate > 0 THEN churn_rate ELSE 0 END"
+    assert data_service._cumulative_day_value(models.DailyAnalytics, "churn_rate_days") == \
+        "CASE WHEN churn_rate > 0 THEN 1 ELSE 0 END"
+
+
+def test_range_totals_match_daily_aggregation_for_filtered_source():
+    day_count = len(ANALYTICS_ROWS)
+
+    expected = kpi_utils.aggregate_data_points([dict(row) for row in ANALYTICS_ROWS])
+    expected["_day_count"] = day_count
+    expected = kpi_utils.calculate_derived_metrics(expected)
+
+    actual = dashboard_service.aggregate_from_range_totals(_range_totals(ANALYTICS_ROWS))
+    actual["_day_count"] = day_count
+    actual = kpi_utils.calculate_derived_metrics(actual)
+
+    for metric in COMPARED_METRICS:
+        assert actual[metric] == pytest.approx(expected[metric]), metric
+    # Không có total_customers -> churn rơi về trung bình đơn giản của các ngày churn > 0
+    assert actual["churn_rate"] == pytest.approx((0.3 + 0.5) / 2)
@@ -0,0 +1,79 @@
+"""
+Job drain và sổ stats_dirty_days: chỉ xóa dòng của ngày tính lại THÀNH CÔNG; ngày lỗi giữ dòng sổ
+(job quét định kỳ tính lại) và không bị đọc lại trong cùng lần drain. Sổ và phần tính toán được giả lập.
+"""
+
+from contextlib import contextmanager
+from datetime import date
+
+import celery_worker
+from services import data_service
+
+
+class _Ledger:
+    def __init__(self, rows):
+        self.rows = list(rows)  # (id, day, source, reason)
+
+    def peek(self, db, brand_id, limit=None, exclude_ids=None):
+        rows = [row for row in self.rows if row[0] not in (exclude_ids or ())]
+        return rows[:limit] if limit else rows
+
+    def ack(self, db, ids):
+        ids = set(ids)
+        self.rows = [row for row in self.rows if row[0] not in ids]
+
+
+class _NullSession:
+    def commit(self):
+        pass
+
+
+def _drain(monkeypatch, ledger, failing_days, batch=2):
+    @contextmanager
+    def fake_session():
+        yield _NullSession()
+
+    recalculated = []
+
+    def fake_recalculate(brand_id, target_dates_iso, source=None):
+        recalculated.append((source, target_dates_iso))
+        return [date.fromisoformat(d) for d in target_dates_iso if date.fromisoformat(d) in failing_days]
+
+    monkeypatch.setattr(celery_worker, "get_db_session", fake_session)
+    monkeypatch.setattr(celery_worker, "RECALC_LEDGER_BATCH", batch)
+    monkeypatch.setattr(celery_worker.task_queues, "clear_pending_drain", lambda brand_id: None)
+    monkeypatch.setattr(celery_worker, "_recalculate_brand_data_specific_dates", fake_recalculate)
+    monkeypatch.setattr(data_service, "peek_dirty_days", ledger.peek)
+    monkeypatch.setattr(data_service, "ack_dirty_days", ledger.ack)
+    return celery_worker._drain_brand_recalculation(1), recalculated
+
+
+def test_drain_acks_only_successful_days(monkeypatch):
+    d1, d2, d3 = date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3)
+    ledger = _Ledger([
+        (1, d1, "shopee", "import"),
+        (2, d2, "shopee", "import"),
+        (3, d2, "tiktok", "import"),
+        (4, d3, None, "delete"),
+    ])
+
+    result, recalculated = _drain(monkeypatch, ledger, failing_days={d2})
+
+    # Ngày lỗi còn nguyên dòng sổ, mỗi dòng chỉ được đọc một lần trong lần drain (lô 2 dòng)
+    assert [row[0] for row in ledger.rows] == [2, 3]
+    assert result == {"mode": "dates", "days": 2}
+    assert recalculated == [
+        ("shopee", ["2024-01-01", "2024-01-02"]),
+        ("tiktok", ["2024-01-02"]),
+        (None, ["2024-01-03"]),
+    ]
+
+
+def test_drain_merges_sources_of_the_same_day(monkeypatch):
+    d1 = date(2024, 1, 1)
+    ledger = _Ledger([(1, d1, "shopee", "import"), (2, d1, "tiktok", "import")])
+
+    result, recalculated = _drain(monkeypatch, ledger, failing_days=set())
+
+    assert recalculated == [(None, ["2024-01-01"])]
+    assert ledger.rows == [] and result["days"] == 1
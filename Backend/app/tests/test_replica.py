@@ -0,0 +1,78 @@
+"""Định tuyến phiên đọc: so sánh LSN và chọn replica / primary (Redis và session giả)."""
+
+from types import SimpleNamespace
+
+import replica
+
+
+class _FakeRedis:
+    def __init__(self, pins=None):
+        self.pins = pins or {}
+
+    def get(self, key):
+        return self.pins.get(key)
+
+
+class _FakeSession:
+    def __init__(self, name, brands, replay_lsn=None, fail=False):
+        self.name = name
+        self.brands = brands
+        self.replay_lsn = replay_lsn
+        self.fail = fail
+        self.closed = False
+
+    def execute(self, statement):
+        return SimpleNamespace(scalar=lambda: self.replay_lsn)
+
+    def lookup(self, slug):
+        if self.fail:
+            raise RuntimeError("replica down")
+        return self.brands.get(slug)
+
+    def close(self):
+        self.closed = True
+
+
+def _route(monkeypatch, replica_session, pins=None):
+    monkeypatch.setattr(replica, "redis_client", _FakeRedis(pins))
+    primary = _FakeSession("primary", {"shop": SimpleNamespace(id=7)})
+    db, brand = replica.open_brand_read_session(
+        lambda session: session.lookup("shop"), lambda: primary, lambda: replica_session
+    )
+    return db, brand
+
+
+def test_parse_lsn_orders_segments():
+    assert replica.parse_lsn(None) is None
+    assert replica.parse_lsn("0/10") == 16
+    assert replica.parse_lsn("1/0") > replica.parse_lsn("0/FFFFFFFF")
+    assert replica._replica_caught_up("16/B374D848", "16/B374D848")
+    assert not replica._replica_caught_up("16/B374D848", "16/B374D847")
+    assert not replica._replica_caught_up("16/B374D848", None)
+
+
+def test_brand_resolved_on_replica_when_not_pinned(monkeypatch):
+    replica_session = _FakeSession("replica", {"shop": SimpleNamespace(id=7)})
+    db, brand = _route(monkeypatch, replica_session)
+    assert db is replica_session and brand.id == 7 and not replica_session.closed
+
+
+def test_pinned_brand_waits_for_replay(monkeypatch):
+    pins = {"replica_pin:7": "0/20"}
+    caught_up = _FakeSession("replica", {"shop": SimpleNamespace(id=7)}, replay_lsn="0/20")
+    assert _route(monkeypatch, caught_up, pins)[0] is caught_up
+
+    lagging = _FakeSession("replica", {"shop": SimpleNamespace(id=7)}, replay_lsn="0/1F")
+    db, brand = _route(monkeypatch, lagging, pins)
+    assert db.name == "primary" and brand.id == 7 and lagging.closed
+
+
+def test_missing_or_broken_replica_falls_back_to_primary(monkeypatch):
+    # Brand vừa tạo, replica chưa có
+    not_replicated = _FakeSession("replica", {})
+    db, brand = _route(monkeypatch, not_replicated)
+    assert db.name == "primary" and brand.id == 7 and not_replicated.closed
+
+    broken = _FakeSession("replica", {}, fail=True)
+    db, brand = _route(monkeypatch, broken)
+    assert db.name == "primary" and brand.id == 7 and broken.closed
@@ -1,6 +1,7 @@
 # FILE: Backend/app/worker_utils.py
 
 import os
+import time
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
@@ -9,18 +10,171 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if DATABASE_URL is None:
     raise ValueError("Biến môi trường DATABASE_URL chưa được thiết lập!")
 
+# ==============================================================================
+# CHẾ ĐỘ WORKER: gevent (I/O, nhiều greenlet) hoặc prefork (CPU, tính toán lại)
+# ==============================================================================
+
+def _gevent_is_patched() -> bool:
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched("socket")
+    except ImportError:
+        return False
+
+# WORKER_POOL do docker-compose truyền vào; nếu không có thì tự nhận diện qua monkey-patch của Celery -P gevent
+WORKER_POOL = os.getenv("WORKER_POOL") or ("gevent" if _gevent_is_patched() else "prefork")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 100 if WORKER_POOL == "gevent" else 1))
+
+def gevent_wait_callback(conn, timeout=None):
+    """
+    Wait callback cho psycopg2 (tương đương psycogreen): thay vì block cả hub khi chờ socket,
+    nhường quyền cho greenlet khác qua gevent.socket.wait_read / wait_write.
+    """
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+if WORKER_POOL == "gevent":
+    from psycopg2 import extensions as _pg_extensions
+    _pg_extensions.set_wait_callback(gevent_wait_callback)
+
+# ==============================================================================
+# ENGINE & POOL (kích thước theo concurrency của worker)
+# ==============================================================================
+
+def _pool_settings():
+    """
+    gevent: nhiều greenlet dùng chung một process -> pool lớn nhưng có trần (WORKER_DB_POOL_MAX)
+    để không vượt max_connections của Postgres. prefork: mỗi process chỉ chạy 1 task tại một thời điểm.
+    """
+    if WORKER_POOL == "gevent":
+        default_size = min(WORKER_CONCURRENCY, int(os.getenv("WORKER_DB_POOL_MAX", 40)))
+        default_overflow = 10
+    else:
+        default_size, default_overflow = 2, 2
+    return (
+        int(os.getenv("WORKER_DB_POOL_SIZE", default_size)),
+        int(os.getenv("WORKER_DB_MAX_OVERFLOW", default_overflow)),
+        int(os.getenv("WORKER_DB_POOL_TIMEOUT", 30)),
+    )
+
+POOL_SIZE, POOL_MAX_OVERFLOW, POOL_TIMEOUT = _pool_settings()
+
 # Tạo engine và session factory một lần duy nhất khi module này được import
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=POOL_SIZE,
+    max_overflow=POOL_MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_pre_ping=True
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Read replica (tùy chọn) cho các request chỉ đọc của worker - định tuyến theo brand trong replica.py
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL") or None
+replica_engine = None
+ReplicaSessionLocal = None
+if REPLICA_DATABASE_URL:
+    replica_engine = create_engine(
+        REPLICA_DATABASE_URL,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_pre_ping=True,
+        connect_args={"options": "-c default_transaction_read_only=on"}
+    )
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+
+# ==============================================================================
+# METRIC: THỜI GIAN CHỜ LẤY KẾT NỐI TỪ POOL
+# ==============================================================================
+
+POOL_METRICS_KEY = f"worker_db_pool_metrics:{WORKER_POOL}"
+SLOW_CHECKOUT_MS = float(os.getenv("WORKER_DB_SLOW_CHECKOUT_MS", 100))
+
+# Cộng dồn toàn bộ metric + cập nhật max trong MỘT lần gọi Redis (atomic, không race giữa các worker)
+_RECORD_CHECKOUT_SCRIPT = """
+local wait = tonumber(ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'checkouts', 1)
+redis.call('HINCRBYFLOAT', KEYS[1], 'total_wait_ms', ARGV[1])
+if wait >= tonumber(ARGV[2]) then
+    redis.call('HINCRBY', KEYS[1], 'slow_checkouts', 1)
+end
+redis.call('HSET', KEYS[1], 'last_wait_ms', ARGV[1], 'pool_size', ARGV[3], 'max_overflow', ARGV[4], 'checked_out', ARGV[5])
+if wait > tonumber(redis.call('HGET', KEYS[1], 'max_wait_ms') or '0') then
+    redis.call('HSET', KEYS[1], 'max_wait_ms', ARGV[1])
+end
+return 1
+"""
+_record_checkout = None
+
+def _record_checkout_wait(wait_ms: float):
+    """Cộng dồn metric vào Redis hash (không bao giờ raise - chỉ phục vụ giám sát)."""
+    global _record_checkout
+    try:
+        if _record_checkout is None:
+            from cache import redis_client
+            _record_checkout = redis_client.register_script(_RECORD_CHECKOUT_SCRIPT)
+        _record_checkout(
+            keys=[POOL_METRICS_KEY],
+            args=[round(wait_ms, 3), SLOW_CHECKOUT_MS, POOL_SIZE, POOL_MAX_OVERFLOW, engine.pool.checkedout()]
+        )
+    except Exception as e:
+        print(f"WARNING: Không ghi được metric pool DB: {e}")
+
+def get_pool_checkout_metrics(pool_name: str = None) -> dict:
+    """Đọc metric thời gian chờ checkout của một loại worker (gevent / prefork)."""
+    from cache import redis_client
+    raw = redis_client.hgetall(f"worker_db_pool_metrics:{pool_name or WORKER_POOL}")
+    checkouts = int(raw.get("checkouts", 0))
+    total_wait = float(raw.get("total_wait_ms", 0))
+    return {
+        "checkouts": checkouts,
+        "slow_checkouts": int(raw.get("slow_checkouts", 0)),
+        "avg_wait_ms": round(total_wait / checkouts, 3) if checkouts else 0.0,
+        "max_wait_ms": float(raw.get("max_wait_ms", 0)),
+        "last_wait_ms": float(raw.get("last_wait_ms", 0)),
+        "checked_out": int(raw.get("checked_out", 0)),
+        "pool_size": int(raw.get("pool_size", 0)),
+        "max_overflow": int(raw.get("max_overflow", 0)),
+    }
+
 @contextmanager
 def get_db_session():
     """
     Cung cấp một session DB cho worker và tự động đóng nó.
     Đây là một "context manager", đảm bảo session luôn được đóng đúng cách.
+    Kết nối được lấy ngay từ đầu để đo thời gian chờ pool.
     """
     db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        db.connection()
+        _record_checkout_wait((time.perf_counter() - started) * 1000)
+        yield db
+    finally:
+        db.close()
+
+@contextmanager
+def get_read_db_session(brand_id: int):
+    """
+    Như get_db_session nhưng chỉ để ĐỌC dữ liệu của một brand: dùng replica khi replica đã theo kịp
+    lần ghi gần nhất của brand (xem replica.py), ngược lại dùng primary.
+    """
+    import replica
+    db = replica.open_read_session(brand_id, SessionLocal, ReplicaSessionLocal)
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
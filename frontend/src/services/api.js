@@ -217,9 +217,9 @@ export const updateBrand = async (brandId, newName) => {
 };
 
 // Hàm nhân bản một brand
-export const cloneBrand = async (brandId) => {
+export const cloneBrand = async (brandId, copyData = false) => {
     try {
-        const response = await apiClient.post(`/brands/${brandId}/clone`);
+        const response = await apiClient.post(`/brands/${brandId}/clone`, null, { params: { copy_data: copyData } });
         return response.data;
     } catch (error) {
         console.error(`Error cloning brand ${brandId}:`, error);
@@ -290,6 +290,102 @@ export const deleteDataInRange = async (brandSlug, startDate, endDate, source =
     }
 };
 
+/**
+ * Chờ kết quả của một data request qua Server-Sent Events.
+ * Dùng fetch (thay vì EventSource) để gửi được header Authorization và hỗ trợ AbortSignal.
+ * @returns {Promise<object|null>} - Envelope {status, data|error}, hoặc null nếu server báo timeout.
+ */
+const streamDataResult = async (cacheKey, signal) => {
+    const token = localStorage.getItem('token');
+    const response = await fetch(`/api/data-requests/stream/${encodeURIComponent(cacheKey)}`, {
+        headers: {
+            Accept: 'text/event-stream',
+            ...(token ? { Authorization: `Bearer ${token}` } : {}),
+        },
+        signal,
+    }).catch((error) => {
+        if (error?.name === 'AbortError') throw new axios.Cancel('Stream was aborted.');
+        throw error;
+    });
+
+    if (!response.ok || !response.body) {
+        throw new Error(`SSE HTTP ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    try {
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) return null;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Mỗi sự kiện SSE kết thúc bằng một dòng trống
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let eventName = 'message';
+                const dataLines = [];
+                rawEvent.split('\n').forEach((line) => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+                });
+
+                if (eventName === 'result') return JSON.parse(dataLines.join('\n'));
+                if (eventName === 'timeout') return null;
+                // Dòng comment keep-alive (": keep-alive") được bỏ qua
+            }
+        }
+    } catch (error) {
+        if (error?.name === 'AbortError') throw new axios.Cancel('Stream was aborted.');
+        throw error;
+    } finally {
+        reader.cancel().catch(() => {});
+    }
+};
+
+/**
+ * Fallback: "hỏi thăm" trạng thái mỗi 2 giây cho đến khi có kết quả.
+ */
+const pollUntilDone = (requestType, cacheKey, signal, throwIfAborted) => new Promise((resolve, reject) => {
+    let pollingInterval;
+
+    const cleanup = () => {
+        if (pollingInterval) clearInterval(pollingInterval);
+        if (signal) signal.removeEventListener('abort', onAbort);
+    };
+
+    const onAbort = () => {
+        cleanup();
+        reject(new axios.Cancel('Polling was aborted.'));
+    };
+    
+    if (signal) signal.addEventListener('abort', onAbort);
+
+    pollingInterval = setInterval(async () => {
+        try {
+            throwIfAborted(); // Check before each poll
+            const statusResponse = await pollDataStatus(cacheKey, signal);
+
+            if (statusResponse.status === 'SUCCESS') {
+                cleanup();
+                resolve(statusResponse.data);
+            } else if (statusResponse.status === 'FAILED') {
+                cleanup();
+                reject(new Error(statusResponse.error || `Worker xử lý '${requestType}' thất bại.`));
+            }
+            // If still 'PROCESSING', do nothing and wait for the next poll.
+        } catch (pollError) {
+            cleanup();
+            reject(pollError);
+        }
+    }, 2000); // Poll every 2 seconds
+});
+
 /**
  * Hàm tổng hợp: Gửi yêu cầu, và tự động "hỏi thăm" (poll) cho đến khi có kết quả.
  * Đây là logic bất đồng bộ chính được các hook sử dụng.
@@ -325,42 +421,29 @@ export const fetchAsyncData = async (requestType, brandSlug, dateRange, params =
             return resultData;
         }
 
+        if (initialResponse.status === 'FAILED') {
+            // Cache hit nhưng là kết quả lỗi (worker đã báo FAILED, còn hiệu lực 5 phút)
+            throw new Error(initialResponse.error || `Worker xử lý '${requestType}' thất bại.`);
+        }
+
         if (initialResponse.status === 'PROCESSING') {
-            return new Promise((resolve, reject) => {
-                let pollingInterval;
-
-                const cleanup = () => {
-                    if (pollingInterval) clearInterval(pollingInterval);
-                    if (signal) signal.removeEventListener('abort', onAbort);
-                };
-
-                const onAbort = () => {
-                    cleanup();
-                    reject(new axios.Cancel('Polling was aborted.'));
-                };
-                
-                if (signal) signal.addEventListener('abort', onAbort);
-
-                pollingInterval = setInterval(async () => {
-                    try {
-                        throwIfAborted(); // Check before each poll
-                        const statusResponse = await pollDataStatus(initialResponse.cache_key, signal);
-
-                        if (statusResponse.status === 'SUCCESS') {
-                            cleanup();
-                            const resultData = statusResponse.data;
-                            resolve(resultData);
-                        } else if (statusResponse.status === 'FAILED') {
-                            cleanup();
-                            reject(new Error(statusResponse.error || `Worker xử lý '${requestType}' thất bại.`));
-                        }
-                        // If still 'PROCESSING', do nothing and wait for the next poll.
-                    } catch (pollError) {
-                        cleanup();
-                        reject(pollError);
-                    }
-                }, 2000); // Poll every 2 seconds
+            const cacheKey = initialResponse.cache_key;
+            // Ưu tiên nhận kết quả qua Server-Sent Events (1 kết nối), lỗi/timeout thì quay về polling
+            const streamed = await streamDataResult(cacheKey, signal).catch((streamError) => {
+                if (axios.isCancel(streamError)) throw streamError;
+                console.warn(`SSE không khả dụng cho '${requestType}', chuyển sang polling:`, streamError);
+                return null;
             });
+
+            if (streamed) {
+                if (streamed.status === 'SUCCESS') return streamed.data;
+                if (streamed.status === 'FAILED') {
+                    throw new Error(streamed.error || `Worker xử lý '${requestType}' thất bại.`);
+                }
+            }
+
+            throwIfAborted();
+            return pollUntilDone(requestType, cacheKey, signal, throwIfAborted);
         }
         
         throw new Error(`Trạng thái phản hồi không mong muốn: ${initialResponse.status}`);
@@ -418,6 +501,27 @@ export const fetchCustomerKpisAPI = async (brandSlug, startDate, endDate, source
     }
 };
 
+/**
+ * Lấy nhiều panel của một trang trong MỘT request (Backend chỉ đọc dữ liệu ngày một lần).
+ * @param {string[]} panels - kpi_summary, daily_kpis_chart, operation_kpis, customer_kpis, top_products, platform_comparison
+ * @returns {Promise<object>} - Object chứa các panel được yêu cầu (+ khoảng thời gian kỳ trước).
+ */
+export const fetchDashboardBundleAPI = async (brandSlug, startDate, endDate, panels, sources = [], interval = 'day', signal) => {
+    try {
+        const payload = { start_date: startDate, end_date: endDate, panels, interval };
+        if (sources && sources.length > 0) {
+            payload.source = sources.includes('all') ? ['all'] : sources;
+        }
+        const response = await apiClient.post(`/brands/${brandSlug}/dashboard-bundle`, payload, { signal });
+        return response.data;
+    } catch (error) {
+        if (!axios.isCancel(error)) {
+            console.error(`Error fetching dashboard bundle for brand ${brandSlug}:`, error);
+        }
+        throw error;
+    }
+};
+
 /**
  * Lấy Top Khách hàng theo kỳ (Dynamic Period).
  * Sử dụng cơ chế Async Worker để tránh timeout.
@@ -0,0 +1,11 @@
+#!/bin/bash
+# Chạy MỘT lần khi primary khởi tạo data dir (docker-entrypoint-initdb.d):
+# tạo user replication và cho phép kết nối streaming từ db-replica.
+# Data dir đã có sẵn -> chạy tay hai bước dưới đây rồi `SELECT pg_reload_conf();`.
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+    CREATE ROLE "${REPLICATION_USER}" WITH REPLICATION LOGIN PASSWORD '${REPLICATION_PASSWORD}';
+EOSQL
+
+echo "host replication ${REPLICATION_USER} all md5" >> "$PGDATA/pg_hba.conf"